@@ -5,11 +5,13 @@ import numpy as np
 from scipy.interpolate import interp1d
 from scipy.signal import convolve
 from scipy import linalg, stats
-import io
-import imageio
+from contextlib import ExitStack
 import datajoint as dj
 from . import preprocess
-from pipeline import experiment
+from pipeline import experiment, config
+from pipeline.utils import receptive_fields
+from pipeline.utils.receptive_fields import RFEngine
+from pipeline.utils.video import ClipCache
 from . import vis
 
 from distutils.version import StrictVersion
@@ -279,8 +281,8 @@ class RF(dj.Computed):
         :param nbins: number of temporal bins in the STA.
         :return: ndarray of shape (n, y, x, nbins)
         """
-        return np.stack((np.tensordot(snippets, movie[:, :, rf_bin:rf_bin + snippets.shape[1]], axes=(1, 2))
-                         for rf_bin in reversed(range(nbins))), 3)
+        maps = receptive_fields.lagged_sta(snippets, receptive_fields.movie_matrix(movie), nbins)
+        return maps.reshape(len(maps), *movie.shape[:2], nbins)
 
     @staticmethod
     def predict_traces(movie, maps):
@@ -289,11 +291,8 @@ class RF(dj.Computed):
         :param maps: ndarray of shape (n, y, x, nbins)
         :return: traces ndarray of shape (n, t)
         """
-        nbins = maps.shape[-1]
-        return sum(
-            np.tensordot(maps[:, :, :, nbins - tau - 1], movie, axes=((1, 2), (0, 1)))[:,
-            tau:movie.shape[2] + tau - nbins + 1]
-            for tau in range(nbins))
+        return receptive_fields.lagged_prediction(receptive_fields.movie_matrix(movie),
+                                                  maps.reshape(len(maps), -1, maps.shape[-1]))
 
     @staticmethod
     def soft_thresh(maps, lam, mu):
@@ -357,60 +356,66 @@ class RF(dj.Computed):
         # cache traces
         print('computing STA...', flush=True)
         stim_duration = 0
-        cache = {}
+        clip_cache = ClipCache(config['path.clip_cache'], config['clip_cache.max_gb'] * 1024 ** 3)
         trace_norm = np.zeros(n_traces)
         maps = 0  # spike-triggered average
-        for trial_key in trial_keys:
-            # load the movies
-            print('%d' % trial_key['trial_idx'], flush=True, end=' ')
-            movie_times = (vis.Trial() & trial_key).fetch1['flip_times'].flatten()
-            fps = 1 / np.diff(movie_times).mean()
-            stim_duration += movie_times[-1] - movie_times[0]
-            if stim_selection == 'monet':
-                movie, cond = (vis.Monet() * vis.MonetLookup() & trial_key).fetch1['cached_movie', 'rng_seed']
-                movie = (np.float32(movie) - 127.5) / 126.5  # rescale to [-1, +1]
-            elif stim_selection == 'clips':
-                movie, cond = (vis.MovieClipCond() * vis.Movie.Clip() & trial_key).fetch1['clip', 'clip_number']
-                movie = imageio.get_reader(io.BytesIO(movie.tobytes()), 'ffmpeg')
-                movie = np.stack((np.float64(frame).mean(axis=2) * 2 / 255 - 1
-                                  for t, frame in zip(movie_times, movie.iter_data())), axis=2)
-                # high-pass filter above 1 Hz
-                movie -= convolve(movie, hamming(fps, 2), 'same')
-            else:
-                raise NotImplementedError('invalid stimulus selection')
-            # rebin the movie to bin_size.  Reverse time for convolution.
-            start_time = movie_times[0] + bin_size / 2
-            movie = convolve(movie, hamming(bin_size * fps, 2), 'same')
-            movie = interp1d(movie_times, movie)
-            movie = movie(np.r_[start_time:movie_times[-1]:bin_size]) / np.sqrt(number_of_repeats[cond])
-            if algorithm != 'sta':
-                # cache the movie if it's needed for iterations
-                cache[trial_key['trial_idx']] = movie
-            snippets = traces(np.r_[start_time + bin_size * (nbins - 1):movie_times[-1]:bin_size])
-            trace_norm += ((snippets - snippets.mean(axis=1, keepdims=True)) ** 2
-                           / number_of_repeats[cond]).sum(axis=1)
-            maps += RF.spike_triggered_avg(snippets, movie, nbins)
-        del traces
-        del snippets
-
-        if algorithm == 'backprop':
-            sta = maps
-            iterations = 15
-            beta = 0.4
-            maps = beta * RF.soft_thresh(sta, lam=0.5, mu=0.05)
-            print()
-            for iteration in range(iterations):
-                predicted_sta = 0
-                for trial_key in trial_keys:
-                    print(end='.', flush=True)
-                    movie = cache[trial_key['trial_idx']]
-                    predicted_traces = RF.predict_traces(movie, maps)
-                    predicted_sta += RF.spike_triggered_avg(predicted_traces, movie, nbins)
-                predicted_sta /= np.maximum(1, np.sqrt(
-                    (predicted_sta ** 2).sum(axis=(1, 2, 3), keepdims=True) /
-                    (sta ** 2).sum(axis=(1, 2, 3), keepdims=True)))
-                maps = RF.soft_thresh(maps + beta * (sta - predicted_sta), lam=beta * 0.5, mu=beta * 0.05)
-                print('iteration', iteration, flush=True)
+        with ExitStack() as exit_stack:
+            # backprop iterates over the movies so they are cached on disk (deleted on exit)
+            engine = (exit_stack.enter_context(RFEngine(nbins, cache_dir=config['path.scratch']))
+                      if algorithm == 'backprop' else None)
+            for trial_key in trial_keys:
+                # load the movies
+                print('%d' % trial_key['trial_idx'], flush=True, end=' ')
+                movie_times = (vis.Trial() & trial_key).fetch1['flip_times'].flatten()
+                fps = 1 / np.diff(movie_times).mean()
+                stim_duration += movie_times[-1] - movie_times[0]
+                if stim_selection == 'monet':
+                    movie, cond = (vis.Monet() * vis.MonetLookup() & trial_key).fetch1['cached_movie', 'rng_seed']
+                    movie = (np.float32(movie) - 127.5) / 126.5  # rescale to [-1, +1]
+                elif stim_selection == 'clips':
+                    movie, cond = (vis.MovieClipCond() * vis.Movie.Clip() & trial_key).fetch1['clip', 'clip_number']
+                    movie = clip_cache.load(movie.tobytes())  # repeated clips are decoded once
+                    movie = np.stack([np.float64(frame).mean(axis=2) * 2 / 255 - 1
+                                      for t, frame in zip(movie_times, movie)], axis=2)
+                    # high-pass filter above 1 Hz
+                    movie -= convolve(movie, hamming(fps, 2), 'same')
+                else:
+                    raise NotImplementedError('invalid stimulus selection')
+                # rebin the movie to bin_size.  Reverse time for convolution.
+                start_time = movie_times[0] + bin_size / 2
+                movie = convolve(movie, hamming(bin_size * fps, 2), 'same')
+                movie = interp1d(movie_times, movie)
+                movie = movie(np.r_[start_time:movie_times[-1]:bin_size]) / np.sqrt(number_of_repeats[cond])
+                snippets = traces(np.r_[start_time + bin_size * (nbins - 1):movie_times[-1]:bin_size])
+                trace_norm += ((snippets - snippets.mean(axis=1, keepdims=True)) ** 2
+                               / number_of_repeats[cond]).sum(axis=1)
+                if engine is None:
+                    maps += RF.spike_triggered_avg(snippets, movie, nbins)
+                else:
+                    # cache the movie (on disk) so iterations do not rebin it again
+                    engine.add_movie(trial_key['trial_idx'], movie)
+                    maps += engine.spike_triggered_avg(snippets, trial_key['trial_idx'])
+                del movie
+            del traces
+            del snippets
+
+            if algorithm == 'backprop':
+                sta = maps
+                iterations = 15
+                beta = 0.4
+                maps = beta * RF.soft_thresh(sta, lam=0.5, mu=0.05)
+                print()
+                for iteration in range(iterations):
+                    predicted_sta = 0
+                    for trial_key in trial_keys:
+                        print(end='.', flush=True)
+                        predicted_traces = engine.predict_traces(trial_key['trial_idx'], maps)
+                        predicted_sta += engine.spike_triggered_avg(predicted_traces, trial_key['trial_idx'])
+                    predicted_sta /= np.maximum(1, np.sqrt(
+                        (predicted_sta ** 2).sum(axis=(1, 2, 3), keepdims=True) /
+                        (sta ** 2).sum(axis=(1, 2, 3), keepdims=True)))
+                    maps = RF.soft_thresh(maps + beta * (sta - predicted_sta), lam=beta * 0.5, mu=beta * 0.05)
+                    print('iteration', iteration, flush=True)
 
         # submit data
         self.insert1(dict(key,
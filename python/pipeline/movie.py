@@ -1,10 +1,10 @@
 from random import shuffle
 import cv2
-import io
-import imageio
 import numpy as np
 import datajoint as dj
 from stimulus import stimulus
+from . import config
+from .utils.video import ClipCache
 
 
 schema = dj.schema('pipeline_movies', locals())
@@ -34,11 +34,9 @@ class MovieQualityLabels(dj.Manual):
     def load_movie(self, key):
         movie = (stimulus.Movie() * stimulus.Movie.Clip() & key).fetch1('clip')
 
-        vid = imageio.get_reader(io.BytesIO(movie.tobytes()), 'ffmpeg')
-        # convert to grayscale and stack to movie in width x height x time
-        m = vid.get_length()
-        movie = np.stack([vid.get_data(i) for i in range(m)], axis=0)
-        return movie
+        # decoded once per clip (frames x height x width x 3, RGB)
+        cache = ClipCache(config['path.clip_cache'], config['clip_cache.max_gb'] * 1024 ** 3)
+        return cache.load(movie.tobytes())
 
     def populate(self, limit=None):
         keys = self.unpopulated.fetch(dj.key)
@@ -6,7 +6,8 @@ import numpy as np
 
 from pipeline import mice
 from pipeline import meso
-from pipeline.utils import h5
+from pipeline.utils import h5, signal
+from pipeline.exceptions import PipelineException
 from commons import lab
 
 
@@ -92,10 +93,7 @@ class OdorTrials(dj.Imported):
             ex. decimal(10) -> [False, True, False, True] -> 2nd and 4th valve open.
         """
 
-        # Format integer into binary, then convert each 0/1 into boolean
-        # Finally, reverse list to make first index encode first valve
-        valve_states = [bool(int(d)) for d in format(int(num), 'b')][::-1]
-        return np.array(valve_states)
+        return h5.decode_valves([num])[0]
 
     def make(self, key):
 
@@ -122,22 +120,16 @@ class OdorTrials(dj.Imported):
         # Shift start indices by one to get end indices
         trial_end_times = h5.ts2sec(digital_data['ts'][valve_open_idx + 1])
 
-        # All keys are appended to a list and inserted at the end to prevent errors from halting mid-calculation
-        all_trial_keys = []
-
         # Find all trials and insert a key for each channel open during each trial
-        for trial_num, (state, start, stop) in enumerate(zip(trial_valve_states, trial_start_times, trial_end_times)):
-
-            valve_array = OdorTrials.convert_valves(state)
-
-            for valve_num in np.where(valve_array)[0]:  # Valve array is already a boolean, look for all true values
-
-                # We start counting valves at 1, not 0 like python indices
-                valve_num = valve_num + 1
-                trial_key = [key['animal_id'], key['odor_session'], key['recording_idx'],
-                             trial_num, valve_num, start, stop]
-                all_trial_keys.append(trial_key)
-
+        valve_arrays = h5.decode_valves(trial_valve_states)  # num_trials x num_valves
+        trial_nums, valve_idx = np.where(valve_arrays)
+
+        # All keys are inserted at the end to prevent errors from halting mid-calculation
+        # We start counting valves at 1, not 0 like python indices
+        all_trial_keys = [[key['animal_id'], key['odor_session'], key['recording_idx'],
+                           trial_num, valve_num, start, stop] for trial_num, valve_num, start, stop
+                          in zip(trial_nums, valve_idx + 1, trial_start_times[trial_nums],
+                                 trial_end_times[trial_nums])]
         self.insert(all_trial_keys)
 
         print(f'{valve_open_idx.shape[0]} odor trials found and inserted for {key}.\n')
@@ -165,9 +157,9 @@ class OdorSync(dj.Imported):
         analog_filename = os.path.join(local_path, filename_base + '_%d.h5')
 
         # Load olfactory data
-        analog_data = h5.read_analog_olfaction_file(analog_filename)
+        analog_data = h5.decode_analog_olfaction_file(analog_filename)
 
-        scan_times = h5.ts2sec(analog_data['ts'], is_packeted=True)
+        scan_times = analog_data['times']
         binarized_signal = analog_data['scanImage'] > 2.7  # TTL voltage low/high threshold
         rising_edges = np.where(np.diff(binarized_signal.astype(int)) > 0)[0]
         frame_times = scan_times[rising_edges]
@@ -182,17 +174,7 @@ class OdorSync(dj.Imported):
 
             # Fill each gap of nan values with correct number of timepoints
             frame_period = np.nanmedian(np.diff(frame_times))  # approx
-            nan_limits = np.where(np.diff(np.isnan(frame_times)))[0]
-            nan_limits[1::2] += 1  # limits are indices of the last valid point before the nan gap and first after it
-            correct_fts = []
-            for i, (start, stop) in enumerate(zip(nan_limits[::2], nan_limits[1::2])):
-                correct_fts.extend(frame_times[0 if i == 0 else nan_limits[2 * i - 1]: start + 1])
-                num_missing_points = int(round((frame_times[stop] - frame_times[start]) /
-                                               frame_period - 1))
-                correct_fts.extend(np.linspace(frame_times[start], frame_times[stop],
-                                               num_missing_points + 2)[1:-1])
-            correct_fts.extend(frame_times[nan_limits[-1]:])
-            frame_times = np.array(correct_fts)
+            frame_times = signal.fill_time_gaps(frame_times, frame_period)
 
         # Check that frame times occur at the same period
         frame_intervals = np.diff(frame_times)
@@ -228,9 +210,9 @@ class Respiration(dj.Imported):
         filename_base = (OdorRecording & key).fetch1('filename')
         analog_filename = os.path.join(local_path, filename_base + '_%d.h5')
 
-        # Load olfactory data
-        analog_data = h5.read_analog_olfaction_file(analog_filename)
-        breath_times = h5.ts2sec(analog_data['ts'], is_packeted=True)
+        # Load olfactory data (decoded file is shared with OdorSync)
+        analog_data = h5.decode_analog_olfaction_file(analog_filename)
+        breath_times = analog_data['times'].copy()
         breath_trace = analog_data['breath']
 
         # Correct NaN gaps in timestamps (mistimed or dropped packets during recording)
@@ -242,10 +224,9 @@ class Respiration(dj.Imported):
                 raise PipelineException(msg)
 
             # Linear interpolate between nans
-            nans_idx = np.where(np.isnan(breath_times))[0]
             non_nans_idx = np.where(~np.isnan(breath_times))[0]
-            breath_times[nans_idx] = np.interp(nans_idx, non_nans_idx, breath_times[non_nans_idx])
             print(f'Largest NaN gap found: {np.max(np.abs(np.diff(breath_times[non_nans_idx])))} seconds')
+            breath_times = signal.fill_nans(breath_times)
 
         # Check that frame times occur at the same period
         breath_intervals = np.diff(breath_times)
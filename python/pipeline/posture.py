@@ -7,6 +7,7 @@ from commons import lab
 import os
 
 from .utils import h5
+from .utils.video import DecodeService, preview_sampler, frame_statistics
 from . import experiment, notify
 from .exceptions import PipelineException
 
@@ -56,13 +57,28 @@ class Posture(dj.Imported):
             timestamps_in_secs[np.logical_and(timestamps_in_secs > lower_ts,
                                               timestamps_in_secs < upper_ts)] = float('nan')
 
-        # Read video
+        # Read video: decode it once for the preview frames and the number of frames
         filename = (experiment.Scan.PostureVideo() & key).fetch1('filename')
         full_filename = os.path.join(local_path, filename)
         video = cv2.VideoCapture(full_filename)
+        header_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))  # can be wrong
+        video.release()
+        preview_idx = np.round(np.linspace(0, header_frames - 1, 16)).astype(int)
+
+        service = DecodeService(full_filename, gray=False)
+        service.register('preview', preview_sampler(preview_idx))
+        service.register('statistics', frame_statistics)
+        results, errors = service.run()
+        if errors:
+            raise PipelineException('Could not decode {}: {}'.format(full_filename,
+                                                                     errors))
+        if len(results['preview']) < len(preview_idx):
+            msg = 'Only {} of {} frames could be decoded'.format(
+                len(results['statistics']), header_frames)
+            raise PipelineException(msg)
 
         # Fix inconsistent num_video_frames vs num_timestamps
-        num_video_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        num_video_frames = len(results['statistics'])  # decoded frames
         num_timestamps = len(timestamps_in_secs)
         if num_timestamps != num_video_frames:
             if abs(num_timestamps - num_video_frames) > 1:
@@ -74,13 +90,9 @@ class Posture(dj.Imported):
             else: # fill with NaNs
                 timestamps_in_secs[-1] = float('nan')
 
-        # Get 16 sample frames
-        frames = []
-        for frame_idx in np.round(np.linspace(0, num_video_frames - 1, 16)).astype(int):
-            video.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-            _, frame = video.read()
-            frames.append(np.asarray(frame, dtype=float)[..., 0])
-        frames = np.stack(frames, axis=-1)
+        # 16 sample frames
+        frames = np.stack([np.asarray(frame, dtype=float)[..., 0] for frame in
+                           results['preview']], axis=-1)
 
         # Insert
         self.insert1({**key, 'posture_time': timestamps_in_secs,
@@ -33,8 +33,9 @@ from datajoint.jobs import key_hash
 from datajoint.autopopulate import AutoPopulate
 
 from .utils.decorators import gitlog
-from .utils import eye_tracking, h5
+from .utils import eye_tracking, h5, pupil_fitting, performance
 from .utils.eye_tracking import PupilTracker, ManualTracker
+from .utils.video import DecodeService, preview_sampler, frame_statistics
 from . import config
 from . import experiment, notify, shared
 from .exceptions import PipelineException
@@ -71,6 +72,19 @@ DEFAULT_PARAMETERS = {'relative_area_threshold': 0.002,
                       }
 
 
+def _insert_in_chunks(table, rows, **kwargs):
+    """ Insert rows with one statement per config['insert.chunk_size'] rows."""
+    performance.insert_in_chunks(table, rows, config['insert.chunk_size'], **kwargs)
+
+
+def _object_array(rows, num_columns):
+    """ 2-d object array of rows that np.array would treat as ragged (e.g., tuples and None)."""
+    array = np.empty((len(rows), num_columns), dtype=object)
+    for i, row in enumerate(rows):
+        array[i] = row
+    return array
+
+
 @schema
 class Eye(dj.Imported):
     definition = """  
@@ -121,14 +135,29 @@ class Eye(dj.Imported):
             timestamps_in_secs[np.logical_and(timestamps_in_secs > lower_ts,
                                               timestamps_in_secs < upper_ts)] = float('nan')
 
-        # Read video
+        # Read video: decode it once for the preview frames and the number of frames
         filename = (experiment.Scan.EyeVideo() & key).fetch1('filename')
         full_filename = os.path.join(local_path, filename)
         # note: prints many 'Unexpected list ...'
         video = cv2.VideoCapture(full_filename)
+        header_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))  # can be wrong
+        video.release()
+        preview_idx = np.round(np.linspace(0, header_frames - 1, 16)).astype(int)
+
+        service = DecodeService(full_filename, gray=False)
+        service.register('preview', preview_sampler(preview_idx))
+        service.register('statistics', frame_statistics)
+        results, errors = service.run()
+        if errors:
+            raise PipelineException('Could not decode {}: {}'.format(full_filename,
+                                                                     errors))
+        if len(results['preview']) < len(preview_idx):
+            msg = 'Only {} of {} frames could be decoded'.format(
+                len(results['statistics']), header_frames)
+            raise PipelineException(msg)
 
         # Fix inconsistent num_video_frames vs num_timestamps
-        num_video_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        num_video_frames = len(results['statistics'])  # decoded frames
         num_timestamps = len(timestamps_in_secs)
         if num_timestamps != num_video_frames:
             if abs(num_timestamps - num_video_frames) > 1:
@@ -141,13 +170,9 @@ class Eye(dj.Imported):
                 timestamps_in_secs = np.array(
                     [*timestamps_in_secs, float('nan')])
 
-        # Get 16 sample frames
-        frames = []
-        for frame_idx in np.round(np.linspace(0, num_video_frames - 1, 16)).astype(int):
-            video.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-            _, frame = video.read()
-            frames.append(np.asarray(frame, dtype=float)[..., 0])
-        frames = np.stack(frames, axis=-1)
+        # 16 sample frames
+        frames = np.stack([np.asarray(frame, dtype=float)[..., 0] for frame in
+                           results['preview']], axis=-1)
 
         # Insert
         self.insert1({**key, 'eye_time': timestamps_in_secs,
@@ -290,17 +315,19 @@ class TrackedVideo(dj.Computed):
         else:
             mask = None
 
-        tr = PupilTracker(param, mask=mask)
         # -1 because of matlab indices
-        traces = tr.track(avi_path, roi - 1,
-                          display=config['display.tracking'])
+        if config['display.tracking']:
+            tr = PupilTracker(param, mask=mask)
+            traces = tr.track(avi_path, roi - 1, display=True)
+        else:
+            traces = eye_tracking.track_parallel(param, avi_path, roi - 1, mask=mask,
+                                                 num_processes=config['tracking.num_processes'])
 
         key['tracking_parameters'] = json.dumps(param)
         self.insert1(key)
-        fr = self.Frame()
-        for trace in traces:
-            trace.update(key)
-            fr.insert1(trace, ignore_extra_fields=True)
+        attrs = ['rotated_rect', 'contour', 'center', 'major_r', 'frame_intensity']  # NULL if missing
+        _insert_in_chunks(self.Frame(), ({**key, **{a: None for a in attrs}, **trace}
+                                         for trace in traces), ignore_extra_fields=True)
 
         self.notify(key)
 
@@ -487,47 +514,51 @@ class FittedContour(dj.Computed):
     def make(self, key):
         print("Populating", key)
 
-        avi_path = (Eye() & key).get_video_path()
-
         contours = (ManuallyTrackedContours.Frame() & key).fetch(
             order_by='frame_id ASC', as_dict=True)
-        self._cap = cap = cv2.VideoCapture(avi_path)
+        centers, axes, _ = pupil_fitting.fit_contours(
+            [ckey['contour'] for ckey in contours], min_points=5,
+            num_processes=config['tracking.num_processes'])
+        for ckey, center, major_r in zip(contours, centers, axes.max(axis=1)):
+            fitted = not np.isnan(major_r)
+            ckey['center'] = center.astype(np.float32) if fitted else None
+            ckey['major_r'] = major_r if fitted else None
+
+        self.insert1(key)
+        _insert_in_chunks(self.Ellipse(), contours, ignore_extra_fields=True)
+
+        if config['display.tracking']:
+            self.replay(key)
+
+    def replay(self, key):
+        """ Show the contours and fitted ellipses over the video (press q to stop).
 
-        frame_number = 0
+        Arguments:
+            key (dict): Key of a populated FittedContour.
+        """
+        avi_path = (Eye() & key).get_video_path()
+        contours = (ManuallyTrackedContours.Frame() & key).fetch('contour', order_by='frame_id')
+        centers = (self.Ellipse() & key).fetch('center', order_by='frame_id')
+
+        cap = cv2.VideoCapture(avi_path)
         n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        while cap.isOpened():
-            if frame_number >= n_frames - 1:
-                print("Reached end of videofile ", avi_path)
+        for frame_number, contour, ecenter in zip(range(n_frames), contours, centers):
+            ret, frame = cap.read()
+            if not ret or frame is None:
+                break
+            if ecenter is not None:
+                cv2.drawContours(frame, [contour], -1, (0, 255, 0), 1)
+                cv2.circle(frame, tuple(contour.mean(axis=0).squeeze().astype(int)), 4,
+                           (0, 165, 255), -1)
+                cv2.ellipse(frame, cv2.fitEllipse(contour), (255, 0, 255), 2)
+                cv2.circle(frame, tuple(map(int, ecenter)), 5, (255, 165, 0), -1)
+            self.display_frame_number(frame, frame_number, n_frames)
+            cv2.imshow('Sauron', frame)
+            if (cv2.waitKey(5) & 0xFF) == ord('q'):
                 break
-
-            ret, frame = self._cap.read()
-            ckey = contours[frame_number]
-            if ret and frame is not None and ckey['contour'] is not None:
-                if ckey['contour'] is not None and len(ckey['contour']) >= 5:
-                    contour = ckey['contour']
-                    center = contour.mean(axis=0)
-                    cv2.drawContours(frame, [contour], -1, (0, 255, 0), 1)
-                    cv2.circle(frame, tuple(
-                        center.squeeze().astype(int)), 4, (0, 165, 255), -1)
-                    ellipse = cv2.fitEllipse(contour)
-                    cv2.ellipse(frame, ellipse, (255, 0, 255), 2)
-                    ecenter = ellipse[0]
-                    cv2.circle(frame, tuple(map(int, ecenter)),
-                               5, (255, 165, 0), -1)
-                    ckey['center'] = np.array(ecenter, dtype=np.float32)
-                    ckey['major_r'] = max(ellipse[1])
-                self.display_frame_number(frame, frame_number, n_frames)
-                cv2.imshow('Sauron', frame)
-                if (cv2.waitKey(5) & 0xFF) == ord('q'):
-                    break
-            frame_number += 1
         cap.release()
         cv2.destroyAllWindows()
 
-        self.insert1(key)
-        for ckey in tqdm(contours):
-            self.Ellipse().insert1(ckey, ignore_extra_fields=True)
-
 # If config.yaml ever updated, make sure you store the file name differently so that it becomes unique
 @schema
 class ConfigDeeplabcut(dj.Manual):
@@ -579,30 +610,22 @@ class Tracking(dj.Computed):
                 Simply re-inserting previously tracked data here!
                 """)
 
+                # copy Frame info
+                frames = (ManuallyTrackedContours.Frame & key).fetch(as_dict=True,
+                                                                      order_by='frame_id')
+                _insert_in_chunks(self, (dict(frame_key, tracking_method=key['tracking_method'])
+                                         for frame_key in frames))
+
                 # check if parameter table was populated b4. 
                 # If not, we can skip inserting param information
-                if len(ManuallyTrackedContours.Parameter & key) == 0:
-                    for frame_id in range(len(ManuallyTrackedContours.Frame & key)):
-                        # copy Frame info
-                        frame_key = (ManuallyTrackedContours.Frame &
-                                    dict(key, frame_id=frame_id)).fetch1()
-                        self.insert1(
-                            dict(frame_key, tracking_method=key['tracking_method']))
-
-                else:
-                    for frame_id in range(len(ManuallyTrackedContours.Frame & key)):
-                        # copy Frame info
-                        frame_key = (ManuallyTrackedContours.Frame &
-                                    dict(key, frame_id=frame_id)).fetch1()
-                        self.insert1(
-                            dict(frame_key, tracking_method=key['tracking_method']))
-                        # copy Parameter info
-                        param_key = (ManuallyTrackedContours.Parameter &
-                                    dict(key, frame_id=frame_id)).fetch1()
-                        min_lambda = (ManuallyTrackedContours &
-                                    key).fetch1('min_lambda')
-                        Tracking.ManualTrackingParameter.insert1(
-                            dict(param_key, min_lambda=min_lambda, tracking_method=key['tracking_method']))
+                if len(ManuallyTrackedContours.Parameter & key) > 0:
+                    # copy Parameter info
+                    min_lambda = (ManuallyTrackedContours & key).fetch1('min_lambda')
+                    params = (ManuallyTrackedContours.Parameter & key).fetch(as_dict=True,
+                                                                            order_by='frame_id')
+                    _insert_in_chunks(Tracking.ManualTrackingParameter, (dict(
+                        param_key, min_lambda=min_lambda, tracking_method=key['tracking_method'])
+                        for param_key in params))
 
             # key does not exist in ManuallyTrackedContours, hence need to trace manually
             else:
@@ -624,19 +647,17 @@ class Tracking(dj.Computed):
 
                 logtrace = tracker.mixing_constant.logtrace.astype(float)
                 min_lambda = logtrace[logtrace > 0].min()
-                frame = Tracking.ManualTracking()
-                parameters = Tracking.ManualTrackingParameter()
+                contours, parameters = [], []
                 for frame_id, ok, contour, params in tqdm(zip(count(), tracker.contours_detected, tracker.contours,
                                                               tracker.parameter_iter()),
                                                           total=len(tracker.contours)):
                     assert frame_id == params['frame_id']
-                    if ok:
-                        frame.insert1(
-                            dict(key, frame_id=frame_id, contour=contour))
-                    else:
-                        frame.insert1(dict(key, frame_id=frame_id))
-                    parameters.insert1(
-                        dict(key, **params, min_lambda=min_lambda), ignore_extra_fields=True)
+                    contours.append([contour if ok else None])
+                    parameters.append(dict(key, **params, min_lambda=min_lambda))
+                _insert_in_chunks(Tracking.ManualTracking(),
+                                  performance.frame_rows(key, contours, ['contour']))
+                _insert_in_chunks(Tracking.ManualTrackingParameter(), parameters,
+                                  ignore_extra_fields=True)
 
     class Deeplabcut(dj.Part):
         definition = """
@@ -728,6 +749,7 @@ class Tracking(dj.Computed):
             """
             Use Deeplabcut to label pupil and eyelids
             """
+            from . import config as pipeline_config
 
             print('Tracking labels with Deeplabcut!')
 
@@ -748,11 +770,34 @@ class Tracking(dj.Computed):
                 config, config['shuffle'], trainFraction)
 
             # make needed directories
-            tracking_dir, _ = self.create_tracking_directory(key)
+            tracking_dir, video_path = self.create_tracking_directory(key)
+
+            if pipeline_config['dlc.streaming']:
+                # decode the original video and feed (cropped) frames to the network in batches
+                batch_size = pipeline_config['dlc.batch_size']
+                predict_batch, bodyparts = DLC_tools.load_pose_predictor(config, batch_size)
+
+                cap = cv2.VideoCapture(video_path)
+                original_width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+                original_height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+                mid_frame_num = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) / 2)
+                short_num_frames = int(round(5 * cap.get(cv2.CAP_PROP_FPS)))  # 5 seconds
+                cap.release()
+
+                case = os.path.basename(video_path).split('.')[0]
+                short_video_path = os.path.join(tracking_dir, 'short', case + '_short.avi')
+                short_h5_path = short_video_path.split('.')[0] + DLCscorer + '.h5'
+                DLC_tools.predict_labels_streaming(
+                    video_path, short_h5_path, DLCscorer, predict_batch, bodyparts, batch_size,
+                    start=mid_frame_num, stop=mid_frame_num + short_num_frames)
+            else:
+                # make a short video (5 seconds long)
+                short_video_path, original_width, original_height, mid_frame_num = DLC_tools.make_short_video(
+                    tracking_dir)
+                short_h5_path = short_video_path.split('.')[0] + DLCscorer + '.h5'
 
-            # make a short video (5 seconds long)
-            short_video_path, original_width, original_height, mid_frame_num = DLC_tools.make_short_video(
-                tracking_dir)
+                # predict using the short video
+                DLC_tools.predict_labels(short_video_path, config)
 
             # add original width and height to config
             config['original_width'] = original_width
@@ -761,11 +806,6 @@ class Tracking(dj.Computed):
             # save info about short video
             key['short_vid_starting_index'] = mid_frame_num
 
-            short_h5_path = short_video_path.split('.')[0] + DLCscorer + '.h5'
-
-            # predict using the short video
-            DLC_tools.predict_labels(short_video_path, config)
-
             # obtain the cropping coordinates from the prediciton on short video
             cropped_coords = DLC_tools.obtain_cropping_coords(
                 short_h5_path, DLCscorer, config)
@@ -777,12 +817,22 @@ class Tracking(dj.Computed):
                                                   original_height=original_height,
                                                   pixel_num=pixel_num)
 
-            # make a compressed and cropped video
-            compressed_cropped_video_path = DLC_tools.make_compressed_cropped_video(
-                tracking_dir, cropped_coords)
+            if pipeline_config['dlc.streaming']:
+                # predict on the cropped original video (labels are saved where the
+                # compressed and cropped video would be)
+                compressed_cropped_video_path = os.path.join(
+                    tracking_dir, 'compressed_cropped', case + '_compressed_cropped.avi')
+                DLC_tools.predict_labels_streaming(
+                    video_path, compressed_cropped_video_path.split('.')[0] + DLCscorer + '.h5',
+                    DLCscorer, predict_batch, bodyparts, batch_size,
+                    cropped_coords=cropped_coords)
+            else:
+                # make a compressed and cropped video
+                compressed_cropped_video_path = DLC_tools.make_compressed_cropped_video(
+                    tracking_dir, cropped_coords)
 
-            # predict using the compressed and cropped video
-            DLC_tools.predict_labels(compressed_cropped_video_path, config)
+                # predict using the compressed and cropped video
+                DLC_tools.predict_labels(compressed_cropped_video_path, config)
 
             key = dict(key, cropped_x0=cropped_coords['cropped_x0'],
                        cropped_x1=cropped_coords['cropped_x1'],
@@ -796,7 +846,8 @@ class Tracking(dj.Computed):
             shutil.rmtree(os.path.dirname(short_video_path))
 
             # delete compressed and cropped video
-            os.remove(compressed_cropped_video_path)
+            if not pipeline_config['dlc.streaming']:
+                os.remove(compressed_cropped_video_path)
 
     def make(self, key):
         print("Tracking for case {}".format(key))
@@ -918,29 +969,34 @@ class FittedPupil(dj.Computed):
             pupil_fit = DLC_tools.DeeplabcutPupilFitting(
                 config=config, bodyparts='all', cropped=True)
 
-            for frame_num in tqdm(range(nframes)):
+            # fit all frames at once (fit_all_frames(raster=True) draws masks frame by frame)
+            fits = pupil_fit.fit_all_frames(num_frames=nframes)
+            circle, ellipse = fits['circle'], fits['ellipse']
 
-                fit_dict = pupil_fit.fitted_core(frame_num=frame_num)
+            for frame_num in range(nframes):
 
                 # circle info
-                center = fit_dict['circle_fit']['center']
-                radius = fit_dict['circle_fit']['radius']
-                visible_portion = fit_dict['circle_visible']['visible_portion']
-
-                data_circle.append([center, radius, visible_portion])
+                if np.isnan(circle['radius'][frame_num]):
+                    data_circle.append([None, None, circle['visible_portion'][frame_num]])
+                else:
+                    data_circle.append([tuple(circle['center'][frame_num]),
+                                        circle['radius'][frame_num],
+                                        circle['visible_portion'][frame_num]])
 
                 # ellipse info
-                center = fit_dict['ellipse_fit']['center']
-                major_radius = fit_dict['ellipse_fit']['major_radius']
-                minor_radius = fit_dict['ellipse_fit']['minor_radius']
-                rotation_angle = fit_dict['ellipse_fit']['rotation_angle']
-                visible_portion = fit_dict['ellipse_visible']['visible_portion']
-
-                data_ellipse.append([center, major_radius, minor_radius,
-                                     rotation_angle, visible_portion])
+                if np.isnan(ellipse['major_radius'][frame_num]):
+                    data_ellipse.append([None, None, None, None,
+                                         ellipse['visible_portion'][frame_num]])
+                else:
+                    data_ellipse.append([tuple(ellipse['center'][frame_num]),
+                                         ellipse['major_radius'][frame_num],
+                                         ellipse['minor_radius'][frame_num],
+                                         ellipse['rotation_angle'][frame_num],
+                                         ellipse['visible_portion'][frame_num]])
 
-        data_circle = np.array(data_circle)
-        data_ellipse = np.array(data_ellipse)
+        # object arrays (rows mix tuples, floats and None)
+        data_circle = _object_array(data_circle, 3)
+        data_ellipse = _object_array(data_ellipse, 5)
 
         # now filter out the outliers by 5.5 std away from mean
         rejected_ind = DLC_tools.filter_by_fitting_std(
@@ -948,14 +1004,9 @@ class FittedPupil(dj.Computed):
 
         data_circle[rejected_ind] = None, None, -3.0
 
-        common_entry = np.array(list(key.values()))
-        common_matrix = np.tile(common_entry, (nframes, 1))
-
-        data_circle = np.hstack(
-            (common_matrix, np.arange(nframes).reshape(-1, 1), data_circle))
-
         # insert data
-        self.Circle.insert(data_circle)
+        _insert_in_chunks(self.Circle, performance.frame_rows(
+            key, data_circle, ['center', 'radius', 'visible_portion']))
 
         # now repeat the process for ellipse
         rejected_ind = DLC_tools.filter_by_fitting_std(
@@ -963,10 +1014,9 @@ class FittedPupil(dj.Computed):
 
         data_ellipse[rejected_ind, :] = None, None, None, None, -3.0
 
-        data_ellipse = np.hstack(
-            (common_matrix, np.arange(nframes).reshape(-1, 1), data_ellipse))
-
-        self.Ellipse.insert(data_ellipse)
+        _insert_in_chunks(self.Ellipse, performance.frame_rows(
+            key, data_ellipse, ['center', 'major_radius', 'minor_radius', 'rotation_angle',
+                                'visible_portion']))
 
 
 
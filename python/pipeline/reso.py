@@ -5,8 +5,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 import scanreader
 
-from . import experiment, notify, shared
+from . import experiment, notify, shared, config
 from .utils import galvo_corrections, signal, quality, mask_classification, performance
+from .utils.masks import SparseMaskSet
 from .exceptions import PipelineException
 
 
@@ -816,8 +817,6 @@ class Segmentation(dj.Computed):
             """
             from .utils import caiman_interface as cmn
             import json
-            import uuid
-            import os
 
             print('')
             print('*' * 85)
@@ -834,25 +833,6 @@ class Segmentation(dj.Computed):
             scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
             scan = scanreader.read_scan(scan_filename)
 
-            # Create memory mapped file (as expected by CaImAn)
-            print('Creating memory mapped file...')
-            filename = '/tmp/caiman-{}_d1_{}_d2_{}_d3_1_order_C_frames_{}_.mmap'.format(
-                uuid.uuid4(), image_height, image_width, num_frames)
-            mmap_shape = (image_height * image_width, num_frames)
-            mmap_scan = np.memmap(filename, mode='w+', shape=mmap_shape, dtype=np.float32)
-
-            # Map: Correct scan and save in memmap scan
-            f = performance.parallel_save_memmap # function to map
-            raster_phase = (RasterCorrection() & key).fetch1('raster_phase')
-            fill_fraction = (ScanInfo() & key).fetch1('fill_fraction')
-            y_shifts, x_shifts = (MotionCorrection() & key).fetch1('y_shifts', 'x_shifts')
-            kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction, 'y_shifts': y_shifts,
-                      'x_shifts': x_shifts, 'mmap_scan': mmap_scan}
-            results = performance.map_frames(f, scan, field_id=field_id, channel=channel, kwargs=kwargs)
-
-            # Reduce: Use the minimum values to make memory mapped scan nonnegative
-            mmap_scan -= np.min(results)  # bit inefficient but necessary
-
             # Set CNMF parameters
             ## Set general parameters
             kwargs = {}
@@ -903,15 +883,22 @@ class Segmentation(dj.Computed):
             kwargs['num_processes'] = 8  # Set to None for all cores available
             kwargs['num_pixels_per_process'] = 10000
 
-            # Extract traces
-            print('Extracting masks and traces (cnmf)...')
-            scan_ = mmap_scan.reshape((image_height, image_width, num_frames), order='F')
-            cnmf_result = cmn.extract_masks(scan_, mmap_scan, **kwargs)
-            (masks, traces, background_masks, background_traces, raw_traces) = cnmf_result
-
-            # Delete memory mapped scan
-            print('Deleting memory mapped scan...')
-            os.remove(mmap_scan.filename)
+            # Correct scan and save it in a memory mapped file (as expected by CaImAn)
+            print('Creating memory mapped file...')
+            raster_phase = (RasterCorrection() & key).fetch1('raster_phase')
+            fill_fraction = (ScanInfo() & key).fetch1('fill_fraction')
+            y_shifts, x_shifts = (MotionCorrection() & key).fetch1('y_shifts', 'x_shifts')
+            with performance.corrected_scan_memmap(
+                    scan, field_id, channel, raster_phase, fill_fraction, y_shifts,
+                    x_shifts, scratch_dir=config['path.scratch'],
+                    reuse=config['cnmf.reuse_memmaps'],
+                    max_reuse_gb=config['cnmf.max_memmaps_gb']) as mmap_scan:
+
+                # Extract traces
+                print('Extracting masks and traces (cnmf)...')
+                scan_ = mmap_scan.reshape((image_height, image_width, num_frames), order='F')
+                cnmf_result = cmn.extract_masks(scan_, mmap_scan, **kwargs)
+                (masks, traces, background_masks, background_traces, raw_traces) = cnmf_result
 
             # Insert CNMF results
             print('Inserting masks, background components and traces...')
@@ -1078,28 +1065,24 @@ class Segmentation(dj.Computed):
     @staticmethod
     def reshape_masks(mask_pixels, mask_weights, image_height, image_width):
         """ Reshape masks into an image_height x image_width x num_masks array."""
-        masks = np.zeros([image_height, image_width, len(mask_pixels)], dtype=np.float32)
-
-        # Reshape each mask
-        for i, (mp, mw) in enumerate(zip(mask_pixels, mask_weights)):
-            mask_as_vector = np.zeros(image_height * image_width)
-            mask_as_vector[np.squeeze(mp - 1).astype(int)] = np.squeeze(mw)
-            masks[:, :, i] = mask_as_vector.reshape(image_height, image_width, order='F')
-
-        return masks
+        masks = SparseMaskSet.from_pixels(mask_pixels, mask_weights, image_height,
+                                          image_width)
+        return masks.to_dense()
 
-    def get_all_masks(self):
-        """Returns an image_height x image_width x num_masks matrix with all masks."""
+    def get_sparse_masks(self):
+        """Returns a SparseMaskSet with all masks (ordered by mask_id)."""
         mask_rel = (Segmentation.Mask() & self)
 
         # Get masks
         image_height, image_width = (ScanInfo() & self).fetch1('px_height', 'px_width')
         mask_pixels, mask_weights = mask_rel.fetch('pixels', 'weights', order_by='mask_id')
 
-        # Reshape masks
-        masks = Segmentation.reshape_masks(mask_pixels, mask_weights, image_height, image_width)
+        return SparseMaskSet.from_pixels(mask_pixels, mask_weights, image_height,
+                                         image_width)
 
-        return masks
+    def get_all_masks(self):
+        """Returns an image_height x image_width x num_masks matrix with all masks."""
+        return self.get_sparse_masks().to_dense()
 
     def plot_masks(self, threshold=0.97, first_n=None):
         """ Draw contours of masks over the correlation image (if available).
@@ -1112,9 +1095,10 @@ class Segmentation(dj.Computed):
         :rtype: matplotlib.figure.Figure
         """
         # Get masks
-        masks = self.get_all_masks()
+        masks = self.get_sparse_masks()
         if first_n is not None:
-            masks = masks[:, :, :first_n]
+            masks = SparseMaskSet(masks.matrix[:first_n], masks.image_height,
+                                  masks.image_width)
 
         # Get correlation image if defined, black background otherwise.
         image_rel = SummaryImages.Correlation() & self
@@ -1130,13 +1114,12 @@ class Segmentation(dj.Computed):
         plt.imshow(background_image)
 
         # Draw contours
-        cumsum_mask = np.empty([image_height, image_width])
+        cumsum_masks = masks.cumulative_mass().matrix  # similar to caiman
         for i in range(num_masks):
-            mask = masks[:, :, i]
-
-            ## Compute cumulative mass (similar to caiman)
-            indices = np.unravel_index(np.flip(np.argsort(mask, axis=None), axis=0), mask.shape) # max to min value in mask
-            cumsum_mask[indices] = np.cumsum(mask[indices]**2) / np.sum(mask**2)
+            cumsum_mask = np.ones(image_height * image_width)
+            row = slice(cumsum_masks.indptr[i], cumsum_masks.indptr[i + 1])
+            cumsum_mask[cumsum_masks.indices[row]] = cumsum_masks.data[row]
+            cumsum_mask = cumsum_mask.reshape(image_height, image_width, order='F')
 
             ## Plot contour at desired threshold (with random color)
             random_color = (np.random.rand(), np.random.rand(), np.random.rand())
@@ -1251,7 +1234,7 @@ class MaskClassification(dj.Computed):
         # Get masks
         image_height, image_width = (ScanInfo() & key).fetch1('px_height', 'px_width')
         mask_ids, pixels, weights = (Segmentation.Mask() & key).fetch('mask_id', 'pixels', 'weights')
-        masks = Segmentation.reshape_masks(pixels, weights, image_height, image_width)
+        masks = SparseMaskSet.from_pixels(pixels, weights, image_height, image_width)
 
         # Classify masks
         if key['classification_method'] == 1:  # manual
@@ -1260,8 +1243,7 @@ class MaskClassification(dj.Computed):
                 raise PipelineException(msg)
 
             template = (SummaryImages.Correlation() & key).fetch1('correlation_image')
-            masks = masks.transpose([2, 0, 1])  # num_masks, image_height, image_width
-            mask_types = mask_classification.classify_manual(masks, template)
+            mask_types = mask_classification.classify_manual(masks.images(), template)
         elif key['classification_method'] == 2:  # cnn-caiman
             from .utils import caiman_interface as cmn
             soma_diameter = tuple(14 / (ScanInfo() & key).microns_per_pixel)
@@ -1304,7 +1286,7 @@ class MaskClassification(dj.Computed):
         :rtype: matplotlib.figure.Figure
         """
         # Get masks
-        masks = (Segmentation() & self).get_all_masks()
+        masks = (Segmentation() & self).get_sparse_masks()
         mask_types = (MaskClassification.Type() & self).fetch('type')
         colormap = {'soma': 'b', 'axon': 'k', 'dendrite': 'c', 'neuropil': 'y',
                     'artifact': 'r', 'unknown': 'w'}
@@ -1324,14 +1306,13 @@ class MaskClassification(dj.Computed):
         plt.imshow(background_image)
 
         # Draw contours
-        cumsum_mask = np.empty([image_height, image_width])
+        cumsum_masks = masks.cumulative_mass().matrix  # similar to caiman
         for i in range(num_masks):
-            mask = masks[:, :, i]
             color = colormap[mask_types[i]]
-
-            ## Compute cumulative mass (similar to caiman)
-            indices = np.unravel_index(np.flip(np.argsort(mask, axis=None), axis=0), mask.shape) # max to min value in mask
-            cumsum_mask[indices] = np.cumsum(mask[indices]**2) / np.sum(mask**2)
+            cumsum_mask = np.ones(image_height * image_width)
+            row = slice(cumsum_masks.indptr[i], cumsum_masks.indptr[i + 1])
+            cumsum_mask[cumsum_masks.indices[row]] = cumsum_masks.data[row]
+            cumsum_mask = cumsum_mask.reshape(image_height, image_width, order='F')
 
             ## Plot contour at desired threshold
             plt.contour(cumsum_mask, [threshold], linewidths=0.8, colors=[color])
@@ -1378,24 +1359,21 @@ class ScanSet(dj.Computed):
         return {k: v for k, v in key.items() if k not in ['field', 'channel']}
 
     def make(self, key):
-        from pipeline.utils import caiman_interface as cmn
-
         # Get masks
         image_height, image_width = (ScanInfo() & key).fetch1('px_height', 'px_width')
         mask_ids, pixels, weights = (Segmentation.Mask() & key).fetch('mask_id', 'pixels', 'weights')
-        masks = Segmentation.reshape_masks(pixels, weights, image_height, image_width)
+        masks = SparseMaskSet.from_pixels(pixels, weights, image_height, image_width)
 
         # Compute units' coordinates
         px_center = [image_height / 2, image_width / 2]
         um_center = (ScanInfo() & key).fetch1('y', 'x')
         um_z = (ScanInfo.Field() & key).fetch1('z')
-        px_centroids = cmn.get_centroids(masks)
+        px_centroids = masks.centroids()
         um_centroids = um_center + (px_centroids - px_center) * (ScanInfo() & key).microns_per_pixel
 
         # Compute units' delays
         delay_image = (ScanInfo.Field() & key).fetch1('delay_image')
-        delays = (np.sum(masks * np.expand_dims(delay_image, -1), axis=(0, 1)) /
-                  np.sum(masks, axis=(0, 1)))
+        delays = masks.weighted_mean(delay_image)
         delays = np.round(delays * 1e3).astype(np.int16)  # in milliseconds
 
         # Get next unit_id for scan
@@ -1740,77 +1718,65 @@ class Func2StructMatching(dj.Computed):
 
     def make(self, key):
         from .utils import registration
-        from scipy import ndimage
+        from scipy import ndimage, sparse
 
-        # Get caiman masks and resize them
+        # Get caiman masks and resize them (one at a time so they stay sparse)
         field_dims = (ScanInfo & key).fetch1('um_height', 'um_width')
-        masks = np.moveaxis((Segmentation & key).get_all_masks(), -1, 0)
-        masks = np.stack([registration.resize(m, field_dims, desired_res=1) for m in
-                          masks])
+        resized_masks = []
+        for mask in (Segmentation & key).get_sparse_masks().images():
+            resized = registration.resize(mask, field_dims, desired_res=1)
+            resized_masks.append(sparse.csr_matrix(resized.ravel(order='F')))
+        masks = SparseMaskSet(sparse.vstack(resized_masks), *resized.shape)
         scansetunit_keys = (ScanSet.Unit & key).fetch('KEY', order_by='mask_id')
 
-        # Binarize masks
-        binary_masks = np.zeros(masks.shape, dtype=bool)
-        for i, mask in enumerate(masks):
-            ## Compute cumulative mass (similar to caiman)
-            indices = np.unravel_index(np.flip(np.argsort(mask, axis=None), axis=0),
-                                       mask.shape)  # max to min value in mask
-            cumsum_mask = np.cumsum(mask[indices] ** 2) / np.sum(mask ** 2)# + 1e-9)
-            binary_masks[i][indices] = cumsum_mask < 0.9
+        # Binarize masks (similar to caiman)
+        binary_masks = masks.binarize(0.9)
 
-        # Get structural segmentation and registration grid
+        # Get structural segmentation, stack units and registration grid
         stack_key = {**key, 'scan_session': key['session']}
         segmented_field = (stack.FieldSegmentation & stack_key).fetch1('segm_field')
         grid = (stack.Registration & stack_key).get_grid(type='affine', desired_res=1)
-        sunit_ids = (stack.FieldSegmentation.StackUnit & stack_key).fetch('sunit_id',
-                                                                          order_by='sunit_id')
-
-        # Create matrix with IOU values (rows for structural units, columns for functional units)
-        ious = []
-        for sunit_id in sunit_ids:
-            binary_sunit = segmented_field == sunit_id
-            intersection = np.logical_and(binary_masks, binary_sunit).sum(axis=(1, 2))  # num_masks
-            union = np.logical_or(binary_masks, binary_sunit).sum(axis=(1, 2))  # num_masks
-            ious.append(intersection / union)
-        iou_matrix = np.stack(ious)
+        sunits = (stack.FieldSegmentation.StackUnit & stack_key).fetch(
+            'sunit_id', 'sunit_z', 'sunit_y', 'sunit_x', 'mask_z', 'mask_y', 'mask_x',
+            order_by='sunit_id')
+        sunit_ids = sunits[0]
+        sunit_coords = np.stack(sunits[1:4], axis=-1)  # num_sunits x 3 (z, y, x)
+        mask_coords = np.stack(sunits[4:7], axis=-1)  # num_sunits x 3 (z, y, x)
+
+        # Compute IOUs (rows for structural units, columns for functional units)
+        iou_matrix = binary_masks.label_ious(segmented_field, sunit_ids).tocoo()
+        sunit_idx, func_idx, ious = iou_matrix.row, iou_matrix.col, iou_matrix.data
 
         # Save all possible matches / iou_matrix > 0
         self.insert1({**key, 'key_hash': key_hash(key)})
-        for mask_idx, func_idx in zip(*np.nonzero(iou_matrix)):
-            self.AllMatches.insert1({'key_hash': key_hash(key),
-                                     'unit_id': scansetunit_keys[func_idx]['unit_id'],
-                                     'sunit_id': sunit_ids[mask_idx],
-                                     'iou': iou_matrix[mask_idx, func_idx]})
-
-        # Iterate over matches (from best to worst), insert
-        while iou_matrix.max() > 0:
-            # Get next best
-            best_mask, best_func = np.unravel_index(np.argmax(iou_matrix),
-                                                    iou_matrix.shape)
-            best_iou = iou_matrix[best_mask, best_func]
-
-            # Get stack unit coordinates
-            coords = (stack.FieldSegmentation.StackUnit & stack_key &
-                      {'sunit_id': sunit_ids[best_mask]}).fetch1('sunit_z', 'sunit_y',
-                                                                 'sunit_x', 'mask_z',
-                                                                 'mask_y', 'mask_x')
-            sunit_z, sunit_y, sunit_x, mask_z, mask_y, mask_x = coords
-
-            # Compute distance to 2-d and 3-d mask
-            px_y, px_x = ndimage.measurements.center_of_mass(binary_masks[best_func])
-            px_coords = np.array([[px_y], [px_x]])
-            func_x, func_y, func_z = [ndimage.map_coordinates(grid[..., i], px_coords,
-                                                              order=1)[0] for i in
-                                      range(3)]
-            distance2d = np.sqrt((func_z - mask_z) ** 2 + (func_y - mask_y) ** 2 +
-                                 (func_x - mask_x) ** 2)
-            distance3d = np.sqrt((func_z - sunit_z) ** 2 + (func_y - sunit_y) ** 2 +
-                                 (func_x - sunit_x) ** 2)
-
-            self.Match.insert1({**key, **scansetunit_keys[best_func],
-                                'sunit_id': sunit_ids[best_mask], 'iou': best_iou,
-                                'distance2d': distance2d, 'distance3d': distance3d})
-
-            # Deactivate match
-            iou_matrix[best_mask, :] = 0
-            iou_matrix[:, best_func] = 0
\ No newline at end of file
+        self.AllMatches.insert([{'key_hash': key_hash(key),
+                                 'unit_id': scansetunit_keys[f_idx]['unit_id'],
+                                 'sunit_id': sunit_ids[s_idx], 'iou': iou} for s_idx,
+                                f_idx, iou in zip(sunit_idx, func_idx, ious)])
+
+        # Select matches greedily (from best to worst); ties broken as in np.argmax
+        order = np.lexsort((func_idx, sunit_idx, -ious))
+        used_sunits, used_funcs, matches = set(), set(), []
+        for s_idx, f_idx, iou in zip(sunit_idx[order], func_idx[order], ious[order]):
+            if s_idx not in used_sunits and f_idx not in used_funcs:
+                used_sunits.add(s_idx)
+                used_funcs.add(f_idx)
+                matches.append((s_idx, f_idx, iou))
+        if not matches:
+            return
+        best_sunits, best_funcs, best_ious = [np.array(x) for x in zip(*matches)]
+
+        # Compute distance to 2-d and 3-d mask
+        px_coords = binary_masks.centroids()[best_funcs].T  # 2 x num_matches
+        func_coords = np.stack([ndimage.map_coordinates(grid[..., i], px_coords, order=1)
+                                for i in [2, 1, 0]], axis=-1)  # num_matches x 3 (z, y, x)
+        distances2d = np.sqrt(np.sum((func_coords - mask_coords[best_sunits]) ** 2,
+                                     axis=-1))
+        distances3d = np.sqrt(np.sum((func_coords - sunit_coords[best_sunits]) ** 2,
+                                     axis=-1))
+
+        self.Match.insert([{**key, **scansetunit_keys[f_idx], 'sunit_id': sunit_ids[s_idx],
+                            'iou': iou, 'distance2d': d2, 'distance3d': d3} for
+                           s_idx, f_idx, iou, d2, d3 in zip(best_sunits, best_funcs,
+                                                             best_ious, distances2d,
+                                                             distances3d)])
\ No newline at end of file
@@ -13,7 +13,18 @@ validators = collections.defaultdict(lambda: lambda value: True)
 
 default = OrderedDict({
     'path.mounts': '/mnt/',
-    'display.tracking': False
+    'path.scratch': '/tmp',  # where to write big temporary files (e.g., memmapped scans)
+    'display.tracking': False,
+    'cnmf.reuse_memmaps': False,  # keep corrected scans in path.scratch for CNMF reruns
+    'cnmf.max_memmaps_gb': 40,  # evict least recently used kept scans above this size
+    'path.stack_chunks': '/mnt/dj-stor01/pipeline-externals/stack-chunks',  # lazy stacks
+    'stack.max_gb': 8,  # memory cap (GB) when preprocessing stacks
+    'tracking.num_processes': 8,  # processes used to track eye videos
+    'dlc.streaming': False,  # feed decoded frames to deeplabcut (no cropped video on disk)
+    'dlc.batch_size': 8,  # frames per deeplabcut forward pass when streaming
+    'insert.chunk_size': 5000,  # rows per insert statement of per-frame tables
+    'path.clip_cache': '/tmp/clip-cache',  # decoded movie clips
+    'clip_cache.max_gb': 10  # size limit of path.clip_cache (least recently used are deleted)
 })
 
 
@@ -9,10 +9,10 @@ from scipy import ndimage
 from scipy import optimize
 import itertools
 
-from . import experiment, notify, shared, reso, meso
+from . import experiment, notify, shared, reso, meso, config
 anatomy = dj.create_virtual_module('pipeline_anatomy','pipeline_anatomy')
 
-from .utils import galvo_corrections, stitching, performance, enhancement
+from .utils import galvo_corrections, stitching, performance, enhancement, surface
 from .utils.signal import mirrconv, float2uint8
 from .exceptions import PipelineException
 
@@ -579,43 +579,30 @@ class Stitching(dj.Computed):
             """ Enhance 2p image. See enhancement.py for details."""
             return enhancement.sharpen_2pimage(enhancement.lcn(image, sigmas))
 
-        def join_rows(rois_):
-            """ Iteratively join all rois that overlap in the same row."""
-            sorted_rois = sorted(rois_, key=lambda roi: (roi.x, roi.y))
-
-            prev_num_rois = float('inf')
-            while len(sorted_rois) < prev_num_rois:
-                prev_num_rois = len(sorted_rois)
-
-                for left, right in itertools.combinations(sorted_rois, 2):
-                    if left.is_aside_to(right):
-                        roi_key = {**key, 'roi_id': left.roi_coordinates[0].id}
-                        um_per_px = (StackInfo.ROI() & roi_key).microns_per_pixel
-
-                        # Compute stitching shifts
-                        neighborhood_size = 25 / um_per_px[1:]
-                        left_ys, left_xs = [], []
-                        for l, r in zip(left.slices, right.slices):
-                            left_slice = enhance(l.slice, neighborhood_size)
-                            right_slice = enhance(r.slice, neighborhood_size)
-                            delta_y, delta_x = stitching.linear_stitch(left_slice,
-                                                                       right_slice,
-                                                                       r.x - l.x)
-                            left_ys.append(r.y - delta_y)
-                            left_xs.append(r.x - delta_x)
-
-                        # Fix outliers
-                        max_y_shift, max_x_shift = 10 / um_per_px[1:]
-                        left_ys, left_xs, _ = galvo_corrections.fix_outliers(
-                            np.array(left_ys), np.array(left_xs), max_y_shift,
-                            max_x_shift, method='linear')
-
-                        # Stitch together
-                        right.join_with(left, left_xs, left_ys)
-                        sorted_rois.remove(left)
-                        break  # restart joining
-
-            return sorted_rois
+        def join(left, right):
+            """ Compute stitching shifts and join left into right."""
+            roi_key = {**key, 'roi_id': left.roi_coordinates[0].id}
+            um_per_px = (StackInfo.ROI() & roi_key).microns_per_pixel
+
+            # Compute stitching shifts
+            neighborhood_size = 25 / um_per_px[1:]
+            left_ys, left_xs = [], []
+            for l, r in zip(left.slices, right.slices):
+                left_slice = enhance(l.slice, neighborhood_size)
+                right_slice = enhance(r.slice, neighborhood_size)
+                delta_y, delta_x = stitching.linear_stitch(left_slice, right_slice,
+                                                           r.x - l.x)
+                left_ys.append(r.y - delta_y)
+                left_xs.append(r.x - delta_x)
+
+            # Fix outliers
+            max_y_shift, max_x_shift = 10 / um_per_px[1:]
+            left_ys, left_xs, _ = galvo_corrections.fix_outliers(
+                np.array(left_ys), np.array(left_xs), max_y_shift, max_x_shift,
+                method='linear')
+
+            # Stitch together
+            right.join_with(left, left_xs, left_ys)
 
         # Stitch overlapping rois recursively
         print('Computing stitching parameters...')
@@ -624,11 +611,11 @@ class Stitching(dj.Computed):
             prev_num_rois = len(rois)
 
             # Join rows
-            rois = join_rows(rois)
+            rois = stitching.join_rows(rois, join)
 
             # Join columns
             [roi.rot90() for roi in rois]
-            rois = join_rows(rois)
+            rois = stitching.join_rows(rois, join)
             [roi.rot270() for roi in rois]
 
         # Compute slice-to slice alignment
@@ -677,14 +664,7 @@ class Stitching(dj.Computed):
                 x_detrend = x_cumsum - x_cumsum.mean()
 
             # Apply alignment shifts in roi
-            for slice_, y_align, x_align in zip(roi.slices, y_detrend, x_detrend):
-                slice_.y -= y_align
-                slice_.x -= x_align
-            for roi_coord in roi.roi_coordinates:
-                roi_coord.ys = [prev_y - y_align for prev_y, y_align in zip(roi_coord.ys,
-                                                                            y_detrend)]
-                roi_coord.xs = [prev_x - x_align for prev_x, x_align in zip(roi_coord.xs,
-                                                                            x_detrend)]
+            roi.shift_slices(y_detrend, x_detrend)
 
         # Insert in Stitching
         print('Inserting...')
@@ -798,23 +778,11 @@ class CorrectedStack(dj.Computed):
                 rois.append(stitching.StitchedROI(corrected_roi, x=xs, y=ys, z=px_z,
                                                   id_=roi_tuple['roi_id']))
 
-            def join_rows(rois_):
-                """ Iteratively join all rois that overlap in the same row."""
-                sorted_rois = sorted(rois_, key=lambda roi: (roi.x, roi.y))
-
-                prev_num_rois = float('inf')
-                while len(sorted_rois) < prev_num_rois:
-                    prev_num_rois = len(sorted_rois)
-
-                    for left, right in itertools.combinations(sorted_rois, 2):
-                        if left.is_aside_to(right):
-                            left_xs = [s.x for s in left.slices]
-                            left_ys = [s.y for s in left.slices]
-                            right.join_with(left, left_xs, left_ys)
-                            sorted_rois.remove(left)
-                            break  # restart joining
-
-                return sorted_rois
+            def join(left, right):
+                """ Join left into right at their stored stitching coordinates."""
+                left_xs = [s.x for s in left.slices]
+                left_ys = [s.y for s in left.slices]
+                right.join_with(left, left_xs, left_ys)
 
             # Stitch all rois together. This is convoluted because smooth blending in
             # join_with assumes rois are next to (not below or atop of) each other
@@ -823,11 +791,11 @@ class CorrectedStack(dj.Computed):
                 prev_num_rois = len(rois)
 
                 # Join rows
-                rois = join_rows(rois)
+                rois = stitching.join_rows(rois, join)
 
                 # Join columns
                 [roi.rot90() for roi in rois]
-                rois = join_rows(rois)
+                rois = stitching.join_rows(rois, join)
                 [roi.rot270() for roi in rois]
 
             # Check stitching went alright
@@ -863,7 +831,7 @@ class CorrectedStack(dj.Computed):
     def notify(self, key):
         import imageio
 
-        volume = (self & key).get_stack(channel=key['channel'])
+        volume = (self & key).get_lazy_stack(channel=key['channel'])
         volume = volume[:: int(volume.shape[0] / 8)]  # volume at 8 diff depths
         video_filename = '/tmp/' + key_hash(key) + '.gif'
         imageio.mimsave(video_filename, float2uint8(volume), duration=1)
@@ -893,6 +861,21 @@ class CorrectedStack(dj.Computed):
         slices = slice_rel.fetch('slice', order_by='islice')
         return np.stack(slices)
 
+    def get_lazy_stack(self, channel=1):
+        """ Get stack as a LazyVolume that fetches slices only when they are indexed, e.g.,
+        stack[z0:z1] only fetches slices z0 to z1.
+
+        :param int channel: What channel to use. Starts at 1
+
+        :returns: The stack (num_slices, image_height, image_width) as a LazyVolume.
+        """
+        from .utils.volume import LazyVolume
+
+        slice_rel = (CorrectedStack.Slice() & self & {'channel': channel})
+        shape = self.fetch1('px_depth', 'px_height', 'px_width')
+        load_slice = lambda i: (slice_rel & {'islice': i + 1}).fetch1('slice')[np.newaxis]
+        return LazyVolume(shape, np.float32, chunk_depth=1, load_chunk=load_slice)
+
     def save_as_tiff(self, filename='stack.tif'):
         """ Save current stack as a tiff file."""
         from tifffile import imsave
@@ -959,24 +942,92 @@ class PreprocessedStack(dj.Computed):
         return (CorrectedStack * shared.Channel).proj() & CorrectedStack.Slice.proj()
 
     def make(self, key):
-        from .utils import registration
-        from .utils import enhancement
+        import os
+        from .utils import slabs
 
-        # Load stack
-        stack = (CorrectedStack() & key).get_stack(key['channel'])
+        # Load stack (slices are fetched as needed)
+        stack = (CorrectedStack() & key).get_lazy_stack(key['channel'])
 
-        # Resize to be 1 um^3
+        # Resize to be 1 um^3, enhance and sharpen (in z-slabs to bound memory usage)
         um_sizes = (CorrectedStack & key).fetch1('um_depth', 'um_height', 'um_width')
-        resized = registration.resize(stack, um_sizes, desired_res=1)
+        attributes = ['resized', 'lcned', 'sharpened']
+        filenames = [os.path.join(config['path.scratch'], '{}-{}.npy'.format(
+            key_hash(key), attribute)) for attribute in attributes]
+        try:
+            resized, lcned, sharpened = slabs.preprocess_stack(stack, um_sizes, filenames,
+                max_gb=config['stack.max_gb'], lcn_sigmas=(3, 25, 25), laplace_sigma=1)
+
+            # Insert
+            self.insert1({**key, 'resized': resized, 'lcned': lcned,
+                          'sharpened': sharpened})
+
+            # Save chunked copies for lazy access
+            for attribute, volume in zip(attributes, [resized, lcned, sharpened]):
+                self._save_chunked(key, attribute, volume)
+            del resized, lcned, sharpened, volume
+        finally:
+            # Delete temporary files (even after errors)
+            for filename in filenames:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+    @staticmethod
+    def _chunked_filename(key, attribute):
+        """ Filename of the chunked copy of a stored stack.
+
+        Named after the key and the hash of the stored blob, so copies of stacks that were
+        deleted and repopulated are never used. The hash is fetched as an SQL expression
+        so the blob itself is not downloaded.
+        """
+        import os
+        import hashlib
+
+        blob_hash = (PreprocessedStack & key).proj(
+            blob_hash='CONCAT({})'.format(attribute)).fetch1('blob_hash')
+        stamp = hashlib.md5(str(blob_hash).encode()).hexdigest()
+        return os.path.join(config['path.stack_chunks'], '{}-{}-{}.chunked'.format(
+            key_hash(key), attribute, stamp))
+
+    @staticmethod
+    def _save_chunked(key, attribute, volume):
+        import os
+        import glob
+        from .utils import volume as volume_utils
+
+        os.makedirs(config['path.stack_chunks'], exist_ok=True)
+        filename = PreprocessedStack._chunked_filename(key, attribute)
+        volume_utils.save_chunked(filename, volume)
+
+        # Delete copies of previous versions of this stack
+        for old_filename in glob.glob(os.path.join(config['path.stack_chunks'],
+                '{}-{}-*.chunked'.format(key_hash(key), attribute))):
+            if old_filename != filename:
+                os.remove(old_filename)
+
+    def get_lazy(self, attribute='resized'):
+        """ Get one of the stacks as a LazyVolume that reads only the chunks needed for each
+        crop, e.g., stack[z0:z1, y0:y1, x0:x1].
+
+        Chunked copies are saved in config['path.stack_chunks'] (shared by all workers)
+        when the stack is populated. Stacks populated before that are fetched once to
+        create their copy.
+
+        :param string attribute: Which stack to get: 'resized', 'lcned' or 'sharpened'.
+
+        :returns: The stack (depth, height, width) as a LazyVolume.
+        """
+        import os
+        from .utils.volume import LazyVolume
 
-        # Enhance
-        lcned = enhancement.lcn(resized, (3, 25, 25))
+        if attribute not in ['resized', 'lcned', 'sharpened']:
+            raise PipelineException('Unrecognized stack {}'.format(attribute))
 
-        # Sharpen
-        sharpened = enhancement.sharpen_2pimage(lcned, 1)
+        key = self.fetch1('KEY')
+        filename = PreprocessedStack._chunked_filename(key, attribute)
+        if not os.path.isfile(filename):
+            PreprocessedStack._save_chunked(key, attribute, (self & key).fetch1(attribute))
 
-        # Insert
-        self.insert1({**key, 'resized': resized, 'lcned': lcned, 'sharpened': sharpened})
+        return LazyVolume.from_file(filename)
 
 
 @schema
@@ -1014,48 +1065,21 @@ class Surface(dj.Computed):
         upper_threshold_percent = 0.6  # Surface median intensity should be in the bottom X% of the *range* of medians
         gaussian_blur_size = 5  # Size of gaussian blur applied to slice
         min_points_allowed = 10  # If there are less than X points after filtering, throw an error
-        bounds = ([0, 0, np.NINF, np.NINF, np.NINF], [np.Inf, np.Inf, np.Inf, np.Inf, np.Inf])  # Bounds for paraboloid fit
+        bounds = ([0, 0, -np.inf, -np.inf, -np.inf], [np.inf, np.inf, np.inf, np.inf, np.inf])  # Bounds for paraboloid fit
         ss_percent = 0.40  # Percentage of points to subsample for robustness check
         num_iterations = 1000  # Number of iterations to use for robustness check
 
-        # DEFINITIONS
-        def surface_eqn(data, a, b, c, d, f):
-            x, y = data
-            return a * x ** 2 + b * y ** 2 + c * x + d * y + f
-
         # MAIN BODY
         if int(key['surface_method_id']) not in valid_method_ids:
             raise PipelineException(f'Error: surface_method_id {key["surface_method_id"]} is not implemented')
 
         print('Calculating surface of brain for stack', key)
-        full_stack = (PreprocessedStack & key).fetch1('resized')
+        full_stack = (PreprocessedStack & key).get_lazy('resized')  # loads top half
         depth, height, width = full_stack.shape
 
-        surface_guess_map = []
-        r_xs = np.arange(r, width - width % r, r * 2)[1:-1]
-        r_ys = np.arange(r, height - height % r, r * 2)[1:-1]
-        full_mesh_x, full_mesh_y = np.meshgrid(np.arange(width), np.arange(height))
-
-        # Surface z should be below this value
-        z_lim = int(depth / 2)
-        # Mean intensity of the first frame in the slice should be less than this value
-        z_0_upper_threshold = np.percentile(full_stack, 30)
-
-        for x in r_xs:
-            for y in r_ys:
-                stack_slice_medians = np.percentile(full_stack[0:z_lim, y - r:y + r, x - r:x + r], 50, axis=(1, 2))
-                blurred_slice = ndimage.gaussian_filter1d(stack_slice_medians, gaussian_blur_size)
-
-                upper_threshold_value = upper_threshold_percent * (
-                        (blurred_slice.max() - blurred_slice.min()) - blurred_slice.min())
-                upper_threshold_idx = np.where(blurred_slice > upper_threshold_value)[0][0]
-
-                stack_slice_derivative = ndimage.sobel(blurred_slice)
-                surface_z = np.argmax(stack_slice_derivative)
-
-                if ((surface_z < upper_threshold_idx) and (blurred_slice[0] < z_0_upper_threshold) and
-                        (blurred_slice[-1] > 10)):
-                    surface_guess_map.append((surface_z, y, x))
+        surface_guess_map = surface.guess_surface_points(full_stack, r, upper_threshold_percent,
+                                                         gaussian_blur_size)
+        del full_stack
 
         if len(surface_guess_map) < min_points_allowed:
             raise PipelineException(f"Surface calculation could not find enough valid points for {key}. Only "
@@ -1070,22 +1094,13 @@ class Surface(dj.Computed):
         # Guess for initial parameters
         initial = [1, 1, int(width / 2), int(height / 2), 1]
 
-        popt, pcov = optimize.curve_fit(surface_eqn, (surface_guess_map[:, 2], surface_guess_map[:, 1]),
-                                        surface_guess_map[:, 0], p0=initial, maxfev=10000, bounds=bounds)
-
-        calculated_surface_map = surface_eqn((full_mesh_x, full_mesh_y), *popt)
-
-        all_sub_fitted_z = np.zeros((num_iterations, height, width))
-        for i in np.arange(num_iterations):
-            indices = np.random.choice(surface_guess_map.shape[0], int(surface_guess_map.shape[0] * ss_percent),
-                                       replace=False)
-            subsample = surface_guess_map[indices]
-            sub_popt, sub_pcov = optimize.curve_fit(surface_eqn, (subsample[:, 2], subsample[:, 1]), subsample[:, 0],
-                                                    p0=initial, maxfev=10000, bounds=bounds)
-            all_sub_fitted_z[i, :, :] = surface_eqn((full_mesh_x, full_mesh_y), *sub_popt)
+        popt = surface.fit_surface(surface_guess_map, initial, bounds)
+        full_mesh_x, full_mesh_y = np.meshgrid(np.arange(width), np.arange(height))
+        calculated_surface_map = surface.surface_eqn((full_mesh_x, full_mesh_y), *popt)
 
-        z_min_matrix = np.percentile(all_sub_fitted_z, 5, axis=0)
-        z_max_matrix = np.percentile(all_sub_fitted_z, 95, axis=0)
+        z_min_matrix, z_max_matrix = surface.bootstrap_surface_bounds(
+            surface_guess_map, (height, width), initial, bounds, ss_percent=ss_percent,
+            num_iterations=num_iterations, percentiles=(5, 95))
 
         surface_key = {**key, 'guessed_points': surface_guess_map, 'surface_im': calculated_surface_map,
                        'lower_bound_im': z_min_matrix, 'upper_bound_im': z_max_matrix}
@@ -1132,7 +1147,7 @@ class Surface(dj.Computed):
 
         from matplotlib import cm
 
-        full_stack = (PreprocessedStack & self).fetch1('resized')
+        full_stack = (PreprocessedStack & self).get_lazy('resized')
         stack_depth, stack_height, stack_width = full_stack.shape
         surface_guess_map, fitted_surface = self.fetch1('guessed_points', 'surface_im')
         fig, axes = plt.subplots(1, 2, figsize=(fig_width, fig_height))
@@ -1779,7 +1794,7 @@ class FieldSegmentation(dj.Computed):
         """
 
     def _make_tuples(self, key):
-        from skimage import measure
+        from .utils import segmentation3d
 
         # Get structural segmentation
         stack_key = {'animal_id': key['animal_id'], 'session': key['stack_session'],
@@ -1797,37 +1812,10 @@ class FieldSegmentation(dj.Computed):
         # Insert in FieldSegmentation
         self.insert1({**key, 'segm_field': segmented_field})
 
-        # Insert each StackUnit
-        instance_props = measure.regionprops(instance)
-        instance_labels = np.array([p.label for p in instance_props])
-        for prop in measure.regionprops(segmented_field):
-            sunit_id = prop.label
-            instance_prop = instance_props[np.argmax(instance_labels == sunit_id)]
-
-            depth = (instance_prop.bbox[3] - instance_prop.bbox[0])
-            height = (instance_prop.bbox[4] - instance_prop.bbox[1])
-            width = (instance_prop.bbox[5] - instance_prop.bbox[2])
-            volume = instance_prop.area
-            sunit_z, sunit_y, sunit_x = (stack_center + np.array(instance_prop.centroid) -
-                                         np.array(instance.shape) / 2 + 0.5)
-
-            binary_sunit = segmented_field == sunit_id
-            area = np.count_nonzero(binary_sunit)
-            px_y, px_x = ndimage.measurements.center_of_mass(binary_sunit)
-            px_coords = np.array([[px_y], [px_x]])
-            mask_x, mask_y, mask_z = [ndimage.map_coordinates(grid[..., i], px_coords,
-                                                              order=1)[0] for i in
-                                      range(3)]
-            distance = np.sqrt((sunit_z - mask_z) ** 2 + (sunit_y - mask_y) ** 2 +
-                               (sunit_x - mask_x) ** 2)
-
-            # Insert in StackUnit
-            self.StackUnit.insert1({**key, 'sunit_id': sunit_id, 'depth': depth,
-                                    'height': height, 'width': width, 'volume': volume,
-                                    'area': area, 'sunit_z': sunit_z, 'sunit_y': sunit_y,
-                                    'sunit_x': sunit_x, 'mask_z': mask_z,
-                                    'mask_y': mask_y, 'mask_x': mask_x,
-                                    'distance': distance})
+        # Insert all StackUnits
+        units = segmentation3d.field_unit_properties(instance, segmented_field, grid,
+                                                     stack_center)
+        self.StackUnit.insert([{**key, **unit} for unit in units])
 
 
 @schema
@@ -2703,7 +2691,7 @@ class Area(dj.Computed):
         return key_source
 
     def make(self, key):
-        from scipy.interpolate import griddata
+        from .utils import registration
         import cv2
 
         #same as key source but retains brain area attribute
@@ -2746,16 +2734,12 @@ class Area(dj.Computed):
                 # convert transformation grid into stack pixel space
                 field2stack_px = [(grid - edge) * px_per_um for grid, edge, px_per_um
                                   in zip(field2stack_um, stack_edges, stack_px_dims / stack_um_dims)]
+                field2stack_px = np.stack(field2stack_px, axis=-1)
 
-
-                grid_locs = np.array([f2s.ravel() for f2s in field2stack_px]).T
-                grid_vals = field_mask.ravel()
-                grid_query = np.array([stack_grid.ravel() for stack_grid in stack_px_grid]).T
-
-                # griddata because scipy.interpolate.interp2d wasn't working for some reason
-                # linear because nearest neighbor doesn't handle nans at the edge of the image
-                stack_mask = griddata(grid_locs, grid_vals, grid_query, method='linear')
-                stack_mask = np.round(np.reshape(stack_mask, (px_h, px_w)))
+                # sample field mask at each stack pixel (inverting the affine)
+                stack_mask = registration.sample_affine_grid(field_mask, field2stack_px,
+                                                             *stack_px_grid, order=1)
+                stack_mask = np.round(stack_mask)
 
                 stack_masks.append(stack_mask)
 
@@ -2779,17 +2763,14 @@ class Area(dj.Computed):
         mod_masks[:, overlap_locs] = np.nan
         ref_mask = np.max([mm * (i + 1) for i, mm in enumerate(mod_masks)], axis=0)
 
-        # interpolate overlap pixels into reference mask
-        non_nan_idx = np.invert(np.isnan(ref_mask))
-        grid_locs = np.array([stack_grid[non_nan_idx].ravel() for stack_grid in stack_px_grid]).T
-        grid_vals = ref_mask[non_nan_idx].ravel()
-        grid_query = np.array([stack_grid[overlap_locs] for stack_grid in stack_px_grid]).T
-
-        mask_assignments = griddata(grid_locs, grid_vals, grid_query, method='nearest')
-
-        for loc, assignment in zip((np.array(grid_query) - 0.5).astype(int), mask_assignments):
-            mod_masks[:, loc[1], loc[0]] = 0
-            mod_masks[int(assignment - 1)][loc[1]][loc[0]] = 1
+        # assign overlap pixels to the nearest non-overlap pixel in reference mask
+        _, (nearest_ys, nearest_xs) = ndimage.distance_transform_edt(overlap_locs,
+                                                                     return_indices=True)
+        overlap_ys, overlap_xs = np.nonzero(overlap_locs)
+        mask_assignments = ref_mask[nearest_ys[overlap_locs],
+                                    nearest_xs[overlap_locs]].astype(int)
+        mod_masks[:, overlap_locs] = 0
+        mod_masks[mask_assignments - 1, overlap_ys, overlap_xs] = 1
 
         area_keys = [{**area_key,**key,'mask': mod_mask} for area_key, mod_mask in zip(area_keys, mod_masks)]
 
@@ -49,15 +49,14 @@ class Temperature(dj.Imported):
                                     'temperature data'.format(**key))
         temp_raw[np.isnan(ts)] = float('nan')
 
-        # Read temperature and smooth it
+        # Read temperature, smooth it and resample at 1 Hz (polyphase: only computes the
+        # smoothed samples that are kept)
         temp_celsius = (temp_raw * 100 - 32) / 1.8  # F to C
         sampling_rate = int(round(1 / np.nanmedian(np.diff(ts))))  # samples per second
-        smooth_temp = signal.low_pass_filter(temp_celsius, sampling_rate, cutoff_freq=1,
-                                             filter_size=2 * sampling_rate)
-
-        # Resample at 1 Hz
+        downsampled_temp = signal.low_pass_filter(temp_celsius, sampling_rate, cutoff_freq=1,
+                                                  filter_size=2 * sampling_rate,
+                                                  step=sampling_rate)
         downsampled_ts = ts[::sampling_rate]
-        downsampled_temp = smooth_temp[::sampling_rate]
 
         # Insert
         self.insert1({**key, 'temp_time': downsampled_ts,
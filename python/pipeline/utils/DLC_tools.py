@@ -86,18 +86,56 @@ def smallest_enclosing_circle_naive(points):
 
 
 def online_median_filter(x, kernel_size=3):
+    """
+    Median filter along the first axis (time). The first and last kernel_size//2 samples are
+    kept as they are.
+
+    Input:
+        x: numpy array
+            signal to filter, e.g., a trace (frames) or an array of labels (frames x bodyparts x 3)
+        kernel_size: int
+            size of the median window. Must be odd
+    Return:
+        online_medfilt: numpy array
+            filtered signal (float64) with the same shape as x
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
 
     assert kernel_size%2 == 1, "kernel size must be odd number!"
 
     interval = kernel_size//2
 
-    online_medfilt = x[0:interval].tolist()
-    for i in range(interval, len(x)-interval):
-        online_medfilt.append(np.median(x[i-interval:i+interval+1]))
-        
-    online_medfilt += x[-interval:].tolist()
+    online_medfilt = np.array(x, dtype=np.float64)
+    if len(online_medfilt) > 2 * interval:
+        windows = sliding_window_view(online_medfilt, kernel_size, axis=0)
+        online_medfilt[interval:len(online_medfilt)-interval] = np.median(windows, axis=-1)
+
+    return online_medfilt
+
+
+def labels_to_array(df_label, DLCscorer, bodyparts):
+    """
+    Convert the labels saved by deeplabcut into a dense array
+
+    Input:
+        df_label: pandas DataFrame
+            labels as saved by deeplabcut, columns are (scorer, bodyparts, coords)
+        DLCscorer: string
+            scorer name used for deeplabcut
+        bodyparts: list
+            names of the bodyparts to keep (in this order)
+    Return:
+        labels: numpy array
+            frames x bodyparts x 3 (x, y, likelihood) array of float32
+        bodypart_index: dictionary
+            index of each bodypart in labels
+    """
+    df_scorer = df_label[DLCscorer]
+    labels = np.stack([df_scorer[bodypart][['x', 'y', 'likelihood']].values
+                       for bodypart in bodyparts], axis=1).astype(np.float32)
+    bodypart_index = {bodypart: i for i, bodypart in enumerate(bodyparts)}
 
-    return np.array(online_medfilt)
+    return labels, bodypart_index
 
 
 class DeeplabcutPlotBodyparts():
@@ -147,22 +185,16 @@ class DeeplabcutPlotBodyparts():
 
         self.df_label = pd.read_hdf(self.label_path)
 
-        self.df_bodyparts = self.df_label[self._DLCscorer][self.bodyparts]
-
-        self.df_bodyparts_likelihood = self.df_bodyparts.iloc[:, self.df_bodyparts.columns.get_level_values(
-            1) == 'likelihood']
-
-        self.df_bodyparts_x = self.df_bodyparts.iloc[:,
-                                                     self.df_bodyparts.columns.get_level_values(1) == 'x']
-        self.df_bodyparts_y = self.df_bodyparts.iloc[:,
-                                                     self.df_bodyparts.columns.get_level_values(1) == 'y']
+        # frames x bodyparts x (x, y, likelihood)
+        self.labels, self.bodypart_index = labels_to_array(
+            self.df_label, self._DLCscorer, self.bodyparts)
 
         # in mm. https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3310398/#R13
         self._pupil_diameter = 3.0 
 
         # obtain median left to right eyelid distance
-        right = self.df_bodyparts['eyelid_right'].values[:, :2]
-        left = self.df_bodyparts['eyelid_left'].values[:, :2]
+        right = self.labels[:, self.bodypart_index['eyelid_right'], :2].astype(np.float64)
+        left = self.labels[:, self.bodypart_index['eyelid_left'], :2].astype(np.float64)
 
         self.median_left_right = np.median(
             np.sqrt(np.einsum('ij,ij->i', left-right, left-right)))
@@ -174,10 +206,10 @@ class DeeplabcutPlotBodyparts():
 
             self.nx = self.clip.width()
             self.ny = self.clip.height()
-            self.df_bodyparts_x = self.df_bodyparts.iloc[:,
-                                                         self.df_bodyparts.columns.get_level_values(1) == 'x'] + self.cropped_coords[0]
-            self.df_bodyparts_y = self.df_bodyparts.iloc[:,
-                                                         self.df_bodyparts.columns.get_level_values(1) == 'y'] + self.cropped_coords[2]
+
+            # labels are in the coordinates of the cropped video
+            self.labels[:, :, 0] += self.cropped_coords[0]
+            self.labels[:, :, 1] += self.cropped_coords[2]
 
         else:
 
@@ -189,11 +221,6 @@ class DeeplabcutPlotBodyparts():
                 raise ValueError(
                     "Only provided {} coordinates! U need 4!".format(len(self.cropped_coords)))
 
-            # self.df_bodyparts_x = self.df_bodyparts.iloc[:,
-            #                                             self.df_bodyparts.columns.get_level_values(1) == 'x'] - self.cropped_coords[0]
-            # self.df_bodyparts_y = self.df_bodyparts.iloc[:,
-            #                                             self.df_bodyparts.columns.get_level_values(1) == 'y'] - self.cropped_coords[2]
-
             self.nx = self.clip.width() - self.cropped_coords[0]
             self.ny = self.clip.height() - self.cropped_coords[2]
 
@@ -209,7 +236,7 @@ class DeeplabcutPlotBodyparts():
         self._dpi = 100
         self._fontsize = 30
 
-        self.tf_likelihood_array = self.df_bodyparts_likelihood.values > self._pcutoff
+        self.tf_likelihood_array = self.labels[:, :, 2] > self._pcutoff
 
     @property
     def dotsize(self):
@@ -238,7 +265,7 @@ class DeeplabcutPlotBodyparts():
     @pcutoff.setter
     def pcutoff(self, value):
         self._pcutoff = value
-        self.tf_likelihood_array = self.df_bodyparts_likelihood.values > self._pcutoff
+        self.tf_likelihood_array = self.labels[:, :, 2] > self._pcutoff
 
     @property
     def colormap(self):
@@ -307,21 +334,27 @@ class DeeplabcutPlotBodyparts():
             frame_num: int
                 A desired frame number
         Output:
-            bpindex: list
-                A list of integers that match with bodypart. For instance, if the bodypart is ['A','B','C']
+            bpindex: numpy array
+                An array of integers that match with bodypart. For instance, if the bodypart is ['A','B','C']
                 and only 'A' and 'C'qualifies the pcutoff, then bpindex = [0,2]
-            x_coords: pandas series
-                A pandas series that contains coordinates whose values meet pcutoff criteria
-            y_coords: pandas series
-                A pandas series that contains coordinates whose values meet pcutoff criteria
+            x_coords: numpy array
+                An array that contains coordinates whose values meet pcutoff criteria
+            y_coords: numpy array
+                An array that contains coordinates whose values meet pcutoff criteria
         """
-        frame_num_tf = self.tf_likelihood_array[frame_num, :]
-        bpindex = [i for i, x in enumerate(frame_num_tf) if x]
+        bpindex = np.flatnonzero(self.tf_likelihood_array[frame_num])
+        x_coords, y_coords = self.labels[frame_num, bpindex, :2].T.astype(np.float64)
 
-        df_x_coords = self.df_bodyparts_x.loc[frame_num, :][bpindex]
-        df_y_coords = self.df_bodyparts_y.loc[frame_num, :][bpindex]
+        return bpindex, x_coords, y_coords
 
-        return bpindex, df_x_coords, df_y_coords
+    def masked_coords(self):
+        """
+        x & y coordinates of all frames with NaNs where labels do not meet pcutoff criteria
+        Output:
+            coords: numpy array
+                frames x bodyparts x 2 array (float32)
+        """
+        return np.where(self.tf_likelihood_array[:, :, None], self.labels[:, :, :2], np.nan)
 
     def configure_plot(self):
         fig = plt.figure(frameon=False, figsize=self.fig_size, dpi=self.dpi)
@@ -358,8 +391,8 @@ class DeeplabcutPlotBodyparts():
         ax_frame = ax.imshow(image, cmap='gray')
 
         # plot bodyparts above the pcutoff
-        bpindex, df_x_coords, df_y_coords = self.coords_pcutoff(frame_num)
-        ax_scatter = ax.scatter(df_x_coords.values, df_y_coords.values, s=self.dotsize**2,
+        bpindex, x_coords, y_coords = self.coords_pcutoff(frame_num)
+        ax_scatter = ax.scatter(x_coords, y_coords, s=self.dotsize**2,
                                 color=self._label_colors(bpindex), alpha=self.alphavalue)
 
         return {'ax_frame': ax_frame, 'ax_scatter': ax_scatter}
@@ -472,6 +505,8 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
                                       'eyelid_left': 'eyelid_left_top',
                                       'eyelid_left_top': 'eyelid_top'}
 
+        self._is_pupil = np.array(['pupil' in bodypart for bodypart in self.bodyparts])
+
         self._circle_threshold_num = 3
         self._ellipse_threshold_num = 6
         self._circle_color = (0, 255, 0)
@@ -521,29 +556,6 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
     def ellipse_color(self, value):
         self._ellipse_color = value
 
-    def coords_pcutoff(self, frame_num):
-        """
-        Given a frame number, return bpindex, x & y coordinates that meet pcutoff criteria
-        Input:
-            frame_num: int
-                A desired frame number
-        Output:
-            bpindex: list
-                A list of integers that match with bodypart. For instance, if the bodypart is ['A','B','C']
-                and only 'A' and 'C'qualifies the pcutoff, then bpindex = [0,2]
-            x_coords: pandas series
-                A pandas series that contains coordinates whose values meet pcutoff criteria
-            y_coords: pandas series
-                A pandas series that contains coordinates whose values meet pcutoff criteria
-        """
-        frame_num_tf = self.tf_likelihood_array[frame_num, :]
-        bpindex = [i for i, x in enumerate(frame_num_tf) if x]
-
-        df_x_coords = self.df_bodyparts_x.loc[frame_num, :][bpindex]
-        df_y_coords = self.df_bodyparts_y.loc[frame_num, :][bpindex]
-
-        return bpindex, df_x_coords, df_y_coords
-
     def connect_eyelids(self, frame_num, frame):
         """
         connect eyelid labels with a straight line. If a label is missing, do not connect and skip to the next label.
@@ -562,9 +574,9 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
         """
         mask = np.zeros(frame.shape[:2], dtype=np.uint8)
 
-        _, df_x_coords, df_y_coords = self.coords_pcutoff(frame_num)
-        eyelid_labels = [label for label in list(
-            df_x_coords.index.get_level_values(0)) if 'eyelid' in label]
+        bpindex, x_coords, y_coords = self.coords_pcutoff(frame_num)
+        coords = {self.bodyparts[i]: (x, y) for i, x, y in zip(bpindex, x_coords, y_coords)}
+        eyelid_labels = [label for label in coords if 'eyelid' in label]
 
         for eyelid in eyelid_labels:
             next_bp = self.complete_eyelid_graph[eyelid]
@@ -572,10 +584,8 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
             if next_bp not in eyelid_labels:
                 continue
 
-            coord_0 = tuple(
-                map(int, map(round, [df_x_coords[eyelid].values[0], df_y_coords[eyelid].values[0]])))
-            coord_1 = tuple(
-                map(int, map(round, [df_x_coords[next_bp].values[0], df_y_coords[next_bp].values[0]])))
+            coord_0 = tuple(map(int, map(round, coords[eyelid])))
+            coord_1 = tuple(map(int, map(round, coords[next_bp])))
             # opencv has some issues with dealing with np objects. Cast it manually again
             frame = cv2.line(
                 np.array(frame), coord_0, coord_1, color=(255, 0, 0), thickness=self.line_thickness)
@@ -621,12 +631,12 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
 
         mask = np.zeros(frame.shape, dtype=np.uint8)
 
-        _, df_x_coords, df_y_coords = self.coords_pcutoff(frame_num)
+        bpindex, x_coords, y_coords = self.coords_pcutoff(frame_num)
 
-        pupil_labels = [label for label in list(
-            df_x_coords.index.get_level_values(0)) if 'pupil' in label]
+        is_pupil = self._is_pupil[bpindex]
+        pupil_x, pupil_y = x_coords[is_pupil], y_coords[is_pupil]
 
-        if len(pupil_labels) < self.circle_threshold_num:
+        if len(pupil_x) < self.circle_threshold_num:
             # print('Frame number: {} has only 2 or less pupil label. Skip fitting!'.format(
             #     frame_num))
             center = None
@@ -634,9 +644,6 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
             final_mask = mask[:, :, 0]
 
         else:
-            pupil_x = df_x_coords.loc[pupil_labels].values
-            pupil_y = df_y_coords.loc[pupil_labels].values
-
             pupil_coords = list(zip(pupil_x, pupil_y))
 
             x, y, radius = smallest_enclosing_circle_naive(pupil_coords)
@@ -661,7 +668,7 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
                 'center': center,
                 'radius': radius,
                 'mask': final_mask,
-                'pupil_labels_num': len(pupil_labels)}
+                'pupil_labels_num': len(pupil_x)}
 
     def fit_ellipse_to_pupil(self, frame_num, frame):
         """
@@ -693,12 +700,12 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
 
         mask = np.zeros(frame.shape, dtype=np.uint8)
 
-        _, df_x_coords, df_y_coords = self.coords_pcutoff(frame_num)
+        bpindex, x_coords, y_coords = self.coords_pcutoff(frame_num)
 
-        pupil_labels = [label for label in list(
-            df_x_coords.index.get_level_values(0)) if 'pupil' in label]
+        is_pupil = self._is_pupil[bpindex]
+        pupil_x, pupil_y = x_coords[is_pupil], y_coords[is_pupil]
 
-        if len(pupil_labels) < self.ellipse_threshold_num:
+        if len(pupil_x) < self.ellipse_threshold_num:
             # print('Frame number: {} has only 2 or less pupil label. Skip fitting!'.format(
             #     frame_num))
             center = None
@@ -708,13 +715,8 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
             final_mask = mask[:, :, 0]
 
         else:
-            pupil_x = df_x_coords.loc[pupil_labels].values.round().astype(
-                np.int32)
-            pupil_y = df_y_coords.loc[pupil_labels].values.round().astype(
-                np.int32)
-
-            pupil_coords = np.array(
-                list(zip(pupil_x, pupil_y))).reshape((-1, 1, 2))
+            pupil_coords = np.stack([pupil_x, pupil_y], axis=1).round().astype(
+                np.int32).reshape((-1, 1, 2))
 
             # https://docs.opencv.org/2.4/modules/imgproc/doc/structural_analysis_and_shape_descriptors.html#fitellipse
             # Python: cv.FitEllipse2(points) → Box2D
@@ -746,7 +748,7 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
                 'major_radius': major_radius,
                 'minor_radius': minor_radius,
                 'rotation_angle': rotation_angle,
-                'pupil_labels_num': len(pupil_labels)}
+                'pupil_labels_num': len(pupil_x)}
 
     def detect_visible_pupil_area(self, eyelid_connect_dict, fit_dict, fitting_method=None):
         """
@@ -860,6 +862,72 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
                 'circle_visible': circle_visible,
                 'ellipse_visible': ellipse_visible}
 
+    def fit_all_frames(self, num_frames=None, raster=False):
+        """
+        Fit a circle and an ellipse to the pupil labels of all frames at once and find the visible
+        portion of the pupil analytically (as the area of the fitted shape inside the eyelid polygon)
+        Input:
+            num_frames: int
+                number of frames to fit. If None, all labeled frames
+            raster: boolean
+                whether to use the frame by frame raster masks of fitted_core (slow, for verification)
+        Output:
+            A dictionary with keys 'circle' and 'ellipse'. Each one is a dictionary of arrays (one value per
+            frame, NaN if fitting did not occur) with keys center (frames x 2) and visible_portion plus
+            radius for the circle or major_radius, minor_radius and rotation_angle for the ellipse.
+            visible_portion follows the convention of detect_visible_pupil_area
+        """
+        from . import pupil_fitting
+
+        num_frames = len(self.labels) if num_frames is None else num_frames
+
+        if raster:
+            fits = [self.fitted_core(frame_num) for frame_num in range(num_frames)]
+
+            def stack(fit_key, key):
+                missing = np.full(2 if key == 'center' else (), np.nan)
+                return np.array([missing if fit[fit_key][key] is None else fit[fit_key][key]
+                                 for fit in fits], dtype=float)
+
+            circle = {k: stack('circle_fit', k) for k in ['center', 'radius']}
+            circle['visible_portion'] = stack('circle_visible', 'visible_portion')
+            ellipse = {k: stack('ellipse_fit', k) for k in ['center', 'major_radius', 'minor_radius',
+                                                              'rotation_angle']}
+            ellipse['visible_portion'] = stack('ellipse_visible', 'visible_portion')
+
+            return {'circle': circle, 'ellipse': ellipse}
+
+        coords = self.masked_coords()[:num_frames]
+        pupil = coords[:, self._is_pupil]
+        pupil_valid = ~np.isnan(pupil[..., 0])
+
+        # eyelid polygon in the order used by connect_eyelids
+        eyelid_order = ['eyelid_top']
+        while len(eyelid_order) < len(self.complete_eyelid_graph):
+            eyelid_order.append(self.complete_eyelid_graph[eyelid_order[-1]])
+        eyelids = coords[:, [self.bodypart_index[bodypart] for bodypart in eyelid_order]]
+        eyelids_ok = ~np.any(np.isnan(eyelids), axis=(1, 2))
+
+        def visible_portion(centers, axes, angles):
+            fitted = ~np.isnan(centers[:, 0])
+            portion = pupil_fitting.visible_portions(eyelids, centers, axes, angles)
+            return np.select([fitted & eyelids_ok, fitted, eyelids_ok], [portion, -1.0, -2.0], -3.0)
+
+        centers, radii = pupil_fitting.enclosing_circles(
+            pupil, pupil_valid, min_points=self.circle_threshold_num)
+        circle = {'center': centers, 'radius': radii,
+                  'visible_portion': visible_portion(centers, 2 * radii[:, None] * np.ones(2),
+                                                     np.zeros(num_frames))}
+
+        # cv2.fitEllipse receives labels rounded to pixels
+        centers, axes, angles = pupil_fitting.fit_ellipses(
+            np.round(pupil), pupil_valid, min_points=self.ellipse_threshold_num)
+        ellipse = {'center': centers, 'major_radius': axes[:, 1] / 2.0,
+                   'minor_radius': axes[:, 0] / 2.0, 'rotation_angle': angles,
+                   'visible_portion': visible_portion(centers, axes, angles)}
+
+        return {'circle': circle, 'ellipse': ellipse}
+
     def plot_fitted_frame(self, frame_num, ax=None, fitting_method='circle', save_fig=False):
 
         if ax is None:
@@ -867,7 +935,7 @@ class DeeplabcutPupilFitting(DeeplabcutPlotBodyparts):
 
         # plot bodyparts above the pcutoff
         bpindex, x_coords, y_coords = self.coords_pcutoff(frame_num)
-        ax_scatter = ax.scatter(x_coords.values, y_coords.values, s=self.dotsize**2,
+        ax_scatter = ax.scatter(x_coords, y_coords, s=self.dotsize**2,
                                 color=self._label_colors(bpindex), alpha=self.alphavalue)
 
         fitted_core_dict = self.fitted_core(frame_num)
@@ -1048,6 +1116,97 @@ def predict_labels(vid_path, config, gputouse=0):
                        trainingsetindex=config['trainingsetindex'], gputouse=gputouse, save_as_csv=False, destfolder=destfolder)
 
 
+def load_pose_predictor(config, batch_size, gputouse=0):
+    """
+    Load the trained deeplabcut network to predict labels on batches of frames
+    (as done by dlc.analyze_videos but without reading the video).
+
+    Input:
+        config: dictionary
+            a deeplabcut model configuration dictionary.
+        batch_size: int
+            number of frames the network receives at once
+        gputouse: int
+            index of the gpu to use. None to use the cpu
+    Return:
+        predict_batch: function
+            receives RGB frames (batch_size x height x width x 3, uint8) and returns their labels
+            (batch_size x 3 * num_bodyparts): x, y and likelihood per bodypart
+        bodyparts: list
+            names of the bodyparts in the order returned by predict_batch
+    """
+    from deeplabcut.pose_estimation_tensorflow.config import load_config
+    from deeplabcut.pose_estimation_tensorflow.nnet import predict
+
+    if gputouse is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gputouse)
+
+    trainFraction = config['TrainingFraction'][config['trainingsetindex']]
+    model_dir = os.path.join(config['project_path'], str(auxiliaryfunctions.GetModelFolder(
+        trainFraction, config['shuffle'], config)))
+    dlc_cfg = load_config(os.path.join(model_dir, 'test', 'pose_cfg.yaml'))
+
+    snapshots = sorted([fn.split('.')[0] for fn in os.listdir(os.path.join(model_dir, 'train'))
+                        if 'index' in fn], key=lambda fn: int(fn.split('-')[1]))
+    snapshotindex = -1 if config['snapshotindex'] == 'all' else config['snapshotindex']
+    dlc_cfg['init_weights'] = os.path.join(model_dir, 'train', snapshots[snapshotindex])
+    dlc_cfg['batch_size'] = batch_size
+
+    sess, inputs, outputs = predict.setup_pose_prediction(dlc_cfg)
+
+    def predict_batch(frames):
+        return predict.getposeNP(frames, dlc_cfg, sess, inputs, outputs)
+
+    return predict_batch, dlc_cfg['all_joints_names']
+
+
+def predict_labels_streaming(vid_path, h5_path, DLCscorer, predict_batch, bodyparts,
+                             batch_size, cropped_coords=None, start=0, stop=None):
+    """
+    Predict labels on (a cropped segment of) a video decoding it once and feeding the frames
+    to the network in batches. Labels are saved in the same h5 format as dlc.analyze_videos.
+
+    Input:
+        vid_path: string
+            Path to the original video.
+        h5_path: string
+            Path to the h5 file where labels are saved.
+        DLCscorer: string
+            scorer name used for deeplabcut (top level of the label columns).
+        predict_batch, bodyparts:
+            network as returned by load_pose_predictor
+        batch_size: int
+            number of frames the network receives at once
+        cropped_coords: dictionary
+            cropping coordinates (cropped_x0, cropped_x1, cropped_y0, cropped_y1). None to use
+            full frames
+        start, stop: int
+            range of frames to predict (0-based). stop=None predicts until the end of the video
+    Return:
+        h5_path: string
+            Path to the h5 file with the labels
+    """
+    from . import video
+
+    crop = None if cropped_coords is None else [cropped_coords[k] for k in (
+        'cropped_x0', 'cropped_x1', 'cropped_y0', 'cropped_y1')]
+
+    labels = []
+    for frames in video.read_batches(vid_path, batch_size, start, stop, crop, rgb=True):
+        num_frames = len(frames)
+        if num_frames < batch_size:  # the network expects full batches
+            padding = np.zeros((batch_size - num_frames, *frames.shape[1:]), dtype=np.uint8)
+            frames = np.concatenate([frames, padding])
+        labels.append(np.asarray(predict_batch(frames))[:num_frames])
+
+    columns = pd.MultiIndex.from_product([[DLCscorer], bodyparts, ['x', 'y', 'likelihood']],
+                                         names=['scorer', 'bodyparts', 'coords'])
+    df_label = pd.DataFrame(np.concatenate(labels), columns=columns)
+    df_label.to_hdf(h5_path, key='df_with_missing', format='table', mode='w')
+
+    return h5_path
+
+
 def obtain_cropping_coords(short_h5_path, DLCscorer, config):
     """
     First, filter out by the pcutoff, then find values that are within 1 std from mean
@@ -1246,54 +1405,24 @@ def filter_by_fitting_std(data, fitting_method, std_magnitude=5.5):
     if fitting_method.lower() == 'circle':
         # at minium we need center and radius info
         assert data.shape[1] >= 2
-
-        # filter out circles
-        center, radius = data[:, 0], data[:, 1].astype(np.float64)
-
-        # only obtain real numbers, not nans.
-        detectedFrames = ~np.isnan(radius)
-        xy = np.full((len(radius), 2), np.nan)
-        xy[detectedFrames, :] = np.vstack(center[detectedFrames])
-
-        x = xy[:, 0]
-        y = xy[:, 1]
-
-        rejected_radius_ind = np.greater(abs(
-            radius - np.nanmean(radius)), std_magnitude * np.nanstd(radius), where=~np.isnan(radius))
-        rejected_x_ind = np.greater(
-            abs(x - np.nanmean(x)), std_magnitude * np.nanstd(x), where=~np.isnan(x))
-        rejected_y_ind = np.greater(
-            abs(y - np.nanmean(y)), std_magnitude * np.nanstd(y), where=~np.isnan(y))
-
-        rejected_ind = np.logical_or(np.logical_or(
-            rejected_radius_ind, rejected_x_ind), rejected_y_ind)
+        sizes = data[:, 1:2].astype(np.float64)  # radius
 
     elif fitting_method.lower() == 'ellipse':
         # at minimum we need center, major_r, and minor_r info
         assert data.shape[1] >= 3
-
-        # filter out ellipses
-        center, major_r, minor_r = data[:, 0], data[:, 1].astype(
-            np.float64), data[:, 2].astype(np.float64)
-
-        detectedFrames = ~np.isnan(major_r)
-        xy = np.full((len(major_r), 2), np.nan)
-        xy[detectedFrames, :] = np.vstack(center[detectedFrames])
-
-        x = xy[:, 0]
-        y = xy[:, 1]
-
-        rejected_major_r_ind = np.greater(abs(
-            major_r - np.nanmean(major_r)), std_magnitude * np.nanstd(major_r), where=~np.isnan(major_r))
-        rejected_minor_r_ind = np.greater(abs(
-            minor_r - np.nanmean(minor_r)), std_magnitude * np.nanstd(minor_r), where=~np.isnan(minor_r))
-        rejected_x_ind = np.greater(
-            abs(x - np.nanmean(x)), std_magnitude * np.nanstd(x), where=~np.isnan(x))
-        rejected_y_ind = np.greater(
-            abs(y - np.nanmean(y)), std_magnitude * np.nanstd(y), where=~np.isnan(y))
-
-        rejected_ind = np.logical_or(np.logical_or(np.logical_or(
-            rejected_major_r_ind, rejected_minor_r_ind), rejected_x_ind), rejected_y_ind)
+        sizes = data[:, 1:3].astype(np.float64)  # major_r, minor_r
+
+    # only obtain real numbers, not nans.
+    detectedFrames = ~np.isnan(sizes[:, 0])
+    xy = np.full((len(data), 2), np.nan)
+    if detectedFrames.any():
+        xy[detectedFrames, :] = np.vstack(data[detectedFrames, 0])
+
+    # frames whose center or size is too far from the mean (nans are never rejected)
+    values = np.hstack([sizes, xy])
+    with np.errstate(invalid='ignore'):
+        rejected_ind = np.any(abs(values - np.nanmean(values, axis=0)) >
+                              std_magnitude * np.nanstd(values, axis=0), axis=1)
 
     return rejected_ind
 
@@ -2,7 +2,6 @@
 import numpy as np
 import multiprocessing as mp
 from caiman import components_evaluation
-from caiman.utils import visualization
 from caiman.source_extraction.cnmf import map_reduce, initialization, pre_processing, \
                                           merging, spatial, temporal, deconvolution
 import glob, os, sys, time
@@ -295,11 +294,13 @@ def _greedyROI(scan, num_components=200, neuron_size=(11, 11),
     masks = np.zeros([image_height, image_width, num_components], dtype=np.float32)
     traces = np.zeros([num_components, num_frames], dtype=np.float32)
     mean_frame = np.mean(residual_scan, axis=-1)
+    neuron_locations = ndimage.gaussian_filter(mean_frame, gaussian_stddev)
+    location_maxima = _TiledArgmax(neuron_locations)
+    filter_radius = [int(4 * stddev + 0.5) for stddev in gaussian_stddev] # as in ndimage
     for i in range(num_components):
 
         # Get center of next component
-        neuron_locations = ndimage.gaussian_filter(mean_frame, gaussian_stddev)
-        y, x = np.unravel_index(np.argmax(neuron_locations), [image_height, image_width])
+        y, x = location_maxima.argmax()
 
         # Compute initial trace (bit messy because of edges)
         half_kernel = np.fix(np.array(gaussian_kernel.shape) / 2).astype(np.int32)
@@ -324,6 +325,20 @@ def _greedyROI(scan, num_components=200, neuron_size=(11, 11),
         residual_scan[yslice, xslice] -= neuron_activity
         mean_frame[yslice, xslice] = np.mean(residual_scan[yslice, xslice], axis=-1)
 
+        # Refilter only the part of neuron_locations affected by the change in mean_frame
+        out_slices, in_slices, crop_slices = [], [], []
+        for window, radius, size in zip([yslice, xslice], filter_radius,
+                                        [image_height, image_width]):
+            out_start = max(window.start - radius, 0)
+            out_stop = min(window.stop + radius, size)
+            in_start = max(out_start - radius, 0)
+            out_slices.append(slice(out_start, out_stop))
+            in_slices.append(slice(in_start, min(out_stop + radius, size)))
+            crop_slices.append(slice(out_start - in_start, out_stop - in_start))
+        refiltered = ndimage.gaussian_filter(mean_frame[tuple(in_slices)], gaussian_stddev)
+        neuron_locations[tuple(out_slices)] = refiltered[tuple(crop_slices)]
+        location_maxima.update(*out_slices)
+
         # Store results
         masks[yslice, xslice, i] = mask
         traces[i] = trace
@@ -347,6 +362,42 @@ def _greedyROI(scan, num_components=200, neuron_size=(11, 11),
     return masks, traces, background_masks, background_traces
 
 
+class _TiledArgmax():
+    """ Keeps track of the argmax of an image that is modified in small regions.
+
+    The image is divided in square tiles and the maximum of each tile is stored; after
+    the image is modified, only the maxima of the affected tiles are recomputed.
+    Ties are resolved as in np.argmax (first position in C order).
+
+    :param np.array image: 2-d image. It is not copied; modify it in place and call update.
+    :param int tile_size: Size of the square tiles.
+    """
+    def __init__(self, image, tile_size=32):
+        self.image = image
+        self.tile_size = tile_size
+        num_tiles = [int(np.ceil(s / tile_size)) for s in image.shape]
+        self.tile_max = np.empty(num_tiles, dtype=image.dtype)
+        self.tile_argmax = np.empty(num_tiles, dtype=np.int64) # flat index in image
+        self.update(slice(0, image.shape[0]), slice(0, image.shape[1]))
+
+    def update(self, yslice, xslice):
+        """ Recompute maxima of the tiles that overlap image[yslice, xslice]."""
+        ts = self.tile_size
+        for ty in range(yslice.start // ts, (yslice.stop - 1) // ts + 1):
+            for tx in range(xslice.start // ts, (xslice.stop - 1) // ts + 1):
+                tile = self.image[ty * ts: (ty + 1) * ts, tx * ts: (tx + 1) * ts]
+                tile_y, tile_x = np.unravel_index(np.argmax(tile), tile.shape)
+                self.tile_max[ty, tx] = tile[tile_y, tile_x]
+                self.tile_argmax[ty, tx] = ((ty * ts + tile_y) * self.image.shape[1] +
+                                            tx * ts + tile_x)
+
+    def argmax(self):
+        """ (y, x) position of the maximum of the image."""
+        is_max = self.tile_max == self.tile_max.max()
+        flat_argmax = np.min(self.tile_argmax[is_max])
+        return np.unravel_index(flat_argmax, self.image.shape)
+
+
 def _gaussian2d(stddev, truncate=4):
     """ Creates a 2-d gaussian kernel truncated at 4 standard deviations (8 in total).
 
@@ -365,12 +416,12 @@ def _gaussian2d(stddev, truncate=4):
 
 # Based on caiman.source_extraction.cnmf.initialization.finetune()
 def _rank1_NMF(scan, trace, num_iterations=5):
-    num_frames = scan.shape[-1]
+    flat_scan = scan.reshape(-1, scan.shape[-1]) # num_pixels x num_frames
     for i in range(num_iterations):
-        mask = np.maximum(np.dot(scan, trace), 0)
-        mask  = mask * np.sum(mask) / np.sum(mask ** 2)
-        trace = np.average(scan.reshape(-1, num_frames), weights=mask.ravel(), axis=0)
-    return mask, trace
+        mask = np.maximum(flat_scan @ trace, 0)
+        mask = mask * np.sum(mask) / np.sum(mask ** 2)
+        trace = (mask @ flat_scan) / np.sum(mask) # weighted average of pixels
+    return mask.reshape(scan.shape[:-1]), trace
 
 
 def deconvolve(trace, AR_order=2):
@@ -391,40 +442,48 @@ def deconvolve(trace, AR_order=2):
     return spike_trace, AR_coeffs
 
 
-def get_centroids(masks):
-    """ Calculate the centroids of each mask (calls caiman's plot_contours).
+def get_centroids(masks, thr=None):
+    """ Calculate the centroids (weighted center of mass) of each mask.
+
+    Same centers of mass as caiman's plot_contours but computed directly from the
+    weights (no contours or matplotlib).
 
-    :param np.array masks: Masks (image_height x image_width x num_components)
+    :param masks: Masks (image_height x image_width x num_components) as a np.array or
+        SparseMaskSet.
+    :param float thr: If given, only the pixels that account for this fraction of the
+        energy (squared weights) of each mask are used, as in caiman's contours with
+        thr_method='nrg'. None uses all pixels (as caiman's CoM).
 
     :returns: Centroids (num_components x 2) in y, x pixels of each component.
     """
-    # Reshape masks
-    image_height, image_width, num_components = masks.shape
-    masks = masks.reshape(-1, num_components, order='F')
+    from .masks import SparseMaskSet
+    if not isinstance(masks, SparseMaskSet):
+        masks = SparseMaskSet.from_dense(masks)
 
-    # Get centroids
-    fake_background = np.empty([image_height, image_width]) # needed for plot contours
-    coordinates = visualization.plot_contours(masks, fake_background)
-    import matplotlib.pyplot as plt; plt.close()
-    centroids = np.array([coordinate['CoM'] for coordinate in coordinates])
+    # Drop low energy pixels
+    if thr is not None:
+        thresholded = masks.matrix.multiply(masks.binarize(thr).matrix)
+        masks = SparseMaskSet(thresholded, masks.image_height, masks.image_width)
 
-    return centroids
+    return masks.centroids()
 
 
 def classify_masks(masks, soma_diameter=(12, 12)):
     """ Uses a convolutional network to predict the probability per mask of being a soma.
 
-    :param np.array masks: Masks (image_height x image_width x num_components)
+    :param masks: Masks (image_height x image_width x num_components) as a np.array or
+        SparseMaskSet.
 
     :returns: Soma predictions (num_components).
     """
     # Reshape masks
+    from .masks import SparseMaskSet
     image_height, image_width, num_components = masks.shape
-    masks = masks.reshape(-1, num_components, order='F')
+    if not isinstance(masks, SparseMaskSet):
+        masks = SparseMaskSet.from_dense(masks)
+    masks = masks.matrix.T.tocoo()  # pixels in F order x num_components
 
     # Prepare input
-    from scipy.sparse import coo_matrix
-    masks = coo_matrix(masks)
     soma_radius = np.int32(np.round(np.array(soma_diameter)/2))
 
     model_path = '/data/pipeline/python/pipeline/data/cnn_model'
@@ -519,7 +578,7 @@ def demix_and_deconvolve_with_cnmf(scan, num_components=200, AR_order=2,
     from caiman.source_extraction.cnmf import cnmf
 
     # Save as memory mapped file in F order (that's how caiman wants it)
-    mmap_filename = _save_as_memmap(scan, base_name='/tmp/caiman', order='F').filename
+    mmap_filename = _save_as_memmap(scan, base_name='/tmp/caiman').filename
 
     # 'Load' scan
     mmap_scan, (image_height, image_width), num_frames = caiman.load_memmap(mmap_filename)
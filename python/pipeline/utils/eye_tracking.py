@@ -1,4 +1,3 @@
-from collections import defaultdict
 from itertools import count
 from operator import attrgetter
 from os import path as op
@@ -299,11 +298,14 @@ class PupilTracker:
     contrast_threshold           : float        # contrast below that threshold are considered dark
     speed_threshold              : float        # eye center can at most move that fraction of the roi between frames
     dr_threshold                 : float        # maximally allow relative change in radius
+    dilation_iter                : int          # dilations of the last ellipse that restrict the search (default: 7)
 
+    Set verbose to False to not print diagnostics for frames where the pupil is not found.
     """
 
-    def __init__(self, param, mask=None):
+    def __init__(self, param, mask=None, verbose=True):
         self._params = param
+        self._verbose = verbose
         self._center = None
         self._radius = None
         self._mask = mask
@@ -314,13 +316,12 @@ class PupilTracker:
     def goodness_of_fit(contour, ellipse):
         center, size, angle = ellipse
         angle *= np.pi / 180
-        err = 0
-        for coord in contour.squeeze().astype(np.float):
-            posx = (coord[0] - center[0]) * np.cos(-angle) - (coord[1] - center[1]) * np.sin(-angle)
-            posy = (coord[0] - center[0]) * np.sin(-angle) + (coord[1] - center[1]) * np.cos(-angle)
-            err += ((posx / size[0]) ** 2 + (posy / size[1]) ** 2 - 0.25) ** 2
+        coords = contour.reshape(-1, 2) - np.asarray(center)
+        posx = coords[:, 0] * np.cos(-angle) - coords[:, 1] * np.sin(-angle)
+        posy = coords[:, 0] * np.sin(-angle) + coords[:, 1] * np.cos(-angle)
+        err = ((posx / size[0]) ** 2 + (posy / size[1]) ** 2 - 0.25) ** 2
 
-        return np.sqrt(err / len(contour))
+        return np.sqrt(np.mean(err))
 
     @staticmethod
     def restrict_to_long_axis(contour, ellipse, corridor):
@@ -331,7 +332,21 @@ class PupilTracker:
         contour = contour[np.abs(contour[:, 0]) < corridor * ellipse[1][1] / 2]
         return (np.dot(contour, R) + center).astype(np.int32)
 
+    _conditions = ['ratio', 'area', 'rmse', 'x coord', 'y coord', 'dx', 'dr/r']
+
     def get_pupil_from_contours(self, contours, small_gray, mask, show_matching=5):
+        """ Fit ellipses to the contours and select the pupil.
+
+        Arguments:
+            contours (list): Contours (n, 1, 2) in the eye ROI.
+            small_gray (np.array): Eye ROI. Candidate ellipses are drawn on it.
+            mask (np.array): Eroded mask of the eye ROI. Contour points outside it are ignored.
+            show_matching (int): If the pupil is not found, print (and draw) candidates that
+                fulfill at least this many conditions.
+
+        Returns:
+            Contour and ellipse of the pupil (None, None if not found).
+        """
         ratio_thres = self._params['ratio_threshold']
         area_threshold = self._params['relative_area_threshold']
         error_threshold = self._params['error_threshold']
@@ -342,13 +357,15 @@ class PupilTracker:
         err = np.inf
         best_ellipse = None
         best_contour = None
-        kernel = np.ones((3, 3))
 
-        results, cond = defaultdict(list), defaultdict(list)
-        for j, cnt in enumerate(contours):
-
-            mask2 = cv2.erode(mask, kernel, iterations=1)
-            idx = mask2[cnt[..., 1], cnt[..., 0]] > 0
+        # diagnostics (one row per fitted contour)
+        results = np.full((len(contours), len(self._conditions)), np.nan)
+        cond = np.zeros((len(contours), len(self._conditions)), dtype=bool)
+        num_fits = 0
+        for cnt in contours:
+            if len(cnt) < min_contour:  # masking only removes points
+                continue
+            idx = mask[cnt[..., 1], cnt[..., 0]] > 0
             cnt = cnt[idx]
 
             if len(cnt) < min_contour:  # otherwise fitEllipse won't work
@@ -362,36 +379,20 @@ class PupilTracker:
             area = np.prod(ellipse[1]) / np.prod(small_gray.shape)
             curr_err = self.goodness_of_fit(cnt, ellipse)
 
-            results['ratio'].append(ratio)
-            results['area'].append(area)
-            results['rmse'].append(curr_err)
-            results['x coord'].append(x / small_gray.shape[1])
-            results['y coord'].append(y / small_gray.shape[0])
-
             center = np.array([x / small_gray.shape[1], y / small_gray.shape[0]])
             r = max(axes)
 
             dr = 0 if self._radius is None else np.abs(r - self._radius) / self._radius
             dx = 0 if self._center is None else np.sqrt(np.sum((center - self._center) ** 2))
 
-            results['dx'].append(dx)
-            results['dr/r'].append(dr)
-            matching_conditions = 1 * (ratio <= ratio_thres) + 1 * (area >= area_threshold) \
-                                  + 1 * (curr_err < error_threshold) \
-                                  + 1 * (margin < center[0] < 1 - margin) \
-                                  + 1 * (margin < center[1] < 1 - margin) \
-                                  + 1 * (dx < speed_thres * self._last_detection) \
-                                  + 1 * (dr < dr_thres * self._last_detection)
-            cond['ratio'].append(ratio <= ratio_thres)
-            cond['area'].append(area >= area_threshold)
-            cond['rmse'].append(curr_err < error_threshold)
-            cond['x coord'].append(margin < center[0] < 1 - margin)
-            cond['y coord'].append(margin < center[1] < 1 - margin)
-            cond['dx'].append(dx < speed_thres * self._last_detection)
-            cond['dr/r'].append(dr < dr_thres * self._last_detection)
-
-            results['conditions'] = matching_conditions
-            cond['conditions'].append(True)
+            results[num_fits] = ratio, area, curr_err, center[0], center[1], dx, dr
+            cond[num_fits] = (ratio <= ratio_thres, area >= area_threshold,
+                              curr_err < error_threshold, margin < center[0] < 1 - margin,
+                              margin < center[1] < 1 - margin,
+                              dx < speed_thres * self._last_detection,
+                              dr < dr_thres * self._last_detection)
+            matching_conditions = cond[num_fits].sum()
+            num_fits += 1
 
             if curr_err < err and matching_conditions == 7:
                 best_ellipse = ellipse
@@ -402,15 +403,13 @@ class PupilTracker:
                 cv2.ellipse(small_gray, ellipse, (255, 0, 0), 2)
 
         if best_ellipse is None:
-            df = pd.DataFrame(results)
-            df2 = pd.DataFrame(cond)
-
-            print('-', end="", flush=True)
-            if 'conditions' in df.columns and np.any(df['conditions'] >= show_matching):
-                idx = df['conditions'] >= show_matching
-                df = df[idx]
-                df2 = df2[idx]
-                df[df2] = np.nan
+            matching = cond[:num_fits].sum(axis=1) >= show_matching
+            if self._verbose:
+                print('-', end="", flush=True)
+            if self._verbose and np.any(matching):  # show values of the failed conditions
+                failed = np.where(cond[:num_fits][matching], np.nan, results[:num_fits][matching])
+                df = pd.DataFrame(failed, columns=self._conditions)
+                df['conditions'] = cond[:num_fits][matching].sum(axis=1)
                 print("\n", df, flush=True)
             self._last_detection += 1
         else:
@@ -422,8 +421,8 @@ class PupilTracker:
 
     def preprocess_image(self, frame, eye_roi):
         h = int(self._params['gaussian_blur'])
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        img_std = np.std(gray)
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        img_std = cv2.meanStdDev(gray)[1].item()
 
         small_gray = gray[slice(*eye_roi[0]), slice(*eye_roi[1])]
 
@@ -467,37 +466,95 @@ class PupilTracker:
             gray[epx - 3:epx + 3, epy - 3:epy + 3] = 0
         cv2.imshow('frame', gray)
 
-    def track(self, videofile, eye_roi, display=False):
-        contrast_low = self._params['contrast_threshold']
-        mask_kernel = np.ones((3, 3))
+    def get_state(self):
+        """ State carried over between frames (last ellipse, center, radius, ...)."""
+        return (self._last_ellipse, self._center, self._radius, self._last_detection,
+                self._running_avg)
+
+    def set_state(self, state):
+        (self._last_ellipse, self._center, self._radius, self._last_detection,
+         self._running_avg) = state
 
+    @staticmethod
+    def same_state(state1, state2):
+        return all(np.array_equal(s1, s2) if isinstance(s1, np.ndarray) or
+                   isinstance(s2, np.ndarray) else s1 == s2 for s1, s2 in zip(state1, state2))
+
+    def track(self, videofile, eye_roi, display=False):
         print("Tracking videofile", videofile)
-        cap = cv2.VideoCapture(videofile)
-        traces = []
+        traces = list(self.iter_track(videofile, eye_roi, display=display))
+        print("Reached end of videofile ", videofile)
+
+        return traces
+
+    def iter_track(self, videofile, eye_roi, start=0, stop=None, display=False):
+        """ Track the pupil in frames [start, stop) of the video, one frame at a time.
 
+        Tracking continues from the current state of the tracker (see get_state).
+
+        Arguments:
+            videofile (str): Path to the eye video.
+            eye_roi (np.array): ROI [[y_start, y_end], [x_start, x_end]] (0-based).
+            start, stop (int): Range of frames to track (0-based). stop=None tracks until
+                the end of the video.
+            display (bool): Whether to show the tracking in a window.
+
+        Yields:
+            Tracking results (dict) per frame. frame_id is 1-based.
+        """
+        cap = cv2.VideoCapture(videofile)
         n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        fr_count = 0
+        stop = n_frames if stop is None else min(stop, n_frames)
+        if start > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+        def read_frames():
+            for _ in range(start, stop):
+                if not cap.isOpened():
+                    break
+                ret, frame = cap.read()
+                yield frame if ret else None
+
+        yield from self.track_frames(read_frames(), eye_roi, start, n_frames, display)
+        cap.release()
+
+    def track_frames(self, frames, eye_roi, start=0, n_frames=None, display=False):
+        """ Track the pupil in a sequence of frames (e.g., from video.DecodeService).
+
+        Tracking continues from the current state of the tracker (see get_state).
+
+        Arguments:
+            frames (iterable): Frames (BGR or grayscale) or None for frames that could not
+                be read.
+            eye_roi (np.array): ROI [[y_start, y_end], [x_start, x_end]] (0-based).
+            start (int): Index of the first frame in the video (0-based).
+            n_frames (int): Number of frames in the video (for progress messages).
+            display (bool): Whether to show the tracking in a window.
+
+        Yields:
+            Tracking results (dict) per frame. frame_id is 1-based.
+        """
+        contrast_low = self._params['contrast_threshold']
+        dilation_iter = int(self._params.get('dilation_iter', 7))
+        mask_kernel = np.ones((3, 3))
+
+        fr_count = start
         if self._mask is not None:
             small_mask = self._mask[slice(*eye_roi[0]), slice(*eye_roi[1])].squeeze()
         else:
             small_mask = np.ones(np.diff(eye_roi, axis=1).squeeze().astype(int), dtype=np.uint8)
+        eroded_mask = cv2.erode(small_mask, mask_kernel, iterations=1)
 
-        while cap.isOpened():
-            if fr_count >= n_frames:
-                print("Reached end of videofile ", videofile)
-                break
-
-            # --- read frame
-            ret, frame = cap.read()
+        for frame in frames:
             fr_count += 1
 
             # --- if we don't get a frame, don't add any tracking results
-            if not ret:
-                traces.append(dict(frame_id=fr_count))
+            if frame is None:
+                yield dict(frame_id=fr_count)
                 continue
 
             # --- print out if there's not display
-            if fr_count % 500 == 0:
+            if fr_count % 500 == 0 and self._verbose:
                 print("\tframe ({}/{})".format(fr_count, n_frames))
 
             # --- preprocess and treshold images
@@ -505,11 +562,11 @@ class PupilTracker:
 
             # --- if contrast is too low, skip it
             if img_std < contrast_low:
-                traces.append(dict(frame_id=fr_count,
-                                   frame_intensity=img_std))
-                print('_', end="", flush=True)
+                if self._verbose:
+                    print('_', end="", flush=True)
                 if display:
                     self.display(gray, blur, thres, eye_roi, fr_count, n_frames)
+                yield dict(frame_id=fr_count, frame_intensity=img_std)
                 continue
 
             # --- detect contours
@@ -519,40 +576,172 @@ class PupilTracker:
                 mask = np.zeros(small_mask.shape, dtype=np.uint8)
                 cv2.ellipse(mask, tuple(self._last_ellipse), (255), thickness=cv2.FILLED)
                 # cv2.drawContours(mask, [self._last_contour], -1, (255), thickness=cv2.FILLED)
-                mask = cv2.dilate(mask, mask_kernel, iterations=self.dilation_iter.value)
+                mask = cv2.dilate(mask, mask_kernel, iterations=dilation_iter)
                 thres *= mask
             thres *= small_mask
 
-            _, contours, hierarchy1 = cv2.findContours(thres.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            contour, ellipse = self.get_pupil_from_contours(contours, blur, small_mask)
+            contours, hierarchy1 = cv2.findContours(thres, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            contour, ellipse = self.get_pupil_from_contours(contours, blur, eroded_mask)
 
             self._last_ellipse = ellipse
 
             if contour is None:
-                traces.append(dict(frame_id=fr_count, frame_intensity=img_std))
+                trace = dict(frame_id=fr_count, frame_intensity=img_std)
             else:
                 eye_center = eye_roi[::-1, 0] + np.asarray(ellipse[0])
                 self._center = np.asarray(ellipse[0]) / np.asarray(small_gray.shape[::-1])
                 self._radius = max(ellipse[1])
 
-                traces.append(dict(center=eye_center,
-                                   major_r=np.max(ellipse[1]),
-                                   rotated_rect=np.hstack(ellipse),
-                                   contour=contour.astype(np.int16),
-                                   frame_id=fr_count,
-                                   frame_intensity=img_std
-                                   ))
+                trace = dict(center=eye_center,
+                             major_r=np.max(ellipse[1]),
+                             rotated_rect=np.hstack(ellipse),
+                             contour=contour.astype(np.int16),
+                             frame_id=fr_count,
+                             frame_intensity=img_std
+                             )
             if display:
                 self.display(self._mask * gray if self._mask is not None else gray, blur, thres, eye_roi,
                              fr_count, n_frames, ellipse=ellipse,
                              eye_center=eye_center, contour=contour, ncontours=len(contours))
-            if (cv2.waitKey(1) & 0xFF == ord('q')):
-                raise PipelineException('Tracking aborted')
+                if (cv2.waitKey(1) & 0xFF == ord('q')):
+                    raise PipelineException('Tracking aborted')
+            yield trace
 
-        cap.release()
-        cv2.destroyAllWindows()
+        if display:
+            cv2.destroyAllWindows()
 
-        return traces
+
+def _track_segment(task):
+    """ Track frames [warmup_start, stop) of the video, decoding them once.
+
+    Tracking starts from state (None to start cold). Returns the results for the warm-up
+    frames [warmup_start, start), the tracker state at the end of the warm-up, the results
+    for frames [start, stop), the tracker state at their end and the hashes of frames
+    [warmup_start, stop) (None for frames that could not be decoded).
+    """
+    from itertools import chain, islice, repeat
+    from . import video
+
+    param, mask, videofile, eye_roi, state, warmup_start, start, stop = task
+    tracker = PupilTracker(param, mask=mask, verbose=False)
+    if state is not None:
+        tracker.set_state(state)
+
+    def track(frames):  # frames that cannot be decoded are tracked as None
+        frames = islice(chain((frame for _, frame in frames), repeat(None)),
+                        stop - warmup_start)
+        warmup, warmup_state, traces = [], tracker.get_state(), []
+        for trace in tracker.track_frames(frames, eye_roi, warmup_start):
+            if len(warmup) < start - warmup_start:
+                warmup.append(trace)
+                warmup_state = tracker.get_state()
+            else:
+                traces.append(trace)
+        return warmup, warmup_state, traces, tracker.get_state()
+
+    service = video.DecodeService(videofile, gray=False)
+    service.register('tracker', track)
+    service.register('hashes', video.frame_hashes)
+    results, errors = service.run(warmup_start, stop)
+    if errors:
+        raise next(iter(errors.values()))
+    hashes = results['hashes'] + [None] * (stop - warmup_start - len(results['hashes']))
+
+    return (*results['tracker'], hashes)
+
+
+def _verify_seek(warmup_hashes, hashes, warmup_start):
+    """ Whether the frames decoded after seeking to warmup_start are frames
+    [warmup_start, start) and could not be frames starting at any other position, e.g., if
+    they are identical dark frames.
+
+    Arguments:
+        warmup_hashes (list): Hashes of the frames decoded after the seek.
+        hashes (list): Hashes of frames [0, start) decoded without seeking (or verified).
+        warmup_start (int): Frame the video was seeked to.
+    """
+    num_frames = len(warmup_hashes)
+    start = warmup_start + num_frames
+    if num_frames == 0 or None in warmup_hashes:
+        return False
+    positions = [p for p in range(start) if hashes[p] == warmup_hashes[0] and
+                 hashes[p: min(p + num_frames, start)] == warmup_hashes[:start - p]]
+
+    return positions == [warmup_start]
+
+
+def track_parallel(param, videofile, eye_roi, mask=None, num_processes=8, overlap=100):
+    """ Track the pupil in contiguous segments of the video in parallel.
+
+    The tracker carries state across frames, so each segment is tracked starting (cold)
+    overlap frames earlier. A segment is kept if the tracker ends the warm-up in the same
+    state as the previous segment ended; otherwise, it is tracked again starting from that
+    state. Results are the same as PupilTracker(param, mask).track(videofile, eye_roi).
+
+    Segments start by seeking (CAP_PROP_POS_FRAMES), which is not frame-accurate for all
+    codecs. Hashes of the decoded warm-up frames should match only those of the same frames
+    in the previous segments and a segment tracked again should decode the same frames as
+    before; otherwise, the whole video is tracked sequentially.
+
+    Arguments:
+        param (dict): Tracking parameters (see PupilTracker).
+        videofile (str): Path to the eye video.
+        eye_roi (np.array): ROI [[y_start, y_end], [x_start, x_end]] (0-based).
+        mask (np.array): Mask for the video frames (see PupilTracker).
+        num_processes (int): Number of segments (tracked in parallel if there are enough
+            CPUs).
+        overlap (int): Number of warm-up frames per segment.
+
+    Returns:
+        List of tracking results (dict) per frame.
+    """
+    import multiprocessing as mp
+
+    if num_processes <= 1:  # no segments to stitch
+        return PupilTracker(param, mask=mask).track(videofile, eye_roi)
+
+    print("Tracking videofile", videofile)
+    cap = cv2.VideoCapture(videofile)
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    num_segments = max(min(num_processes, n_frames // max(overlap, 1)), 1)
+    num_processes = max(min(num_segments, mp.cpu_count() - 1), 1)
+    limits = np.linspace(0, n_frames, num_segments + 1).astype(int)
+    tasks = [(param, mask, videofile, eye_roi, None, max(start - overlap, 0), start, stop)
+             for start, stop in zip(limits[:-1], limits[1:])]
+    if num_processes > 1:
+        with mp.Pool(num_processes) as pool:
+            segments = pool.map(_track_segment, tasks)
+    else:
+        segments = [_track_segment(task) for task in tasks]
+
+    # Stitch segments (the first one starts at frame 0 without seeking)
+    traces, state, hashes = segments[0][2:]
+    for (_, warmup_state, segment_traces, segment_state, segment_hashes), task in zip(
+            segments[1:], tasks[1:]):
+        warmup_start, start, stop = task[5:]
+        warmup_hashes = segment_hashes[:start - warmup_start]
+        segment_hashes = segment_hashes[start - warmup_start:]
+        if not _verify_seek(warmup_hashes, hashes, warmup_start):
+            print('Could not verify the seek to frame {}: tracking sequentially'.format(
+                warmup_start), flush=True)
+            return PupilTracker(param, mask=mask).track(videofile, eye_roi)
+
+        if not PupilTracker.same_state(warmup_state, state):  # track the segment again
+            print('Retracking frames {}-{}'.format(start, stop), flush=True)
+            _, _, segment_traces, segment_state, retracked_hashes = _track_segment(
+                (param, mask, videofile, eye_roi, state, start, start, stop))
+            if retracked_hashes != segment_hashes:
+                print('Could not verify the seek to frame {}: tracking '
+                      'sequentially'.format(start), flush=True)
+                return PupilTracker(param, mask=mask).track(videofile, eye_roi)
+        traces.extend(segment_traces)
+        state = segment_state
+        hashes.extend(segment_hashes)
+    print("Reached end of videofile ", videofile)
+
+    return traces
 
 
 def adjust_gamma(image, gamma=1.0):
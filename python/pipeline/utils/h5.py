@@ -1,5 +1,7 @@
 import h5py
 import numpy as np
+import os
+from collections import OrderedDict
 from ..exceptions import PipelineException
 from .eye_tracking import ANALOG_PACKET_LEN
 from .signal import mirrconv, spaced_max
@@ -107,8 +109,8 @@ def ts2sec(ts, sampling_rate=1e7, is_packeted=False):
     """
     # Remove wrap around
     ts = np.array(ts, np.float64) # copy to avoid overwriting input
-    for wrap_idx in np.where(np.diff(ts) < 0)[0]:
-        ts[wrap_idx + 1: ] += 2 ** 32
+    num_wraps = np.cumsum(np.diff(ts) < 0) # wrap arounds before each timestamp
+    ts[1:] += num_wraps * 2 ** 32
 
     # Convert counter timestamps to secs
     ts_secs = ts / sampling_rate
@@ -132,9 +134,12 @@ def ts2sec(ts, sampling_rate=1e7, is_packeted=False):
         if np.any(abs(np.diff(ys) - expected_length) > 0.1 * expected_length):
             abnormal_diffs = abs(np.diff(ys) - expected_length) > 0.1 * expected_length
             abnormal_limits = np.where(np.diff([0, *abnormal_diffs, 0]))[0]
-            for start, stop in zip(abnormal_limits[::2], abnormal_limits[1::2]):
-                abnormal_indices = np.logical_and(sample_xs > xs[start], sample_xs < xs[stop])
-                ts_secs[abnormal_indices] = float('nan')
+
+            # Mark samples inside each gap: xs[start] < sample_xs < xs[stop]
+            gap_changes = np.zeros(len(ts_secs) + 1, dtype=int)
+            np.add.at(gap_changes, xs[abnormal_limits[::2]] + 1, 1)
+            np.add.at(gap_changes, xs[abnormal_limits[1::2]], -1)
+            ts_secs[np.cumsum(gap_changes[:-1]) > 0] = float('nan')
 
             print('Warning: Unequal spacing between continuos packets: {} abnormal gap(s)'
                   ' detected. Signal will have NaNs.'.format(len(abnormal_limits) // 2))
@@ -269,6 +274,22 @@ def read_digital_olfaction_file(filename):
         return data
 
 
+def decode_valves(valves):
+    """ Decode valve states stored as decimals of their binary representation.
+
+    :param np.array valves: Valve states (num_events), e.g., 10 = 0b1010: 2nd and 4th
+        valves are open.
+
+    :returns: Boolean array (num_events x num_valves), True if valve is open. First column
+        is the first valve; num_valves is the highest valve open in any event (at least 1,
+        as in the binary representation of 0).
+    """
+    states = np.asarray(valves).astype('<u8').reshape(-1, 1)
+    bits = np.unpackbits(states.view(np.uint8), axis=1, bitorder='little')
+    num_valves = max(int(states.max()).bit_length(), 1) if states.size > 0 else 0
+    return bits[:, :num_valves].astype(bool)
+
+
 def read_analog_olfaction_file(filename):
     """ Reads hdf5 files with olfaction analog signals.
     :param filename: path of the file. Needs a %d where 2GB file split counter is located.
@@ -302,4 +323,44 @@ def read_analog_olfaction_file(filename):
             msg = 'Unknown file version {} in file {}'.format(file_version, filename)
             raise PipelineException(msg)
 
-        return data
\ No newline at end of file
+        return data
+
+
+ANALOG_CACHE_GB = 2  # memory for decoded analog files (least recently used are dropped)
+_decoded_analog_files = OrderedDict()  # filename -> (modification time, data)
+
+
+def decode_analog_olfaction_file(filename):
+    """ Reads an hdf5 file with olfaction analog signals and converts its timestamps to
+    seconds.
+
+    Decoded files are cached (up to ANALOG_CACHE_GB) so tables using the same recording
+    (e.g., odor.OdorSync and odor.Respiration) read and decode it only once, even if one
+    table is populated for all recordings before the other.
+
+    :param filename: path of the file. Needs a %d where 2GB file split counter is located.
+    :returns: A dictionary as in read_analog_olfaction_file with an extra field:
+        times: 1-d array (num_samples). Time of each sample in seconds (ts2sec with
+            packets); NaN for samples in mistimed packets.
+        Arrays are shared by all callers so they are read-only.
+    """
+    modification_time = os.path.getmtime(filename % 0)
+    if _decoded_analog_files.get(filename, (None, ))[0] != modification_time:
+        data = read_analog_olfaction_file(filename)
+        data['times'] = ts2sec(data['ts'], is_packeted=True)
+        for value in data.values():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+        _decoded_analog_files.pop(filename, None)
+        _decoded_analog_files[filename] = (modification_time, data)
+
+        # Drop least recently used files (always keeping this one)
+        sizes = {name: sum(v.nbytes for v in d.values() if isinstance(v, np.ndarray))
+                 for name, (_, d) in _decoded_analog_files.items()}
+        for name in list(_decoded_analog_files)[:-1]:  # oldest first
+            if sum(sizes.values()) <= ANALOG_CACHE_GB * 1024 ** 3:
+                break
+            del _decoded_analog_files[name], sizes[name]
+    _decoded_analog_files.move_to_end(filename)
+
+    return _decoded_analog_files[filename][1]
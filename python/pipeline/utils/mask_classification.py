@@ -5,7 +5,8 @@ import numpy as np
 def classify_manual(masks, template):
     """ Opens a GUI that lets you manually classify masks into any of the valid types.
 
-    :param np.array masks: 3-d array of masks (num_masks, image_height, image_width)
+    :param masks: Iterable of 2-d masks (image_height, image_width), e.g., a 3-d array
+        (num_masks, image_height, image_width) or SparseMaskSet.images().
     :param np.array template: Image used as background to help with mask classification.
     """
     import matplotlib.pyplot as plt
@@ -0,0 +1,212 @@
+""" Sparse representation of 2-d segmentation masks. """
+import numpy as np
+from scipy import sparse
+
+
+class SparseMaskSet():
+    """ A set of 2-d masks stored as a (num_masks x num_pixels) CSR matrix.
+
+    Pixels are indexed in column major (Fortran) order, as in Segmentation.Mask, so
+    pixel p is at y = p % image_height, x = p // image_height. Operations work directly
+    on the nonzero entries; use to_dense() only when an image is actually needed.
+
+    :param sparse.spmatrix matrix: Masks (num_masks x image_height * image_width).
+    :param int image_height: Height of the field in pixels.
+    :param int image_width: Width of the field in pixels.
+    """
+    def __init__(self, matrix, image_height, image_width):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.matrix.sum_duplicates()
+        self.image_height = image_height
+        self.image_width = image_width
+
+    @classmethod
+    def from_pixels(cls, mask_pixels, mask_weights, image_height, image_width):
+        """ Create the mask set from the pixels and weights in Segmentation.Mask.
+
+        :param list mask_pixels: Per mask, 1-based indices into the image in column
+            major order.
+        :param list mask_weights: Per mask, weights at the indices above.
+        :param int image_height: Height of the field in pixels.
+        :param int image_width: Width of the field in pixels.
+        """
+        mask_pixels = [np.ravel(mp).astype(np.int64) - 1 for mp in mask_pixels]
+        mask_weights = [np.ravel(mw).astype(np.float32) for mw in mask_weights]
+        indptr = np.cumsum([0] + [len(mp) for mp in mask_pixels])
+        indices = np.concatenate(mask_pixels) if mask_pixels else np.empty(0, dtype=int)
+        data = (np.concatenate(mask_weights) if mask_weights else
+                np.empty(0, dtype=np.float32))
+        matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(mask_pixels),
+                                   image_height * image_width))
+        return cls(matrix, image_height, image_width)
+
+    @classmethod
+    def from_dense(cls, masks):
+        """ Create the mask set from an image_height x image_width x num_masks array."""
+        image_height, image_width, num_masks = masks.shape
+        matrix = sparse.csr_matrix(masks.reshape(image_height * image_width, num_masks,
+                                                 order='F').T)
+        return cls(matrix, image_height, image_width)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def shape(self):
+        """ Shape of the dense version: (image_height, image_width, num_masks)."""
+        return (self.image_height, self.image_width, len(self))
+
+    def _row_ids(self):
+        """ Mask index of each stored entry."""
+        return np.repeat(np.arange(len(self)), np.diff(self.matrix.indptr))
+
+    def to_dense(self, subset=None):
+        """ Masks as an image_height x image_width x num_masks array (np.float32).
+
+        :param subset: Indices (or boolean array) of the masks to return. None for all.
+        """
+        matrix = self.matrix if subset is None else self.matrix[subset]
+        dense = matrix.astype(np.float32).toarray()
+        dense = dense.reshape(-1, self.image_width, self.image_height)
+        return np.ascontiguousarray(dense.transpose([2, 1, 0]))
+
+    def images(self):
+        """ Generator of each mask as a 2-d image (image_height x image_width)."""
+        for i in range(len(self)):
+            yield self.to_dense([i])[:, :, 0]
+
+    def sums(self):
+        """ Sum of weights per mask (num_masks)."""
+        return np.asarray(self.matrix.sum(axis=1)).ravel()
+
+    def weighted_mean(self, image):
+        """ Mean of image under each mask weighted by the mask weights.
+
+        :param np.array image: Image (image_height x image_width), e.g., a delay image.
+
+        :returns: Weighted means (num_masks).
+        """
+        return self.matrix.dot(np.ravel(image, order='F')) / self.sums()
+
+    def centroids(self):
+        """ Center of mass of each mask (num_masks x 2) in y, x pixels."""
+        ys = np.arange(self.image_height * self.image_width) % self.image_height
+        xs = np.arange(self.image_height * self.image_width) // self.image_height
+        return np.stack([self.weighted_mean(ys), self.weighted_mean(xs)], axis=-1)
+
+    def bounding_boxes(self):
+        """ Bounding box of the nonzero pixels of each mask.
+
+        :returns: Array (num_masks x 4) with (y_start, y_end, x_start, x_end) per mask;
+            ends are exclusive so masks[y_start: y_end, x_start: x_end] has the entire
+            mask. Empty masks get an empty box (0, 0, 0, 0).
+        """
+        matrix = self.matrix.copy()
+        matrix.eliminate_zeros()
+        ys = matrix.indices % self.image_height
+        xs = matrix.indices // self.image_height
+
+        boxes = np.zeros((len(self), 4), dtype=int)
+        counts = np.diff(matrix.indptr)
+        non_empty = counts > 0
+        starts = matrix.indptr[:-1][non_empty]
+        if len(ys) > 0:
+            boxes[non_empty, 0] = np.minimum.reduceat(ys, starts)
+            boxes[non_empty, 1] = np.maximum.reduceat(ys, starts) + 1
+            boxes[non_empty, 2] = np.minimum.reduceat(xs, starts)
+            boxes[non_empty, 3] = np.maximum.reduceat(xs, starts) + 1
+
+        return boxes
+
+    def cumulative_mass(self):
+        """ Fraction of mass (squared weights) accumulated at each pixel when pixels are
+        visited from highest to lowest weight (similar to caiman's contours).
+
+        Pixels outside the mask accumulate all the mass (1.0) and are not stored.
+
+        :returns: SparseMaskSet with the cumulative mass as weights.
+        """
+        row_ids = self._row_ids()
+        order = np.lexsort((-self.matrix.data, row_ids))  # per mask, max to min weight
+        squared = self.matrix.data[order].astype(np.float64) ** 2
+        cumsum = np.cumsum(squared)
+        previous = np.concatenate([[0], cumsum])[self.matrix.indptr[:-1]]  # per mask
+        totals = np.concatenate([[0], cumsum])[self.matrix.indptr[1:]] - previous
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mass = (cumsum - previous[row_ids]) / totals[row_ids]
+
+        matrix = sparse.csr_matrix((mass, self.matrix.indices[order],
+                                    self.matrix.indptr.copy()), shape=self.matrix.shape)
+        matrix.sort_indices()
+        return SparseMaskSet(matrix, self.image_height, self.image_width)
+
+    def binarize(self, threshold=0.9):
+        """ Binary masks with the highest weighted pixels that account for a threshold
+        fraction of the mass (squared weights) of each mask.
+
+        :param float threshold: Fraction of the mass to keep.
+
+        :returns: SparseMaskSet with boolean weights.
+        """
+        mass = self.cumulative_mass().matrix
+        matrix = sparse.csr_matrix((mass.data < threshold, mass.indices, mass.indptr),
+                                   shape=mass.shape, copy=True)
+        matrix.eliminate_zeros()
+        return SparseMaskSet(matrix, self.image_height, self.image_width)
+
+    def overlap(self, other=None):
+        """ Number of pixels shared by the nonzero regions of each pair of masks.
+
+        :param SparseMaskSet other: Second set of masks. Defaults to self.
+
+        :returns: Sparse matrix (num_masks x num_other_masks) of np.int64.
+        """
+        other = self if other is None else other
+        support = (self.matrix != 0).astype(np.int64)
+        other_support = (other.matrix != 0).astype(np.int64)
+        return support.dot(other_support.T).tocsr()
+
+    def label_ious(self, label_image, labels):
+        """ Intersection-over-union of the nonzero region of each mask with each labelled
+        region in a label image (e.g., a segmented field).
+
+        Intersections are a histogram over (label, mask) pairs of the pixels in each
+        mask, so only pairs that actually overlap are computed.
+
+        :param np.array label_image: Image (image_height x image_width) with integer
+            labels.
+        :param list labels: Labels of interest. Pixels with other labels are ignored.
+
+        :returns: Sparse matrix (num_labels x num_masks) with the IOU of each pair.
+        """
+        labels = np.asarray(labels)
+        label_image = np.ravel(label_image, order='F')
+
+        # Map each pixel to the index of its label in labels (-1 if not there)
+        label_idx = np.full(len(label_image), -1)
+        if len(labels) > 0:
+            sorter = np.argsort(labels)
+            positions = np.searchsorted(labels, label_image, sorter=sorter)
+            candidates = sorter[np.minimum(positions, len(labels) - 1)]
+            is_label = labels[candidates] == label_image
+            label_idx[is_label] = candidates[is_label]
+
+        # Count intersections
+        support = self.matrix.copy()
+        support.eliminate_zeros()
+        mask_idx = np.repeat(np.arange(len(self)), np.diff(support.indptr))
+        pixel_labels = label_idx[support.indices]
+        in_label = pixel_labels >= 0
+        intersections = sparse.coo_matrix((np.ones(np.count_nonzero(in_label)),
+                                           (pixel_labels[in_label], mask_idx[in_label])),
+                                          shape=(len(labels), len(self))).tocsr().tocoo()
+
+        # Compute unions from the areas
+        label_areas = np.bincount(label_idx[label_idx >= 0], minlength=len(labels))
+        mask_areas = np.diff(support.indptr)
+        unions = (label_areas[intersections.row] + mask_areas[intersections.col] -
+                  intersections.data)
+
+        return sparse.csr_matrix((intersections.data / unions, (intersections.row,
+                                                                intersections.col)),
+                                 shape=intersections.shape)
@@ -1,5 +1,6 @@
 import numpy as np
 import multiprocessing as mp
+from contextlib import contextmanager
 from . import galvo_corrections
 import time
 
@@ -216,15 +217,147 @@ def parallel_save_memmap(chunks, results, raster_phase, fill_fraction, y_shifts,
         chunk = _correct_field(chunk, raster_phase, fill_fraction, x_shifts[frames],
                                y_shifts[frames])
 
-        # Save in mmap scan
+        # Save in mmap scan (flushed once by the caller after all chunks are written)
         num_frames = chunk.shape[-1]
         mmap_scan[:, frames] = chunk.reshape((-1, num_frames), order='F')
-        mmap_scan.flush()
 
         # Save minimum value in results
         results.append(chunk.min())
 
 
+@contextmanager
+def corrected_scan_memmap(scan, field_id, channel, raster_phase, fill_fraction, y_shifts,
+                          x_shifts, scratch_dir='/tmp', reuse=False, max_reuse_gb=None):
+    """ Correct a field and save it in a memory mapped file as expected by CaImAn.
+
+    Chunks of the scan are corrected in parallel and written directly to disk so the
+    full scan is never loaded in memory. The memmap has shape (num_pixels, num_frames),
+    pixels are flattened in F order and values are shifted to be nonnegative.
+
+    The file is deleted when exiting the context, unless reuse is True. In that case,
+    its name is derived from a hash of the scan files and correction parameters and the
+    file is kept in scratch_dir, so later calls with the same corrected scan (e.g.,
+    CNMF reruns with different parameters) skip the correction. Kept files are yielded
+    read-only and, if max_reuse_gb is given, the least recently used ones are deleted
+    once they take more than that in scratch_dir.
+
+    :param Scan scan: An scan object as returned by scanreader.
+    :param int field_id: Which field to use: 0-based.
+    :param int channel: Which channel to read. 0-based.
+    :param float raster_phase: Raster phase used for raster correction.
+    :param float fill_fraction: Fill fraction used for raster correction.
+    :param np.array y_shifts, x_shifts: Motion shifts to correct scan.
+    :param string scratch_dir: Directory where the memmap will be written.
+    :param bool reuse: Whether to reuse (and keep) the memmap across calls.
+    :param float max_reuse_gb: Maximum size of the kept memmaps in scratch_dir. None for
+        no limit.
+
+    :yields: np.memmap (num_pixels x num_frames).
+    """
+    import hashlib
+    import uuid
+    import os
+
+    image_height, image_width = scan[field_id, :, :, channel, 0].shape[:2]
+    num_frames = scan.num_frames
+    mmap_shape = (image_height * image_width, num_frames)
+    suffix = '_d1_{}_d2_{}_d3_1_order_C_frames_{}_.mmap'.format(image_height, image_width,
+                                                              num_frames)
+
+    # Name the file after the corrected scan (if reusing) or a random id
+    if reuse:
+        scan_hash = hashlib.md5()
+        for info in [sorted(scan.filenames), field_id, channel, raster_phase,
+                     fill_fraction]:
+            scan_hash.update(repr(info).encode())
+        for shifts in [y_shifts, x_shifts]:
+            scan_hash.update(np.ascontiguousarray(shifts, dtype=np.float64).tobytes())
+        filename = os.path.join(scratch_dir, 'caiman-' + scan_hash.hexdigest() + suffix)
+    else:
+        filename = os.path.join(scratch_dir, 'caiman-{}'.format(uuid.uuid4()) + suffix)
+
+    try:
+        if os.path.isfile(filename):
+            print('Reusing memory mapped file', filename)
+            os.utime(filename)  # mark as recently used
+        else:
+            # Write to a temporary file first so incomplete files are never reused
+            temp_filename = os.path.join(scratch_dir, 'caiman-{}'.format(uuid.uuid4()) +
+                                         suffix)
+            try:
+                mmap_scan = np.memmap(temp_filename, mode='w+', shape=mmap_shape,
+                                      dtype=np.float32)
+
+                # Map: Correct scan and save in memmap scan (queued chunks are held in
+                # memory so keep few of them)
+                kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
+                          'y_shifts': y_shifts, 'x_shifts': x_shifts,
+                          'mmap_scan': mmap_scan}
+                results = map_frames(parallel_save_memmap, scan, field_id=field_id,
+                                     channel=channel, kwargs=kwargs, queue_size=2)
+
+                # Reduce: Use the minimum values to make memory mapped scan nonnegative
+                mmap_scan -= np.min(results)  # bit inefficient but necessary
+                mmap_scan.flush()
+                del mmap_scan
+
+                os.rename(temp_filename, filename)
+            finally:
+                if os.path.isfile(temp_filename):
+                    os.remove(temp_filename)
+
+            if reuse and max_reuse_gb is not None:
+                evict_memmaps(scratch_dir, max_reuse_gb, keep=filename)
+
+        yield np.memmap(filename, mode='r' if reuse else 'r+', shape=mmap_shape,
+                        dtype=np.float32)
+    finally:
+        if not reuse and os.path.isfile(filename):
+            print('Deleting memory mapped scan...')
+            os.remove(filename)
+
+
+def evict_memmaps(scratch_dir, max_gb, keep=None):
+    """ Delete least recently used memmaps kept by corrected_scan_memmap.
+
+    Only files named after a corrected scan hash are considered; memmaps being written
+    or not kept (named with a random id) are never deleted. Memmaps still open
+    elsewhere stay readable until they are closed.
+
+    :param string scratch_dir: Directory with the memmaps.
+    :param float max_gb: Maximum size of the kept memmaps after eviction.
+    :param string keep: Filename of a memmap that should not be deleted.
+
+    :returns: List of deleted filenames.
+    """
+    import re
+    import os
+
+    pattern = re.compile(r'caiman-[0-9a-f]{32}_d1_\d+_d2_\d+_d3_1_order_C_frames_\d+_'
+                         r'\.mmap$')
+    memmaps = []
+    for entry in os.scandir(scratch_dir):
+        if pattern.match(entry.name) and entry.is_file():
+            stat = entry.stat()
+            memmaps.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in memmaps)
+    deleted = []
+    for _, size, filename in sorted(memmaps):  # oldest first
+        if total_bytes <= max_gb * 1024 ** 3:
+            break
+        if keep is not None and os.path.abspath(filename) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(filename)
+        except FileNotFoundError:  # deleted by another process
+            pass
+        total_bytes -= size
+        deleted.append(filename)
+
+    return deleted
+
+
 def parallel_fluorescence(chunks, results, raster_phase, fill_fraction, y_shifts,
                          x_shifts, mask_pixels, mask_weights):
     """ Correct scan and compute fluorescence traces for the given masks.
@@ -500,4 +633,47 @@ def parallel_correct_stack(chunks, results, raster_phase, fill_fraction, y_shift
         averaged = np.mean(corrected, axis=-1) if corrected.ndim > 2 else corrected
 
         # Add to results
-        results.append((field_idx, averaged))
\ No newline at end of file
+        results.append((field_idx, averaged))
+
+
+def insert_in_chunks(table, rows, chunk_size=5000, **kwargs):
+    """ Insert rows with one multi-row statement per chunk_size rows: a round trip per
+    chunk rather than per row while keeping each statement under the server's packet size.
+
+    :param table: Table (or part table) to insert into.
+    :param rows: Iterable of rows (dicts).
+    :param int chunk_size: Rows per statement.
+    :param kwargs: Passed to table.insert, e.g., ignore_extra_fields.
+
+    :returns int: Number of insert statements.
+    """
+    from itertools import islice
+
+    if chunk_size < 1:
+        raise ValueError('chunk_size should be positive')
+
+    rows = iter(rows)
+    num_statements = 0
+    chunk = list(islice(rows, chunk_size))
+    while chunk:
+        table.insert(chunk, **kwargs)
+        num_statements += 1
+        chunk = list(islice(rows, chunk_size))
+
+    return num_statements
+
+
+def frame_rows(key, values, names):
+    """ Rows of a per-frame table: the key plus frame_id and the values of that frame.
+
+    :param dict key: Attributes shared by all rows (primary key of the master table).
+    :param values: Iterable with the values (one per name) of each frame, in frame order.
+    :param list names: Attribute names of the values.
+
+    :returns: Generator of rows (dicts) with frame_id starting at 0.
+    """
+    for frame_id, frame_values in enumerate(values):
+        if len(frame_values) != len(names):
+            raise ValueError('Frame {} has {} values for {} attributes'.format(
+                frame_id, len(frame_values), len(names)))
+        yield dict(key, frame_id=frame_id, **dict(zip(names, frame_values)))
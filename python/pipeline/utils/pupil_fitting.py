@@ -0,0 +1,328 @@
+""" Circles and ellipses fitted to the labeled pupil points (or contours) of all frames. """
+import numpy as np
+
+
+def _chunks(num_frames, chunk_size=10000):
+    """ Slices of frames processed together (bounds memory for long videos)."""
+    return [slice(start, start + chunk_size) for start in range(0, num_frames, chunk_size)]
+
+
+def enclosing_circles(points, valid, min_points=3):
+    """ Smallest circle through three points enclosing all points, for each frame.
+
+    Vectorized version of DLC_tools.smallest_enclosing_circle_naive: all triples of points
+    are tried and the smallest of their circumcircles enclosing all points is kept.
+
+    :param np.array points: Points (frames x k x 2).
+    :param np.array valid: Boolean mask (frames x k) of points to use.
+    :param int min_points: Minimum number of valid points to fit a circle.
+
+    :returns: (centers (frames x 2), radii (frames)). NaN where there are not enough points or
+        no circumcircle encloses all points (e.g., all points are collinear).
+    """
+    from itertools import combinations
+
+    points = np.asarray(points, dtype=np.float64)
+    valid = np.asarray(valid, dtype=bool)
+    triples = np.array(list(combinations(range(points.shape[1]), 3)))
+    if len(triples) == 0:
+        return np.full((len(points), 2), np.nan), np.full(len(points), np.nan)
+
+    circles = np.full((len(points), 3), np.nan)
+    for chunk in _chunks(len(points)):
+        pts = points[chunk]
+        a, b, c = [pts[:, triples[:, i]] for i in range(3)]  # chunk x triples x 2
+
+        # circumcircle as in DLC_tools.make_circumcircle
+        o = (np.minimum(np.minimum(a, b), c) + np.maximum(np.maximum(a, b), c)) / 2
+        a, b, c = a - o, b - o, c - o
+        ax, ay, bx, by, cx, cy = a[..., 0], a[..., 1], b[..., 0], b[..., 1], c[..., 0], c[..., 1]
+        d = (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by)) * 2.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = ((ax*ax + ay*ay) * (by - cy) + (bx*bx + by*by) * (cy - ay) +
+                 (cx*cx + cy*cy) * (ay - by)) / d
+            y = ((ax*ax + ay*ay) * (cx - bx) + (bx*bx + by*by) * (ax - cx) +
+                 (cx*cx + cy*cy) * (bx - ax)) / d
+        radius = np.max(np.hypot(x[..., None] - np.stack([ax, bx, cx], -1),
+                                 y[..., None] - np.stack([ay, by, cy], -1)), axis=-1)
+        x, y = x + o[..., 0], y + o[..., 1]
+
+        # keep circles through valid points that enclose all valid points
+        distances = np.hypot(pts[:, None, :, 0] - x[..., None], pts[:, None, :, 1] - y[..., None])
+        encloses = distances <= radius[..., None] * (1 + 1e-14)
+        ok = ((d != 0) & valid[chunk][:, triples].all(-1) &
+              (encloses | ~valid[chunk][:, None]).all(-1))
+        radius = np.where(ok, radius, np.inf)
+
+        best = np.argmin(radius, axis=1)  # first smallest, as in the sequential search
+        rows = np.arange(len(best))
+        found = np.isfinite(radius[rows, best])
+        circles[chunk] = np.where(found[:, None], np.stack([x[rows, best], y[rows, best],
+                                                            radius[rows, best]], -1), np.nan)
+
+    circles[valid.sum(-1) < min_points] = np.nan
+
+    return circles[:, :2], circles[:, 2]
+
+
+def _svd_solve(design, targets):
+    """ Least-squares solutions of a batch of systems (ignoring tiny singular values, as
+    cv2.SVBackSubst)."""
+    u, w, vt = np.linalg.svd(design, full_matrices=False)
+    threshold = 2 * np.finfo(np.float64).eps * w.sum(-1, keepdims=True)
+    w_inv = np.divide(1, w, out=np.zeros_like(w), where=w > threshold)
+    return np.einsum('fji,fj->fi', vt, np.einsum('fkj,fk->fj', u, targets) * w_inv), w
+
+
+def fit_ellipses(points, valid, min_points=6):
+    """ Least-squares ellipses fitted to the points of each frame.
+
+    Batched version of the algebraic fit in cv2.fitEllipse (conic fit on normalized points
+    followed by a refit around the estimated center). Centers and axes match
+    cv2.fitEllipse; angles are always derived from the fitted conic (cv2 leaves them at 0
+    when the first axis is already the shorter one). Degenerate frames are fitted with
+    cv2.fitEllipse.
+
+    :param np.array points: Points (frames x k x 2). cv2.fitEllipse receives integer points
+        so pass rounded points to reproduce it.
+    :param np.array valid: Boolean mask (frames x k) of points to use.
+    :param int min_points: Minimum number of valid points to fit an ellipse (at least 5).
+
+    :returns: (centers (frames x 2), axes (frames x 2), angles (frames)) with full axes
+        lengths as (minor, major) and angle (in degrees) of the minor axis, as in the
+        rotated rectangle returned by cv2.fitEllipse. NaN where there are not enough points.
+    """
+    import cv2
+
+    points = np.asarray(points, dtype=np.float32)
+    valid = np.asarray(valid, dtype=bool)
+    num_frames, num_points = valid.shape
+    ellipses = np.full((num_frames, 5), np.nan)  # cx, cy, width, height, angle
+
+    enough_points = valid.sum(-1) >= max(min_points, 5)
+    for chunk in _chunks(num_frames):
+        frames = np.flatnonzero(enough_points[chunk]) + chunk.start
+        if len(frames) == 0:
+            continue
+        mask = valid[frames]
+        weights = mask.astype(np.float64)
+        pts = np.where(mask[..., None], points[frames], 0)
+
+        # normalize points (in single precision, as cv2)
+        center = np.zeros((len(frames), 2), dtype=np.float32)
+        for i in range(num_points):  # sequential sum
+            center += pts[:, i]
+        center /= mask.sum(-1, keepdims=True).astype(np.float32)
+        deltas = (pts - center[:, None]) * mask[..., None]
+        s = np.sum(np.abs(deltas).astype(np.float64), axis=(1, 2))
+        scale = 100 / np.maximum(s, np.finfo(np.float32).eps)
+        px, py = deltas[..., 0] * scale[:, None], deltas[..., 1] * scale[:, None]
+
+        # fit general conic A x^2 + B y^2 + C xy - D x - E y = -1e4
+        design = np.stack([-px * px, -py * py, -px * py, px, py], -1) * weights[..., None]
+        conic, w = _svd_solve(design, 1e4 * weights)
+        degenerate = w[:, 0] * np.finfo(np.float32).eps > w[:, -1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+
+            # center: zero gradient of the conic
+            system = np.stack([np.stack([2 * conic[:, 0], conic[:, 2]], -1),
+                               np.stack([conic[:, 2], 2 * conic[:, 1]], -1)], 1)
+            determinant = np.linalg.det(system)
+            degenerate |= ~np.isfinite(determinant) | (determinant == 0)
+            system[degenerate] = np.eye(2)
+            offset = np.linalg.solve(system, conic[:, 3:5, None])[..., 0]
+
+            # refit A, B, C around that center
+            qx, qy = px - offset[:, :1], py - offset[:, 1:]
+            design = np.stack([qx * qx, qy * qy, qx * qy], -1) * weights[..., None]
+            refit, w = _svd_solve(design, weights)
+            a, b, c = refit.T
+            degenerate |= w[:, -1] <= w[:, 0] * 1e-10  # e.g., points on a line through the center
+
+            angle = -0.5 * np.arctan2(c, b - a)
+            t = np.where(np.abs(c) > 1e-8, c / np.sin(-2 * angle), b - a)
+            radii = np.abs(np.stack([a + b - t, a + b + t], -1))
+            radii = np.where(radii > 1e-8, np.sqrt(2 / radii), radii)
+
+        cx = (offset[:, 0] / scale).astype(np.float32) + center[:, 0]
+        cy = (offset[:, 1] / scale).astype(np.float32) + center[:, 1]
+        width, height = (radii * 2 / scale[:, None]).astype(np.float32).T
+        angle = np.degrees(angle)
+        swap = width > height
+        width, height = np.where(swap, height, width), np.where(swap, width, height)
+        angle = np.where(swap, 90 + angle, angle) % 180
+        ellipses[frames] = np.stack([cx, cy, width, height, angle], -1)
+
+        degenerate |= ~np.all(np.isfinite(ellipses[frames]), -1) | ~(width > 0)
+        for frame in frames[degenerate]:
+            (cx, cy), (width, height), angle = cv2.fitEllipse(
+                points[frame, valid[frame]].reshape(-1, 1, 2))
+            ellipses[frame] = cx, cy, width, height, angle
+
+    return ellipses[:, :2], ellipses[:, 2:4], ellipses[:, 4]
+
+
+def _fit_contour_chunk(contours):
+    """ cv2.fitEllipse of each contour as rows (cx, cy, width, height, angle)."""
+    import cv2
+
+    return np.array([[*center, *axes, angle] for center, axes, angle in
+                     (cv2.fitEllipse(contour) for contour in contours)]).reshape(-1, 5)
+
+
+def fit_contours(contours, min_points=5, chunk_size=1000, num_processes=1):
+    """ Ellipses fitted to contours with cv2.fitEllipse, in parallel over chunks of contours.
+
+    :param list contours: Contours (k x 1 x 2 arrays, as from cv2.findContours) or None where
+        there is no contour.
+    :param int min_points: Minimum number of points to fit an ellipse (at least 5).
+    :param int chunk_size: Contours fitted per task.
+    :param int num_processes: Number of processes fitting chunks in parallel (capped by the
+        number of CPUs).
+
+    :returns: (centers (contours x 2), axes (contours x 2), angles (contours)) as returned by
+        cv2.fitEllipse. NaN for missing contours or contours with less than min_points points.
+    """
+    import multiprocessing as mp
+
+    lengths = np.array([0 if contour is None else len(contour) for contour in contours])
+    to_fit = np.flatnonzero(lengths >= max(min_points, 5))
+    ellipses = np.full((len(contours), 5), np.nan)
+
+    tasks = [[contours[i] for i in to_fit[chunk]] for chunk in _chunks(len(to_fit), chunk_size)]
+    num_processes = max(min(num_processes, len(tasks), mp.cpu_count() - 1), 1)
+    if num_processes > 1:
+        with mp.Pool(num_processes) as pool:
+            results = pool.map(_fit_contour_chunk, tasks)
+    else:
+        results = [_fit_contour_chunk(task) for task in tasks]
+    if results:
+        ellipses[to_fit] = np.concatenate(results)
+
+    return ellipses[:, :2], ellipses[:, 2:4], ellipses[:, 4]
+
+
+def ellipse_polygons(centers, axes, angles, num_vertices=64):
+    """ Convex polygons approximating ellipses (or circles).
+
+    :param np.array centers: Centers (frames x 2).
+    :param np.array axes: Full axes lengths (frames x 2) along the rotated x and y axes.
+    :param np.array angles: Rotation of the ellipses in degrees (frames).
+    :param int num_vertices: Number of vertices of each polygon.
+
+    :returns: Vertices (frames x num_vertices x 2) in counterclockwise order (when y points
+        up) and with the polygons' area equal to the ellipses' area.
+    """
+    t = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+    # scale up the inscribed polygon so its area equals the ellipse area
+    axes = np.asarray(axes) / 2 * np.sqrt(2 * np.pi / num_vertices / np.sin(2 * np.pi /
+                                                                             num_vertices))
+    x = axes[:, :1] * np.cos(t)
+    y = axes[:, 1:] * np.sin(t)
+    angles = np.radians(angles)[:, None]
+    cos, sin = np.cos(angles), np.sin(angles)
+
+    return np.stack([centers[:, :1] + x * cos - y * sin, centers[:, 1:] + x * sin + y * cos],
+                    axis=-1)
+
+
+def _polygon_areas(polygons, lengths):
+    """ Areas of padded polygons (frames x max_length x 2) with lengths vertices each."""
+    indices = np.arange(polygons.shape[1])
+    next_indices = np.where(indices + 1 < lengths[:, None], indices + 1, 0)
+    next_vertices = np.take_along_axis(polygons, next_indices[..., None], axis=1)
+    cross = (polygons[..., 0] * next_vertices[..., 1] - polygons[..., 1] * next_vertices[..., 0])
+    return np.abs(np.sum(np.where(indices < lengths[:, None], cross, 0), axis=1)) / 2
+
+
+def clipped_areas(polygons, convex_polygons):
+    """ Area of the intersection of each polygon with a convex polygon.
+
+    Polygons are clipped against each edge of the convex polygons (Sutherland-Hodgman) for
+    all frames at once.
+
+    :param np.array polygons: Vertices (frames x n x 2) of simple (not necessarily convex)
+        polygons.
+    :param np.array convex_polygons: Vertices (frames x m x 2) of convex polygons in
+        counterclockwise order (when y points up).
+
+    :returns: Areas (frames).
+    """
+    polygons = np.asarray(polygons, dtype=np.float64)
+    convex_polygons = np.asarray(convex_polygons, dtype=np.float64)
+    if len(polygons) == 0:
+        return np.zeros(0)
+    rows = np.arange(len(polygons))
+    lengths = np.full(len(polygons), polygons.shape[1])
+
+    for start, end in zip(convex_polygons.transpose([1, 0, 2]),
+                          np.roll(convex_polygons, -1, axis=1).transpose([1, 0, 2])):
+        # NaNs (crossings of parallel edges, vertices of emptied polygons) are never kept
+        with np.errstate(divide='ignore', invalid='ignore'):
+            edge = (end - start)[:, None]
+            sides = (edge[..., 0] * (polygons[..., 1] - start[:, None, 1]) -
+                     edge[..., 1] * (polygons[..., 0] - start[:, None, 0]))  # >= 0 is inside
+            inside = sides >= 0
+
+            # vertices are packed at the start: the previous of the first one is the last one
+            last = np.maximum(lengths - 1, 0)
+            previous_vertices = np.concatenate([polygons[rows, last][:, None],
+                                                polygons[:, :-1]], axis=1)
+            previous_sides = np.concatenate([sides[rows, last][:, None], sides[:, :-1]], axis=1)
+            previous_inside = previous_sides >= 0
+            in_polygon = np.arange(polygons.shape[1]) < lengths[:, None]
+
+            # each edge (previous -> vertex) adds its crossing with the clipping line (if any)
+            # and its end vertex (if inside)
+            t = previous_sides / (previous_sides - sides)
+            crossings = previous_vertices + t[..., None] * (polygons - previous_vertices)
+        candidates = np.stack([crossings, polygons], axis=2).reshape(len(polygons), -1, 2)
+        keep = np.stack([in_polygon & (inside != previous_inside), in_polygon & inside],
+                        axis=2).reshape(len(polygons), -1)
+
+        # pack the kept vertices
+        positions = np.cumsum(keep, axis=1) - 1
+        lengths = positions[:, -1] + 1
+        polygons = np.zeros((len(polygons), max(lengths.max(), 1), 2))
+        polygons[np.nonzero(keep)[0], positions[keep]] = candidates[keep]
+
+    return np.where(lengths >= 3, _polygon_areas(polygons, lengths), 0)
+
+
+def visible_portions(eyelids, centers, axes, angles, num_vertices=64):
+    """ Portion of each ellipse (or circle) inside the polygon formed by the eyelids.
+
+    :param np.array eyelids: Vertices (frames x n x 2) of the eyelid polygons (in order).
+    :param np.array centers, axes, angles: Ellipses as returned by fit_ellipses. For
+        circles, axes are the diameters and angles are 0.
+    :param int num_vertices: Number of vertices of the polygon approximating each ellipse.
+
+    :returns: Visible portion (frames) between 0 and 1. NaN for frames with NaN inputs.
+    """
+    centers, axes, angles = np.asarray(centers), np.asarray(axes), np.asarray(angles)
+    visible = np.full(len(centers), np.nan)
+    ok = (np.all(np.isfinite(np.reshape(eyelids, (len(visible), -1))), -1) &
+          np.all(np.isfinite(centers), -1) & np.all(np.isfinite(axes), -1) &
+          np.isfinite(angles) & np.all(axes > 0, -1))
+    for chunk in _chunks(len(visible)):
+        frames = np.flatnonzero(ok[chunk]) + chunk.start
+        if len(frames) == 0:
+            continue
+        polygons = ellipse_polygons(centers[frames], axes[frames], angles[frames], num_vertices)
+        areas = np.pi * axes[frames, 0] * axes[frames, 1] / 4
+
+        # clip the pupil by the (fewer) eyelid edges if the eyelid polygon is convex
+        eyelid_polygons = np.asarray(eyelids, dtype=np.float64)[frames]
+        edges = np.roll(eyelid_polygons, -1, axis=1) - eyelid_polygons
+        turns = edges[..., 0] * np.roll(edges[..., 1], -1, axis=1) - \
+            edges[..., 1] * np.roll(edges[..., 0], -1, axis=1)
+        clockwise = np.sum(turns, axis=1) < 0
+        eyelid_polygons[clockwise] = eyelid_polygons[clockwise, ::-1]
+        convex = np.all(np.where(clockwise[:, None], turns <= 0, turns >= 0), axis=1)
+
+        inside_areas = np.empty(len(frames))
+        inside_areas[convex] = clipped_areas(polygons[convex], eyelid_polygons[convex])
+        inside_areas[~convex] = clipped_areas(eyelid_polygons[~convex], polygons[~convex])
+        visible[frames] = inside_areas / areas
+
+    return np.clip(visible, 0, 1)
@@ -0,0 +1,115 @@
+""" Spike-triggered averages of receptive fields for all temporal bins at once. """
+import numpy as np
+import tempfile
+import shutil
+import os
+
+
+def movie_matrix(movie):
+    """ Float32, C-contiguous (t, y*x) matrix of a (y, x, t) movie."""
+    return np.ascontiguousarray(movie.reshape(-1, movie.shape[-1]).T, dtype=np.float32)
+
+
+def lag_matrix(movie_matrix, nbins):
+    """ Lag (Hankel) matrix of a movie without copying it.
+
+    :param np.array movie_matrix: C-contiguous (t, p) matrix.
+    :param int nbins: Number of temporal bins.
+
+    :returns: Read-only view (t - nbins + 1, nbins * p) whose row t is
+        movie_matrix[t: t + nbins].ravel(); rows overlap in memory.
+    """
+    from numpy.lib.stride_tricks import as_strided
+
+    num_frames, num_pixels = movie_matrix.shape
+    return as_strided(movie_matrix, shape=(num_frames - nbins + 1, nbins * num_pixels),
+                      strides=movie_matrix.strides, writeable=False)
+
+
+def lagged_sta(snippets, movie_matrix, nbins):
+    """ Spike-triggered average for all temporal bins (as a single matrix product):
+        sta[i, p, b] = sum_t snippets[i, t] * movie_matrix[t + nbins - 1 - b, p]
+
+    :param np.array snippets: Traces (n, t') with t' <= t - nbins + 1.
+    :param np.array movie_matrix: C-contiguous (t, p) matrix.
+    :param int nbins: Number of temporal bins.
+
+    :returns: Array (n, p, nbins) (np.float32).
+    """
+    snippets = np.asarray(snippets, dtype=np.float32)
+    num_traces, num_samples = snippets.shape
+    lagged = snippets @ lag_matrix(movie_matrix, nbins)[:num_samples]
+    lagged = lagged.reshape(num_traces, nbins, movie_matrix.shape[1])
+
+    return np.ascontiguousarray(lagged[:, ::-1].transpose([0, 2, 1]))  # lag to bin
+
+
+def lagged_prediction(movie_matrix, maps):
+    """ Traces predicted by linear receptive fields (adjoint of lagged_sta):
+        traces[i, t] = sum_{p, b} maps[i, p, b] * movie_matrix[t + nbins - 1 - b, p]
+
+    :param np.array movie_matrix: C-contiguous (t, p) matrix.
+    :param np.array maps: Receptive fields (n, p, nbins).
+
+    :returns: Array (n, t - nbins + 1) (np.float32).
+    """
+    nbins = maps.shape[-1]
+    kernels = np.ascontiguousarray(maps[:, :, ::-1].transpose([0, 2, 1]), dtype=np.float32)
+    return kernels.reshape(len(maps), -1) @ lag_matrix(movie_matrix, nbins).T
+
+
+class RFEngine():
+    """ Spike-triggered averages and predicted traces over many trials' movies.
+
+    Each movie is converted once to a float32 (t, y*x) matrix and cached on disk so
+    iterative algorithms (e.g., backprop) reuse it without rebinning it or keeping all
+    movies in memory. Use as a context manager (or call close) to delete the cache.
+
+    :param int nbins: Number of temporal bins in the maps.
+    :param string cache_dir: Directory for the cached movies. None for the system's temp.
+    """
+    def __init__(self, nbins, cache_dir=None):
+        self.nbins = nbins
+        self.cache_dir = tempfile.mkdtemp(prefix='rf-', dir=cache_dir)
+        self.image_shapes = {}  # (y, x) per movie
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _filename(self, movie_id):
+        return os.path.join(self.cache_dir, '{}.npy'.format(movie_id))
+
+    def add_movie(self, movie_id, movie):
+        """ Cache a movie.
+
+        :param movie_id: Identifier of the movie, e.g., the trial_idx.
+        :param np.array movie: Movie (y, x, t).
+        """
+        np.save(self._filename(movie_id), movie_matrix(movie))
+        self.image_shapes[movie_id] = movie.shape[:2]
+
+    def get_movie_matrix(self, movie_id):
+        """ Cached (t, y*x) matrix of a movie (memory-mapped)."""
+        return np.load(self._filename(movie_id), mmap_mode='r')
+
+    def spike_triggered_avg(self, snippets, movie_id):
+        """ Spike-triggered average of snippets (n, t) on a cached movie.
+
+        :returns: Array (n, y, x, nbins).
+        """
+        maps = lagged_sta(snippets, self.get_movie_matrix(movie_id), self.nbins)
+        return maps.reshape(len(maps), *self.image_shapes[movie_id], self.nbins)
+
+    def predict_traces(self, movie_id, maps):
+        """ Traces predicted by maps (n, y, x, nbins) on a cached movie.
+
+        :returns: Array (n, t - nbins + 1).
+        """
+        return lagged_prediction(self.get_movie_matrix(movie_id),
+                                 maps.reshape(len(maps), -1, self.nbins))
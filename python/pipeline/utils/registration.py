@@ -33,7 +33,7 @@ def create_grid(um_sizes, desired_res=1):
     return full_grid
 
 
-def resize(original, um_sizes, desired_res):
+def resize(original, um_sizes, desired_res, z_range=None):
     """ Resize array originally of um_sizes size to have desired_res resolution.
 
     We preserve the center of original and resized arrays exactly in the middle. We also
@@ -43,26 +43,53 @@ def resize(original, um_sizes, desired_res):
     :param np.array original: Array to resize.
     :param tuple um_sizes: Size in microns of the array (one per axis).
     :param int or tuple desired_res: Desired resolution (um/px) for the output array.
+    :param tuple z_range: Only for 3-d arrays. Start and end of the output slices to
+        compute, e.g., (10, 20) returns resized[10:20]. Only the slices in original
+        needed to sample them are read so original can be any array-like that supports
+        slicing in its first axis (e.g., a LazyVolume). None computes all slices.
 
     :return: Output array (np.float32) resampled to the desired resolution. Size in pixels
         is round(um_sizes / desired_res).
     """
     import torch.nn.functional as F
 
-    # Create grid to sample in microns
-    grid = create_grid(um_sizes, desired_res) # d x h x w x 3
+    if z_range is None:
+        # Create grid to sample in microns
+        grid = create_grid(um_sizes, desired_res) # d x h x w x 3
+    else:
+        # Create grid for the requested slices only
+        desired_res = (desired_res, ) * 3 if np.isscalar(desired_res) else desired_res
+        zs = create_grid(um_sizes[:1], desired_res[:1])[z_range[0]: z_range[1], 0]
+        yx_grid = create_grid(um_sizes[1:], desired_res[1:]) # h x w x 2
+        grid = np.empty((len(zs), *yx_grid.shape[:2], 3), dtype=np.float32)
+        grid[..., :2] = yx_grid
+        grid[..., 2] = zs[:, np.newaxis, np.newaxis]
 
     # Re-express as a torch grid [-1, 1]
     um_per_px = np.array([um / px for um, px in zip(um_sizes, original.shape)])
     torch_ones = np.array(um_sizes) / 2 - um_per_px / 2  # sample position of last pixel in original
     grid = grid / torch_ones[::-1].astype(np.float32)
 
+    if z_range is not None:
+        # Crop original to the slices used for interpolation and re-express z in [-1, 1]
+        # of the cropped array (grid_sample's default align_corners=False, border padding)
+        depth = len(original)
+        z_idxs = np.clip(((grid[:, 0, 0, 2].astype(np.float64) + 1) * depth - 1) / 2, 0,
+                         depth - 1)
+        start = int(np.floor(z_idxs.min()))
+        end = min(int(np.floor(z_idxs.max())) + 2, depth)
+        grid[..., 2] = ((2 * (z_idxs - start) + 1) / (end - start) - 1)[:, np.newaxis,
+                                                                        np.newaxis]
+        original = np.asarray(original[start: end])
+
     # Resample
     input_tensor = torch.from_numpy(original.reshape(1, 1, *original.shape).astype(
         np.float32))
     grid_tensor = torch.from_numpy(grid.reshape(1, *grid.shape))
     resized_tensor = F.grid_sample(input_tensor, grid_tensor, padding_mode='border')
     resized = resized_tensor.numpy().squeeze()
+    if z_range is not None:
+        resized = resized.reshape(grid.shape[:-1])  # keep z even if there is one slice
 
     return resized
 
@@ -78,3 +105,45 @@ def affine_product(X, A, b):
     :return: A (d1 x d2 x 3) torch.Tensor corresponding to the transformed coordinates.
     """
     return torch.einsum('ij,klj->kli', (A, X)) + b
+
+
+def sample_affine_grid(image, grid, query_xs, query_ys, order=1):
+    """ Sample an image at arbitrary points given the position of each of its pixels.
+
+    The pixel positions (grid) should be an affine transformation of the pixel indices,
+    e.g., a field registered to a stack with an affine. The affine is fitted from the grid
+    and inverted so each query point is mapped back to (fractional) image indices and
+    sampled with map_coordinates.
+
+    :param np.array image: 2-d array (h x w) to sample.
+    :param np.array grid: Array (h x w x 2) with the (x, y) position of each pixel in the
+        image.
+    :param np.array query_xs: x positions (same space as grid) to sample.
+    :param np.array query_ys: y positions (same space as grid) to sample.
+    :param int order: Order of the spline interpolation (1 for linear).
+
+    :return: Array (same shape as query_xs) with the sampled values; 0 outside the image.
+    """
+    from scipy import ndimage
+
+    # Fit affine: (x, y) = A (col, row) + b
+    rows, cols = np.meshgrid(np.arange(image.shape[0]), np.arange(image.shape[1]),
+                             indexing='ij')
+    design = np.stack([cols.ravel(), rows.ravel(), np.ones(cols.size)], axis=-1)
+    params = np.linalg.lstsq(design, grid.reshape(-1, 2).astype(np.float64), rcond=None)[0]
+    A, b = params[:2].T, params[2]
+
+    # Map query points to image indices
+    query_points = np.stack([np.ravel(query_xs), np.ravel(query_ys)]) - b[:, None]
+    query_cols, query_rows = np.linalg.solve(A, query_points)
+
+    # Sample (points outside the image, up to numerical error, are zero)
+    sampled = ndimage.map_coordinates(image.astype(np.float64), [query_rows, query_cols],
+                                      order=order, mode='nearest')
+    eps = 1e-3  # pixels
+    is_inside = np.logical_and.reduce([query_rows > -eps, query_cols > -eps,
+                                       query_rows < image.shape[0] - 1 + eps,
+                                       query_cols < image.shape[1] - 1 + eps])
+    sampled[~is_inside] = 0
+
+    return sampled.reshape(np.shape(query_xs))
@@ -1,15 +1,215 @@
 """ Code to perform  3d stack segmentations. """
-from bl3d import models, utils
 import torch
 import numpy as np
 from os import path
+import itertools
 
 
 #torch.backends.cudnn.benchmark=True # time efficient but memory inefficient
 
 
+class SegmentationEngine():
+    """ Runs an ensemble of QCANet models over big stacks.
+
+    By default, each model segments the entire volume at once (with the model's own
+    forward_on_big_input if available), as segment() originally did. With tiled=True,
+    the volume is processed in overlapping tiles: each tile (plus a halo of context that
+    is later discarded) is passed through all models before moving to the next one and
+    probabilities of overlapping tiles are blended with gaussian weights. Tiling bounds
+    memory but recomputes the halos (it is ~2.5x slower on CPU), so only use it for
+    stacks that do not fit in memory. Loaded models are cached per process so creating
+    more engines does not reload them from disk.
+
+    Tiled output only matches whole-volume inference if the halo is at least the
+    receptive field radius of the models and inputs are aligned with their pooling grid
+    (pooling_stride: product of the strides of all pooling layers).
+
+    :param list model_names: Filenames of the models (in data_path) to ensemble.
+    :param string data_path: Folder with the saved models.
+    :param list nets: Already loaded models. If given, model_names is ignored. Each net
+        receives a 1 x 1 x D x H x W tensor and returns (detection, segmentation) logits.
+    :param string device: 'cuda' or 'cpu'. Defaults to cuda if available.
+    :param bool tiled: Whether to use tiled inference.
+    :param tuple tile_shape: Size (d, h, w) of the output region of each tile. If None,
+        it is computed to respect max_memory_in_GB.
+    :param tuple overlap: Overlap between neighboring tiles (blended with gaussians).
+    :param tuple halo: Context added to each side of the tile and dropped after
+        inference. Should be at least the receptive field radius of the models.
+    :param tuple pooling_stride: Input tiles start (and end, unless at the border of the
+        volume) at multiples of this stride.
+    :param float max_memory_in_GB: Maximum memory to use (full-size outputs plus tiles).
+    :param int bytes_per_voxel: Approximate memory used by the network (activations) per
+        input voxel. Used to size tiles.
+    :param int num_threads: Number of threads used by torch in the CPU.
+    :param bool quantize: Apply dynamic int8 quantization (CPU only). Only layers
+        supported by torch's dynamic quantization are quantized.
+    :param bool channels_last: Use channels-last (NDHWC) memory format (CPU only).
+    """
+    _loaded_models = {}  # cache of loaded models: (filename, device, options) -> net
+
+    def __init__(self, model_names=('bestndn_1-9-17026.pth', ),
+                 data_path='/data/pipeline/python/pipeline/data/', nets=None, device=None,
+                 tiled=False, tile_shape=None, overlap=(16, 32, 32), halo=(32, 32, 32),
+                 pooling_stride=(8, 8, 8), max_memory_in_GB=8, bytes_per_voxel=2048, num_threads=None,
+                 quantize=False, channels_last=False):
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else
+                                              'cpu'))
+        self.is_cpu = self.device.type == 'cpu'
+        self.tiled = tiled
+        self.tile_shape = tile_shape
+        self.overlap = np.array(overlap)
+        self.halo = np.array(halo)
+        self.pooling_stride = np.array(pooling_stride)
+        self.max_memory_in_GB = max_memory_in_GB
+        self.bytes_per_voxel = bytes_per_voxel
+        self.quantize = quantize and self.is_cpu
+        self.channels_last = channels_last and self.is_cpu
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        if nets is None:
+            nets = [self._load_model(path.join(data_path, name)) for name in model_names]
+        else:
+            nets = [self._prepare_model(net) for net in nets]
+        self.nets = nets
+
+    def _prepare_model(self, net):
+        net.eval()
+        net.to(self.device)
+        if self.quantize:
+            net = torch.quantization.quantize_dynamic(net, dtype=torch.qint8)
+        if self.channels_last:
+            net = net.to(memory_format=torch.channels_last_3d)
+        return net
+
+    def _load_model(self, filename):
+        """ Load model from file (or from the cache if already loaded)."""
+        from bl3d import models
+
+        cache_key = (filename, str(self.device), self.quantize, self.channels_last)
+        if cache_key not in SegmentationEngine._loaded_models:
+            net = models.QCANet()
+            net.load_state_dict(torch.load(filename, map_location=self.device))
+            SegmentationEngine._loaded_models[cache_key] = self._prepare_model(net)
+        return SegmentationEngine._loaded_models[cache_key]
+
+    def _compute_tile_shape(self, volume_shape):
+        """ Biggest tile (halving its largest side) that fits in max_memory_in_GB."""
+        volume_shape = np.array(volume_shape)
+        if self.tile_shape is not None:
+            return np.minimum(self.tile_shape, volume_shape)
+
+        # Input volume and three full-size outputs (detection, segmentation and weights)
+        available_bytes = self.max_memory_in_GB * 1024 ** 3 - 16 * np.prod(volume_shape)
+        min_shape = np.minimum(2 * self.overlap + 1, volume_shape)
+        tile_shape = volume_shape.copy()
+        while (np.prod(tile_shape + 2 * self.halo) * self.bytes_per_voxel > available_bytes
+               and np.any(tile_shape > min_shape)):
+            largest_axis = np.argmax(tile_shape - min_shape)
+            tile_shape[largest_axis] = max(tile_shape[largest_axis] // 2,
+                                           min_shape[largest_axis])
+        if np.prod(tile_shape + 2 * self.halo) * self.bytes_per_voxel > available_bytes:
+            print('Warning: Segmentation may not fit in {} GB. Using smallest possible '
+                  'tile.'.format(self.max_memory_in_GB))
+
+        return tile_shape
+
+    def _forward(self, input_, big_input=False):
+        """ Average detection and segmentation probabilities of all models.
+
+        :param bool big_input: Whether to use the models' forward_on_big_input (if they
+            have one) rather than a single forward pass.
+        """
+        tensor = torch.as_tensor(input_[np.newaxis, np.newaxis]).to(self.device)
+        if self.channels_last:
+            tensor = tensor.contiguous(memory_format=torch.channels_last_3d)
+
+        detection_sum = np.zeros(input_.shape, dtype=np.float32)
+        segmentation_sum = np.zeros(input_.shape, dtype=np.float32)
+        for net in self.nets:
+            forward = getattr(net, 'forward_on_big_input', net) if big_input else net
+            detection, segmentation = forward(tensor)
+            detection_sum += torch.sigmoid(detection)[0, 0].cpu().numpy()
+            segmentation_sum += torch.sigmoid(segmentation)[0, 0].cpu().numpy()
+
+        return detection_sum / len(self.nets), segmentation_sum / len(self.nets)
+
+    def predict(self, volume):
+        """ Voxel-wise centroid and cell probabilities for the entire volume.
+
+        :param np.array volume: 3-d array (normalized stack).
+
+        :returns: detection, segmentation. Arrays of the same shape as volume (np.float32).
+        """
+        volume = volume.astype(np.float32, copy=False)
+        if not self.tiled:
+            with getattr(torch, 'inference_mode', torch.no_grad)():
+                return self._forward(volume, big_input=True)
+
+        tile_shape = self._compute_tile_shape(volume.shape)
+        weights = _gaussian_weights(tile_shape)
+
+        detection = np.zeros(volume.shape, dtype=np.float32)
+        segmentation = np.zeros(volume.shape, dtype=np.float32)
+        weight_sum = np.zeros(volume.shape, dtype=np.float32)
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            for tile, input_tile, crop in _tiles(volume.shape, tile_shape, self.overlap,
+                                                 self.halo, self.pooling_stride):
+                tile_detection, tile_segmentation = self._forward(
+                    np.ascontiguousarray(volume[input_tile]))
+                detection[tile] += weights * tile_detection[crop]
+                segmentation[tile] += weights * tile_segmentation[crop]
+                weight_sum[tile] += weights
+        detection /= weight_sum
+        segmentation /= weight_sum
+
+        return detection, segmentation
+
+
+def _gaussian_weights(shape, sigma_fraction=1 / 4, min_weight=1e-3):
+    """ Separable gaussian centered in the tile (sigma is a fraction of the tile size)."""
+    weights = np.ones(shape, dtype=np.float32)
+    for axis, size in enumerate(shape):
+        coords = np.arange(size) - (size - 1) / 2
+        axis_weights = np.exp(-coords ** 2 / (2 * (sigma_fraction * size) ** 2))
+        weights *= axis_weights.reshape([-1 if i == axis else 1 for i in
+                                         range(len(shape))]).astype(np.float32)
+    return np.maximum(weights, min_weight)
+
+
+def _tiles(volume_shape, tile_shape, overlap, halo, stride=(1, 1, 1)):
+    """ Generate tiles covering the entire volume.
+
+    Input tiles are extended to start (and end, unless at the end of the volume) at
+    multiples of stride so they are aligned with the pooling grid of the whole volume.
+
+    :returns: Generator of (tile, input_tile, crop) tuples of slices. tile is the output
+        region in the volume, input_tile is the region with halo (clipped to the volume)
+        and crop is the region of the tile inside the input tile.
+    """
+    starts_per_axis = []
+    for size, tile_size, axis_overlap in zip(volume_shape, tile_shape, overlap):
+        step = max(tile_size - axis_overlap, 1)
+        starts = list(range(0, size - tile_size + 1, step))
+        if starts[-1] != size - tile_size:
+            starts.append(size - tile_size)
+        starts_per_axis.append(starts)
+
+    for starts in itertools.product(*starts_per_axis):
+        tile, input_tile, crop = [], [], []
+        for start, tile_size, axis_halo, axis_stride, size in zip(starts, tile_shape, halo,
+                                                                  stride, volume_shape):
+            input_start = max(start - axis_halo, 0) // axis_stride * axis_stride
+            input_end = min(-(-(start + tile_size + axis_halo) // axis_stride) * axis_stride,
+                            size)
+            tile.append(slice(start, start + tile_size))
+            input_tile.append(slice(input_start, input_end))
+            crop.append(slice(start - input_start, start - input_start + tile_size))
+        yield tuple(tile), tuple(input_tile), tuple(crop)
+
+
 def segment(stack, method='ensemble', pad_mode='reflect', seg_threshold=0.8,
-            min_voxels=65, max_voxels=4168, compactness_factor=0.05):
+            min_voxels=65, max_voxels=4168, compactness_factor=0.05, **engine_kwargs):
     """ Utility function to segment a 3-d stack
 
     :param stack: 3-d array. Raw Stack resampled to 1 mm^3.
@@ -21,48 +221,34 @@ def segment(stack, method='ensemble', pad_mode='reflect', seg_threshold=0.8,
     :param max_voxels: Maximum number of voxels in a valid object.
     :param compactness_factor: Weight for the compactness objective during instance
         segmentation.
+    :param engine_kwargs: Extra arguments passed to SegmentationEngine, e.g., num_threads
+        or tiled=True and max_memory_in_GB for stacks that do not fit in memory.
 
     :return: detection, segmentation, instance. Arrays of the same shape as stack:
         voxel-wise centroid probability (np.float32), voxel-wise cell probability
         (np.float32) and instance segmentation (np.int32).
     """
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    if device.type == 'cpu':
-        print('Running 3-d segmentation in the CPU will take more time.')
-
-    # Prepare input
-    padded = np.pad(stack, 20, mode=pad_mode)
-    lcned= utils.lcn(padded, (3, 25, 25))
-    norm = (lcned - lcned.mean()) / lcned.std()
-    input_ = torch.as_tensor(norm[np.newaxis, np.newaxis, ...])  # 1 x 1 x D x H x W
-    del padded, lcned, norm # release memory
+    from bl3d import utils
 
     # Declare models
-    net = models.QCANet()
-    data_path = '/data/pipeline/python/pipeline/data/'
     if method == 'single':
         model_names = ['bestndn_1-9-17026.pth']
     else:
         model_names = ['bestndn_1-9-17026.pth', 'bestndn_1-17-17206.pth',
                        'bestndn_1-3-17259.pth', 'bestndn_1-8-17261.pth']  # we'll ensemble all of these
+    engine = SegmentationEngine(model_names, **engine_kwargs)
+    if engine.is_cpu:
+        print('Running 3-d segmentation in the CPU will take more time.')
+
+    # Prepare input
+    padded = np.pad(stack, 20, mode=pad_mode)
+    lcned= utils.lcn(padded, (3, 25, 25))
+    norm = ((lcned - lcned.mean()) / lcned.std()).astype(np.float32)
+    del padded, lcned # release memory
 
     # Create detection and segmentation probabilities
-    detection_sum = np.empty(input_.shape[-3:], dtype=np.float32)
-    segmentation_sum = np.empty(input_.shape[-3:], dtype=np.float32)
-    with torch.no_grad():
-        for model_name in model_names:
-            # Import model from file
-            net.load_state_dict(torch.load(path.join(data_path, model_name)))
-            net.eval()
-            net.to(device)
-
-            # Segment
-            detection, segmentation = net.forward_on_big_input(input_)
-            detection_sum += torch.sigmoid(detection).squeeze().numpy()
-            segmentation_sum += torch.sigmoid(segmentation).squeeze().numpy()
-        detection = detection_sum / len(model_names)
-        segmentation = segmentation_sum / len(model_names)
-    del input_, detection_sum, segmentation_sum # release memory
+    detection, segmentation = engine.predict(norm)
+    del norm # release memory
 
     # Drop padding (added above)
     detection = detection[20:-20, 20:-20, 20:-20]
@@ -73,4 +259,55 @@ def segment(stack, method='ensemble', pad_mode='reflect', seg_threshold=0.8,
                                  min_voxels=min_voxels, max_voxels=max_voxels,
                                  compactness_factor=compactness_factor)
 
-    return detection, segmentation, instance
\ No newline at end of file
+    return detection, segmentation, instance
+
+
+def field_unit_properties(instance, segmented_field, grid, stack_center):
+    """ Size and centroids of the stack units that appear in a registered field.
+
+    All units are computed at once: one regionprops pass per image, centroids of all
+    2-d masks with a single center_of_mass call and one map_coordinates per grid axis.
+
+    :param np.array instance: 3-d instance segmentation of the stack (np.int).
+    :param np.array segmented_field: 2-d array with the stack unit ids sampled at each
+        position of the field.
+    :param np.array grid: Field grid (height x width x 3) with the (x, y, z) position in
+        the motor coordinate system of each pixel in the field.
+    :param np.array stack_center: (z, y, x) center of the stack in motor coordinates.
+
+    :returns: List of dicts (one per unit in the field; ordered by sunit_id) with the
+        attributes of stack.FieldSegmentation.StackUnit.
+    """
+    from skimage import measure
+    from scipy import ndimage
+
+    # Get 3-d properties of all stack units
+    instance_props = {prop.label: prop for prop in measure.regionprops(instance)}
+
+    # Get 2-d masks in the field
+    field_props = measure.regionprops(segmented_field)
+    sunit_ids = np.array([prop.label for prop in field_props])
+    if len(sunit_ids) == 0:
+        return []
+    px_centroids = np.array(ndimage.center_of_mass(segmented_field > 0, segmented_field,
+                                                   index=sunit_ids))  # num_units x 2
+    mask_xs, mask_ys, mask_zs = [ndimage.map_coordinates(grid[..., i], px_centroids.T,
+                                                         order=1) for i in range(3)]
+
+    units = []
+    for field_prop, mask_z, mask_y, mask_x in zip(field_props, mask_zs, mask_ys, mask_xs):
+        instance_prop = instance_props[field_prop.label]
+        sunit_z, sunit_y, sunit_x = (stack_center + np.array(instance_prop.centroid) -
+                                     np.array(instance.shape) / 2 + 0.5)
+        distance = np.sqrt((sunit_z - mask_z) ** 2 + (sunit_y - mask_y) ** 2 +
+                           (sunit_x - mask_x) ** 2)
+        units.append({'sunit_id': field_prop.label,
+                      'depth': instance_prop.bbox[3] - instance_prop.bbox[0],
+                      'height': instance_prop.bbox[4] - instance_prop.bbox[1],
+                      'width': instance_prop.bbox[5] - instance_prop.bbox[2],
+                      'volume': instance_prop.area, 'area': field_prop.area,
+                      'sunit_z': sunit_z, 'sunit_y': sunit_y, 'sunit_x': sunit_x,
+                      'mask_z': mask_z, 'mask_y': mask_y, 'mask_x': mask_x,
+                      'distance': distance})
+
+    return units
@@ -1,6 +1,9 @@
 import numpy as np
 
 
+FFT_MIN_FILTER_SIZE = 256  # mirrconv uses FFTs for filters at least this long
+
+
 def notnan(x, start=0, increment=1):
     while np.isnan(x[start]) and 0 <= start < len(x):
         start += increment
@@ -18,27 +21,73 @@ def fill_nans(x):
     return x
 
 
+def fill_time_gaps(times, period):
+    """ Replace each gap of NaNs in a sequence of (roughly) periodic times with the
+    number of timepoints that fit in it given the period, linearly spaced.
+
+    :param np.array times: 1-d array of times with NaN gaps. First and last times must not
+        be NaN.
+    :param float period: Expected time between consecutive timepoints.
+
+    :returns: Array of times without NaNs. It could have a different length than times if
+        gaps have more (or less) missing timepoints than NaNs.
+    """
+    valid_idx = np.where(~np.isnan(times))[0]
+    valid_times = times[valid_idx]
+
+    # Count missing points after each valid time (only those before a gap)
+    intervals = np.diff(valid_times)
+    is_gap = np.diff(valid_idx) > 1
+    num_missing = np.where(is_gap, np.round(intervals / period - 1), 0).astype(int)
+
+    # Place valid times after the missing points and interpolate the missing ones
+    positions = np.arange(len(valid_times)) + np.concatenate([[0], np.cumsum(num_missing)])
+    return np.interp(np.arange(positions[-1] + 1), positions, valid_times)
+
+
 def normalize(img):
     return (img - img.min()) / (img.max() - img.min())
 
 
-def mirrconv(signal, f):
+def _mirror_pad(signal, n):
+    """ Pad n samples at each end of signal, mirrored (without repeating the edges)."""
+    return np.hstack((signal[n - 1::-1], signal, signal[:-n - 1:-1]))
+
+
+def mirrconv(signal, f, method='auto'):
     """ Convolution with mirrored ends to avoid edge artifacts.
 
     :param np.array signal: One-dimensional signal.
     :param np.array f: One-dimensional filter (length should be odd).
+    :param string method: 'direct' (np.convolve), 'fft' (overlap-add FFT convolution) or
+        'auto' to use FFTs for long filters. In the FFT path, outputs whose window contains
+        NaNs are set to NaN (as in direct convolution).
     :returns: Filtered signal (same length as signal)
     """
     if signal.ndim != 1 or f.ndim != 1:
        raise ValueError('Only one-dimensional signals allowed.')
     if len(f) % 2 != 1:
         raise ValueError('Filter must have odd length')
+    if method not in ['auto', 'direct', 'fft']:
+        raise ValueError('Unknown method {}'.format(method))
     if len(f) < 3:
         return signal
 
     n = len(f) // 2
-    padded_signal = np.hstack((signal[n - 1::-1], signal, signal[:-n - 1:-1]))
-    filtered_signal = np.convolve(padded_signal, f, mode='valid')
+    padded_signal = _mirror_pad(signal, n)
+    if method == 'direct' or (method == 'auto' and len(f) < FFT_MIN_FILTER_SIZE):
+        filtered_signal = np.convolve(padded_signal, f, mode='valid')
+    else:
+        from scipy.signal import oaconvolve
+
+        nans = np.isnan(padded_signal)
+        if np.any(nans):
+            padded_signal = np.where(nans, 0, padded_signal)
+        filtered_signal = oaconvolve(padded_signal, f, mode='valid')
+        if np.any(nans):
+            nan_counts = np.concatenate([[0], np.cumsum(nans)])
+            nans_in_window = nan_counts[len(f):] - nan_counts[:-len(f)]
+            filtered_signal[nans_in_window > 0] = float('nan')
 
     return filtered_signal
 
@@ -67,14 +116,16 @@ def spaced_max(x, min_interval):
     return peaks
 
 
-def low_pass_filter(signal, sampling_freq, cutoff_freq, filter_size=1000):
+def low_pass_filter(signal, sampling_freq, cutoff_freq, filter_size=1000, step=1):
     """ Low pass filter a signal.
 
     :param signal: Signal to filter.
     :param sampling_freq: Signal sampling frequency.
     :param cutoff_freq: Cutoff frequency. Frequencies above this will be filtered out.
     :param filter_size: Size of the filter to use. If even, we use filter_size + 1.
-    :return: Filtered signal (same lenght as signal)
+    :param step: Return only every step-th sample (filtered_signal[::step]). These are
+        computed with a polyphase filter (upfirdn), so the rest are never computed.
+    :return: Filtered signal (same lenght as signal, or signal[::step] if step > 1)
 
     ..seealso: http://www.labbookpages.co.uk/audio/firWindowing.html
     """
@@ -87,6 +138,17 @@ def low_pass_filter(signal, sampling_freq, cutoff_freq, filter_size=1000):
     filter_ /= filter_.sum()
 
     # Filter signal
-    filtered_signal = mirrconv(signal, filter_)
+    if step == 1 or len(filter_) < 3:
+        filtered_signal = mirrconv(signal, filter_)[::step]
+    else:
+        from scipy.signal import upfirdn
+
+        # Filtered sample i is full_convolution(padded_signal)[i + 2 * half_size]; prepend
+        # zeros so the samples we need are at multiples of step
+        num_zeros = -2 * half_size % step
+        padded_signal = np.hstack((np.zeros(num_zeros), _mirror_pad(signal, half_size)))
+        first_sample = (2 * half_size + num_zeros) // step
+        filtered_signal = upfirdn(filter_, padded_signal, down=step)[first_sample:]
+        filtered_signal = filtered_signal[:len(signal[::step])]
 
-    return filtered_signal
\ No newline at end of file
+    return filtered_signal
@@ -0,0 +1,178 @@
+""" Streaming (z-slab) preprocessing of stacks that do not fit in memory. """
+import numpy as np
+from scipy import ndimage
+
+from . import registration, enhancement
+from ..exceptions import PipelineException
+
+
+def filter_radius(sigma, truncate=4.0):
+    """ Radius (in pixels) of scipy.ndimage's gaussian filters; pixels further away than
+    this do not affect the filtered value."""
+    return int(truncate * float(sigma) + 0.5)
+
+
+def get_slab_depth(out_shape, in_shape, halo, max_gb, copies=8):
+    """ Deepest slab that can be resized, lcned and sharpened using at most max_gb.
+
+    Processing a slab needs around copies (float32) copies of the resized slab with its
+    halos (sampling grid, filter outputs and temporaries) plus two copies of the original
+    slices it is sampled from.
+
+    :param tuple out_shape: Shape of the resized stack (depth x height x width).
+    :param tuple in_shape: Shape of the original stack.
+    :param int halo: Number of extra slices needed at each side of the slab.
+    :param float max_gb: Memory cap in GB.
+    :param int copies: Number of full copies of each resized slice needed.
+
+    :returns: Number of slices per slab.
+    """
+    out_plane_bytes = 4 * out_shape[1] * out_shape[2]
+    in_plane_bytes = 4 * in_shape[1] * in_shape[2]
+    in_planes_per_plane = in_shape[0] / out_shape[0]
+    bytes_per_plane = copies * out_plane_bytes + 2 * in_planes_per_plane * in_plane_bytes
+    extra_bytes = 2 * 2 * in_plane_bytes  # interpolation needs a slice at each end
+
+    depth = int((max_gb * 1024 ** 3 - extra_bytes) / bytes_per_plane) - 2 * halo
+    if depth < 1:
+        msg = 'Slices of shape {} need more than {} GB (halo={})'
+        raise PipelineException(msg.format(out_shape[1:], max_gb, halo))
+
+    return min(depth, out_shape[0])
+
+
+def _read(filename, start, end):
+    """ Read volume[start: end] from a .npy file."""
+    volume = np.load(filename, mmap_mode='r')
+    return np.array(volume[start: end])  # copy so file is unmapped when volume is deleted
+
+
+def _write(filename, start, slab):
+    """ Write slab into volume[start: start + len(slab)] in a .npy file."""
+    volume = np.load(filename, mmap_mode='r+')
+    volume[start: start + len(slab)] = slab
+    volume.flush()
+
+
+def percentiles(filename, slabs, q, num_bins=2 ** 16):
+    """ Exact np.percentile (with linear interpolation) of a big volume in a .npy file.
+
+    The volume is read slab by slab: a first pass counts values in a histogram to find
+    the bin that contains each needed order statistic and a second pass gathers the
+    values in those bins to select them exactly.
+
+    :param string filename: .npy file with the volume.
+    :param list slabs: (start, end) tuples that cover the depth of the volume.
+    :param list q: Percentiles to compute (0-100).
+    :param int num_bins: Number of bins in the histogram.
+
+    :returns: Array with the percentiles (same dtype as the volume).
+    """
+    volume = np.load(filename, mmap_mode='r')
+    num_values, dtype = volume.size, volume.dtype
+    del volume
+
+    minima, maxima = zip(*[(slab.min(), slab.max()) for slab in
+                           (_read(filename, *s) for s in slabs)])
+    min_value, max_value = min(minima), max(maxima)
+    if min_value == max_value:
+        return np.full(len(q), min_value, dtype=dtype)
+
+    # Rank of the values needed for each percentile
+    positions = np.asarray(q, dtype=np.float64) / 100 * (num_values - 1)
+    ranks = np.unique(np.concatenate([np.floor(positions), np.ceil(positions)])).astype(
+        np.int64)
+
+    # Find their bins
+    scale = num_bins / (float(max_value) - float(min_value))
+    to_bins = lambda values: np.clip(((values.astype(np.float64) - float(min_value)) *
+                                      scale).astype(np.int64), 0, num_bins - 1).ravel()
+    counts = sum(np.bincount(to_bins(_read(filename, *s)), minlength=num_bins)
+                 for s in slabs)
+    cum_counts = np.cumsum(counts)
+    rank_bins = np.searchsorted(cum_counts, ranks, side='right')
+
+    # Gather values in those bins and select the ranks
+    in_bins = [[] for _ in ranks]
+    for s in slabs:
+        slab = _read(filename, *s).ravel()
+        slab_bins = to_bins(slab)
+        for values, bin_ in zip(in_bins, rank_bins):
+            values.append(slab[slab_bins == bin_])
+    previous_counts = np.concatenate([[0], cum_counts])[rank_bins]
+    values = {rank: np.partition(np.concatenate(values), rank - previous)[rank - previous]
+              for rank, values, previous in zip(ranks, in_bins, previous_counts)}
+
+    lower = np.array([values[rank] for rank in np.floor(positions).astype(np.int64)])
+    upper = np.array([values[rank] for rank in np.ceil(positions).astype(np.int64)])
+    return (lower + (positions - np.floor(positions)) * (upper - lower)).astype(dtype)
+
+
+def preprocess_stack(original, um_sizes, filenames, max_gb=8, lcn_sigmas=(3, 25, 25),
+                     laplace_sigma=1, low_percentile=3, high_percentile=99.9):
+    """ Resize a stack to 1 um^3, apply local contrast normalization and sharpen it slab
+    by slab using at most max_gb of memory.
+
+    Results match (up to float rounding of the resizing at slab boundaries):
+        resized = registration.resize(original, um_sizes, desired_res=1)
+        lcned = enhancement.lcn(resized, lcn_sigmas)
+        sharpened = enhancement.sharpen_2pimage(lcned, laplace_sigma, low_percentile,
+                                                high_percentile)
+    Each slab is resized with enough slices at each side (halo) to compute the gaussian
+    filters in it exactly and results are written to .npy files. Percentiles and
+    normalization for the sharpened stack are computed in extra passes over its file.
+
+    :param original: Stack (depth x height x width) in any array-like that can be sliced
+        in z, e.g., a LazyVolume; only the slices needed for each slab are read.
+    :param tuple um_sizes: Size in microns of the stack (depth, height, width).
+    :param tuple filenames: Filenames (.npy) for the resized, lcned and sharpened stacks.
+    :param float max_gb: Memory cap (in GB) for the processing of each slab.
+    :param tuple lcn_sigmas: Sigmas for the local contrast normalization.
+    :param float laplace_sigma: Sigma of the laplace filter used for sharpening.
+    :param float low_percentile, high_percentile: Percentiles at which to clip the
+        sharpened stack.
+
+    :returns: Resized, lcned and sharpened stacks as read-only np.memmap.
+    """
+    resized_file, lcned_file, sharpened_file = filenames
+    out_shape = tuple(int(round(um)) for um in um_sizes)  # as in registration.create_grid
+    depth = out_shape[0]
+    for filename in filenames:
+        np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=out_shape)
+
+    # Get slabs
+    laplace_halo = filter_radius(laplace_sigma)
+    halo = filter_radius(lcn_sigmas[0]) + laplace_halo  # resized slices needed at each side
+    slab_depth = get_slab_depth(out_shape, original.shape, halo, max_gb)
+    slabs = [(start, min(start + slab_depth, depth)) for start in range(0, depth,
+                                                                         slab_depth)]
+
+    for start, end in slabs:
+        # Resize
+        resized_start, resized_end = max(0, start - halo), min(depth, end + halo)
+        resized = registration.resize(original, um_sizes, desired_res=1,
+                                      z_range=(resized_start, resized_end))
+        _write(resized_file, start, resized[start - resized_start: end - resized_start])
+
+        # Enhance
+        lcned_start, lcned_end = max(0, start - laplace_halo), min(depth, end + laplace_halo)
+        lcned = enhancement.lcn(resized, lcn_sigmas)[lcned_start - resized_start:
+                                                     lcned_end - resized_start]
+        del resized
+        _write(lcned_file, start, lcned[start - lcned_start: end - lcned_start])
+
+        # Sharpen (as in enhancement.sharpen_2pimage before clipping)
+        sharpened = lcned - ndimage.gaussian_laplace(lcned, laplace_sigma)
+        _write(sharpened_file, start, sharpened[start - lcned_start: end - lcned_start])
+        del lcned, sharpened
+
+    # Clip and normalize sharpened stack
+    low, high = percentiles(sharpened_file, slabs, [low_percentile, high_percentile])
+    clipped_sum = sum(np.clip(_read(sharpened_file, *s), low, high).sum(dtype=np.float64)
+                      for s in slabs)
+    mean = np.float32(clipped_sum / np.prod(out_shape))
+    for start, end in slabs:
+        clipped = np.clip(_read(sharpened_file, start, end), low, high)
+        _write(sharpened_file, start, (clipped - mean) / (high - low + 1e-7))
+
+    return tuple(np.load(filename, mmap_mode='r') for filename in filenames)
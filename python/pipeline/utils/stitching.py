@@ -1,4 +1,5 @@
 import numpy as np
+import itertools
 from scipy import signal
 from scipy.ndimage import interpolation
 from pipeline.utils import galvo_corrections
@@ -53,7 +54,7 @@ class StitchedSlice():
         # Taper sides for smoother blending
         if smooth_blend:
             overlap = (self.width + other.width) - output_width
-            taper = signal.hann(2 * overlap)[:overlap]
+            taper = signal.windows.hann(2 * overlap)[:overlap]
 
             if self.x + self.width / 2 > x + other.width / 2:  # other | self
                 self.mask[..., :overlap] *= taper
@@ -62,29 +63,20 @@ class StitchedSlice():
                 other.mask[..., :overlap] *= taper
                 self.mask[..., -overlap:] *= (1 - taper)
 
-        # Initialize empty (big) slices
-        mask1 = np.zeros([output_height, output_width], dtype=np.float32)
-        slice1 = np.zeros([output_height, output_width], dtype=self.dtype)
-        mask1[:self.height, :self.width] = self.mask
-        slice1[:self.height, :self.width] = self.slice
-
-        mask2 = np.zeros([output_height, output_width], dtype=np.float32)
-        slice2 = np.zeros([output_height, output_width], dtype=other.dtype)
-        mask2[:other.height, :other.width] = other.mask
-        slice2[:other.height, :other.width] = other.slice
-
-        # Move rois to their final position
-        delta1 = (self.y - self.height / 2) - y_min, (self.x - self.width / 2) - x_min
-        mask1 = interpolation.shift(mask1, delta1, order=1)
-        slice1 = interpolation.shift(slice1, delta1, order=1)
-
-        delta2 = (y - other.height / 2) - y_min, (x - other.width / 2) - x_min
-        mask2 = interpolation.shift(mask2, delta2, order=1)
-        slice2 = interpolation.shift(slice2, delta2, order=1)
+        # Place each roi in its final position (integer offset plus subpixel shift)
+        mask = np.zeros([output_height, output_width], dtype=np.float32)
+        slice_ = np.zeros([output_height, output_width], dtype=np.result_type(
+            self.dtype, other.dtype, np.float32))
+        for roi, roi_x, roi_y in [(self, self.x, self.y), (other, x, y)]:
+            delta = (roi_y - roi.height / 2) - y_min, (roi_x - roi.width / 2) - x_min
+            (ys, xs), roi_mask, roi_slice = _shift_into_canvas(roi.mask, roi.slice, delta,
+                                                               mask.shape)
+            mask[ys, xs] += roi_mask
+            slice_[ys, xs] += roi_slice * roi_mask
 
         # Blend (mask act as weights and normalization needed for them to sum to 1)
-        self.mask = mask1 + mask2
-        self.slice = slice1 * mask1 + slice2 * mask2
+        self.mask = mask
+        self.slice = slice_
         self.slice[self.mask > 1e-7] /= self.mask[self.mask > 1e-7]
 
         # Bookkeeping: Update coordinates
@@ -92,6 +84,37 @@ class StitchedSlice():
         self.y = y_min + output_height / 2
 
 
+def _shift_into_canvas(mask, slice_, delta, canvas_shape):
+    """ Shift mask and slice by delta (y, x) in a canvas of canvas_shape.
+
+    Equivalent to zero-padding mask and slice to canvas_shape and calling
+    interpolation.shift(..., delta, order=1) on them but we only interpolate the region
+    that the shifted roi covers (and skip it if the shift is an integer).
+
+    :returns: ((ys, xs), mask, slice). Region of the canvas covered by the roi and shifted
+        mask and slice to be placed in there.
+    """
+    int_delta = [int(np.floor(d)) for d in delta]
+    frac_delta = [d - i for d, i in zip(delta, int_delta)]
+
+    if any(abs(d) > 0 for d in frac_delta):
+        # Pad with one zero row and column to interpolate the trailing edge
+        padded_mask = np.zeros([mask.shape[0] + 1, mask.shape[1] + 1], dtype=np.float32)
+        padded_slice = np.zeros(padded_mask.shape, dtype=slice_.dtype)
+        padded_mask[:-1, :-1] = mask
+        padded_slice[:-1, :-1] = slice_
+        mask = interpolation.shift(padded_mask, frac_delta, order=1)
+        slice_ = interpolation.shift(padded_slice, frac_delta, order=1)
+
+    # Crop to the canvas
+    height = min(mask.shape[0], canvas_shape[0] - int_delta[0])
+    width = min(mask.shape[1], canvas_shape[1] - int_delta[1])
+    region = (slice(int_delta[0], int_delta[0] + height),
+              slice(int_delta[1], int_delta[1] + width))
+
+    return region, mask[:height, :width], slice_[:height, :width]
+
+
 class ROICoordinates():
     """ Simple class to hold ROI id and coordinates. """
     def __init__(self, id_, xs, ys):
@@ -114,18 +137,28 @@ class StitchedROI():
         self.z = z
         self.dtype = dtype
         self.roi_coordinates = [ROICoordinates(id_, xs, ys)]  # bookkeeping
+        self._cached_extent = None
+
+    @property
+    def _extent(self):
+        """ (y_min, y_max, x_min, x_max) of the volume. Cached until slices are moved."""
+        if self._cached_extent is None:
+            y_min = min([slice_.y - slice_.height / 2 for slice_ in self.slices])
+            y_max = max([slice_.y + slice_.height / 2 for slice_ in self.slices])
+            x_min = min([slice_.x - slice_.width / 2 for slice_ in self.slices])
+            x_max = max([slice_.x + slice_.width / 2 for slice_ in self.slices])
+            self._cached_extent = (y_min, y_max, x_min, x_max)
+        return self._cached_extent
 
     @property
     def height(self):
-        y_min = min([slice_.y - slice_.height / 2 for slice_ in self.slices])
-        y_max = max([slice_.y + slice_.height / 2 for slice_ in self.slices])
+        y_min, y_max, _, _ = self._extent
         y_max = y_max - (y_max - y_min) % 1 + 1 # Round up to an integer value
         return int(round(y_max - y_min))
 
     @property
     def width(self):
-        x_min = min([slice_.x - slice_.width / 2 for slice_ in self.slices])
-        x_max = max([slice_.x + slice_.width / 2 for slice_ in self.slices])
+        _, _, x_min, x_max = self._extent
         x_max = x_max - (x_max - x_min) % 1 + 1 # Round up to an integer value
         return int(round(x_max - x_min))
 
@@ -135,19 +168,18 @@ class StitchedROI():
 
     @property
     def x(self):
-        x_min = min([slice_.x - slice_.width / 2 for slice_ in self.slices])
+        x_min = self._extent[2]
         return x_min + self.width / 2
 
     @property
     def y(self):
-        y_min = min([slice_.y - slice_.height / 2 for slice_ in self.slices])
+        y_min = self._extent[0]
         return y_min + self.height / 2
 
     @property
     def volume(self):
         """ Collects all slices into a single 3-d volume."""
-        x_min = min([slice_.x - slice_.width / 2 for slice_ in self.slices])
-        y_min = min([slice_.y - slice_.height / 2 for slice_ in self.slices])
+        y_min, _, x_min, _ = self._extent
 
         # Move each slice to the right position
         volume = np.zeros([self.depth, self.height, self.width], dtype=self.dtype)
@@ -197,6 +229,7 @@ class StitchedROI():
             slice_.rot90()
         for roi_coord in self.roi_coordinates:
             roi_coord.rot90()
+        self._cached_extent = None
 
     def rot270(self):
         """ Inverse of rot90. """
@@ -225,6 +258,67 @@ class StitchedROI():
 
         # Update z (rarely different between ROIs)
         self.z = (self.z + other.z) / 2
+        self._cached_extent = None
+
+    def shift_slices(self, y_shifts, x_shifts):
+        """ Move each slice (and the ROIs that form it) by -y_shifts, -x_shifts.
+
+        :param list y_shifts, x_shifts: Shifts per slice (as returned by alignment).
+        """
+        for slice_, y_shift, x_shift in zip(self.slices, y_shifts, x_shifts):
+            slice_.y -= y_shift
+            slice_.x -= x_shift
+        for roi_coord in self.roi_coordinates:
+            roi_coord.ys = [prev_y - y_shift for prev_y, y_shift in zip(roi_coord.ys,
+                                                                        y_shifts)]
+            roi_coord.xs = [prev_x - x_shift for prev_x, x_shift in zip(roi_coord.xs,
+                                                                        x_shifts)]
+        self._cached_extent = None
+
+
+def join_rows(rois, join):
+    """ Join all rois that overlap in the same row.
+
+    Candidate pairs (ROIs that are aside each other) are computed once and kept in a
+    heap; after each join, only pairs involving the joined ROI are recomputed. ROIs are
+    joined in the same order as if we restarted the search over all (sorted) pairs after
+    every join.
+
+    :param list rois: StitchedROI objects.
+    :param function join: Function that receives (left, right) ROIs and joins left into
+        right, e.g., lambda left, right: right.join_with(left, xs, ys).
+
+    :returns: List of StitchedROIs after joining (sorted by x, y).
+    """
+    import heapq
+
+    sorted_rois = sorted(rois, key=lambda roi: (roi.x, roi.y))
+    is_alive = [True] * len(sorted_rois)
+
+    # Build candidate pairs
+    candidates = [(i, j) for i, j in itertools.combinations(range(len(sorted_rois)), 2)
+                  if sorted_rois[i].is_aside_to(sorted_rois[j])]
+    heapq.heapify(candidates)
+
+    while candidates:
+        i, j = heapq.heappop(candidates)
+        if not (is_alive[i] and is_alive[j]):
+            continue
+        left, right = sorted_rois[i], sorted_rois[j]
+        if not left.is_aside_to(right):  # pair went stale after an earlier join
+            continue
+
+        join(left, right)
+        is_alive[i] = False
+
+        # Update candidate pairs that involve the joined roi
+        for k in range(len(sorted_rois)):
+            if k != j and is_alive[k]:
+                pair = (min(j, k), max(j, k))
+                if sorted_rois[pair[0]].is_aside_to(sorted_rois[pair[1]]):
+                    heapq.heappush(candidates, pair)
+
+    return [roi for roi, alive in zip(sorted_rois, is_alive) if alive]
 
 
 
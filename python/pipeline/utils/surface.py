@@ -0,0 +1,156 @@
+""" Utilities to estimate the brain surface from a 1 um^3 stack. """
+import numpy as np
+import multiprocessing as mp
+from scipy import ndimage
+from scipy import optimize
+from . import volume
+
+
+def surface_eqn(data, a, b, c, d, f):
+    """ Paraboloid used to model the surface: z = ax^2 + by^2 + cx + dy + f."""
+    x, y = data
+    return a * x ** 2 + b * y ** 2 + c * x + d * y + f
+
+
+def guess_surface_points(stack, r=50, upper_threshold_percent=0.6, gaussian_blur_size=5):
+    """ Guess the depth of the surface at a grid of 2r x 2r windows.
+
+    For each window we take the median intensity per depth, blur it over z and take the
+    depth with the strongest (positive) derivative as the surface. Windows are
+    non-overlapping so we reshape each row of windows into a (z, 2r, num_windows, 2r)
+    view and compute all of them at once.
+
+    Windows are dropped if the guessed depth is above the first depth that crosses the
+    intensity threshold, if the first median is above the 30th percentile of the stack
+    or if the last median is below 10.
+
+    :param np.array stack: Stack (depth x height x width) as a np.array or LazyVolume. Only
+        the top half is loaded (the percentile is computed by chunks).
+    :param int r: Half size of each window in pixels.
+    :param float upper_threshold_percent: Surface median intensity should be in the
+        bottom X% of the *range* of medians.
+    :param float gaussian_blur_size: Sigma of the gaussian applied to the medians over z.
+
+    :returns: Array (num_points x 3) with guessed (z, y, x) points; x-major order.
+    """
+    depth, height, width = stack.shape
+
+    # Centers of the windows (edge windows are dropped)
+    r_xs = np.arange(r, width - width % r, r * 2)[1:-1]
+    r_ys = np.arange(r, height - height % r, r * 2)[1:-1]
+    if len(r_xs) == 0 or len(r_ys) == 0:
+        return np.empty((0, 3), dtype=int)
+
+    # Surface z should be below this value
+    z_lim = int(depth / 2)
+    # Mean intensity of the first frame in the slice should be less than this value
+    z_0_upper_threshold = volume.percentile(stack, 30)
+
+    # Median intensity per depth for every window (one row of windows at a time)
+    top_stack = stack[:z_lim]
+    x_start, x_end = r_xs[0] - r, r_xs[-1] + r
+    medians = np.empty((z_lim, len(r_ys), len(r_xs)))
+    for i, y in enumerate(r_ys):
+        windows = top_stack[:, y - r: y + r, x_start: x_end].reshape(z_lim, 2 * r,
+                                                                     len(r_xs), 2 * r)
+        medians[:, i] = np.percentile(windows, 50, axis=(1, 3))
+
+    # Blur and differentiate over z
+    blurred = ndimage.gaussian_filter1d(medians, gaussian_blur_size, axis=0)
+    derivative = ndimage.correlate1d(blurred, [-1, 0, 1], axis=0)  # 1-d sobel
+    surface_zs = np.argmax(derivative, axis=0)
+
+    # Find first depth that crosses the upper threshold
+    upper_threshold_values = upper_threshold_percent * ((blurred.max(axis=0) -
+                                                         blurred.min(axis=0)) -
+                                                        blurred.min(axis=0))
+    above_threshold = blurred > upper_threshold_values
+    upper_threshold_idx = np.where(above_threshold.any(axis=0),
+                                   np.argmax(above_threshold, axis=0), -1)
+
+    is_valid = np.logical_and.reduce([surface_zs < upper_threshold_idx,
+                                      blurred[0] < z_0_upper_threshold,
+                                      blurred[-1] > 10])
+
+    # Return points in x-major order
+    ys, xs = np.meshgrid(r_ys, r_xs, indexing='ij')
+    points = np.stack([surface_zs, ys, xs], axis=-1).transpose(1, 0, 2)
+    return points[is_valid.T]
+
+
+def fit_surface(points, initial, bounds, maxfev=10000):
+    """ Fit a paraboloid to (z, y, x) points. Returns the fitted parameters."""
+    popt, _ = optimize.curve_fit(surface_eqn, (points[:, 2], points[:, 1]), points[:, 0],
+                                 p0=initial, maxfev=maxfev, bounds=bounds)
+    return popt
+
+
+def _bootstrap_fits(args):
+    """ Fit the surface to num_iterations random subsamples of points.
+
+    Function to run in each process. Each call gets its own seed so results do not depend
+    on the number of processes.
+    """
+    points, num_iterations, subsample_size, initial, bounds, seed = args
+    rng = np.random.default_rng(seed)
+    params = np.empty((num_iterations, 5))
+    for i in range(num_iterations):
+        indices = rng.choice(len(points), subsample_size, replace=False)
+        params[i] = fit_surface(points[indices], initial, bounds)
+    return params
+
+
+def bootstrap_surface_bounds(points, shape, initial, bounds, ss_percent=0.4,
+                             num_iterations=1000, percentiles=(5, 95), seed=None,
+                             num_processes=8, chunk_size_in_GB=0.1):
+    """ Confidence interval of the fitted surface via subsampling.
+
+    We refit the paraboloid to num_iterations random subsamples of points (in parallel)
+    and compute the desired percentiles of the fitted depth at each pixel. Only the
+    parameters of each fit are kept; depths are evaluated and reduced in chunks of rows
+    so we never hold the (num_iterations x height x width) array in memory.
+
+    :param np.array points: Array (num_points x 3) with guessed (z, y, x) points.
+    :param tuple shape: (height, width) of the output images.
+    :param list initial: Initial parameters for the fit.
+    :param tuple bounds: Bounds for the parameters (as expected by curve_fit).
+    :param float ss_percent: Percentage of points used in each subsample.
+    :param int num_iterations: Number of subsamples.
+    :param tuple percentiles: Percentiles to compute at each pixel.
+    :param int seed: Seed for the random generator. Results are reproducible for the same
+        seed regardless of num_processes.
+    :param int num_processes: Number of processes to use for fitting.
+    :param float chunk_size_in_GB: Maximum size of the depths evaluated at once.
+
+    :returns: List of (height x width) arrays. One per requested percentile.
+    """
+    # Fit the subsamples in parallel (each task with an independent random stream)
+    subsample_size = int(len(points) * ss_percent)
+    num_tasks = int(np.ceil(num_iterations / 25))  # fixed so results do not depend on num_processes
+    task_sizes = [len(s) for s in np.array_split(np.arange(num_iterations), num_tasks)]
+    seeds = np.random.SeedSequence(seed).spawn(num_tasks)
+    tasks = [(points, n, subsample_size, initial, bounds, s) for n, s in
+             zip(task_sizes, seeds)]
+    num_processes = max(min(num_processes, mp.cpu_count() - 1), 1)
+    if num_processes > 1:
+        with mp.Pool(num_processes) as pool:
+            params = np.concatenate(pool.map(_bootstrap_fits, tasks))
+    else:
+        params = np.concatenate([_bootstrap_fits(task) for task in tasks])
+
+    # Compute percentiles over chunks of rows
+    height, width = shape
+    bytes_per_row = num_iterations * width * 8
+    rows_per_chunk = max(int(chunk_size_in_GB * 1024 ** 3 / bytes_per_row), 1)
+    bound_ims = [np.empty(shape) for _ in percentiles]
+    xs = np.arange(width)
+    for row_start in range(0, height, rows_per_chunk):
+        rows = slice(row_start, min(row_start + rows_per_chunk, height))
+        mesh_x, mesh_y = np.meshgrid(xs, np.arange(height)[rows])
+        design = np.stack([mesh_x ** 2, mesh_y ** 2, mesh_x, mesh_y, np.ones_like(mesh_x)])
+        fitted_zs = params @ design.reshape(5, -1)  # num_iterations x (rows * width)
+        chunk_percentiles = np.percentile(fitted_zs, percentiles, axis=0)
+        for bound_im, chunk_percentile in zip(bound_ims, chunk_percentiles):
+            bound_im[rows] = chunk_percentile.reshape(-1, width)
+
+    return bound_ims
@@ -0,0 +1,316 @@
+""" Utilities to read frames from (behavior) videos. """
+import numpy as np
+import os
+
+try:
+    import cv2
+except ImportError:
+    print("Could not find cv2. You won't be able to read videos.")
+
+
+def read_batches(filename, batch_size, start=0, stop=None, crop=None, rgb=False):
+    """ Decode frames [start, stop) of a video once and yield them in batches.
+
+    :param string filename: Path to the video.
+    :param int batch_size: Number of frames per batch (the last one can be smaller).
+    :param int start: First frame to read (0-based).
+    :param int stop: Frame to stop at. None (or a value past the last frame that could be
+        decoded) reads until the end of the video.
+    :param tuple crop: (x0, x1, y0, y1) pixel limits of the frames. None for full frames.
+    :param bool rgb: Whether to return RGB frames rather than BGR.
+
+    :returns: Generator of arrays (num_frames x height x width x 3, np.uint8).
+    """
+    cap = cv2.VideoCapture(filename)
+    if not cap.isOpened():
+        raise ValueError('Could not open video {}'.format(filename))
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    stop = num_frames if stop is None else min(stop, num_frames)
+    if start > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    x0, x1, y0, y1 = crop or (0, int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 0,
+                              int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    for batch_start in range(start, stop, batch_size):
+        batch = np.empty((min(batch_size, stop - batch_start), y1 - y0, x1 - x0, 3), np.uint8)
+        for i in range(len(batch)):
+            ret, frame = cap.read()
+            if not ret:  # frame count in the header can be wrong: stop here
+                cap.release()
+                if i > 0:
+                    yield batch[:i]
+                return
+            if rgb:
+                cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2RGB, dst=batch[i])
+            else:
+                batch[i] = frame[y0:y1, x0:x1]
+        yield batch
+    cap.release()
+
+
+class DecodeService():
+    """ Decode a video once and fan the frames out to several consumers.
+
+    Frames are decoded (in the calling thread) into a ring of ring_size frames that every
+    consumer reads in its own thread. The decoder waits for the slowest consumer once it is
+    ring_size frames ahead (backpressure). A consumer that raises an exception (or returns
+    before reading all frames) is detached; the others keep receiving frames.
+
+    Consumers are callables that receive an iterator of (frame_id, frame) pairs and return
+    a result. Frames are views into the ring that are only valid until the consumer asks
+    for the next one: copy them to keep them. For instance:
+
+        service = DecodeService(filename)
+        service.register('preview', preview_sampler([0, 500, 1000]))
+        service.register('statistics', frame_statistics)
+        results, errors = service.run()
+
+    :param string filename: Path to the video.
+    :param tuple crop: (x0, x1, y0, y1) pixel limits of the frames. None for full frames.
+    :param bool gray: Whether to convert frames to grayscale (rather than BGR).
+    :param int ring_size: Number of decoded frames buffered.
+
+    :ivar int num_decoded: Number of frames decoded in the last run.
+    """
+    def __init__(self, filename, crop=None, gray=True, ring_size=64):
+        self.filename = filename
+        self.crop = crop
+        self.gray = gray
+        self.ring_size = ring_size
+        self.consumers = {}
+        self.num_decoded = 0
+
+    def register(self, name, consumer):
+        """ Add a consumer (callable receiving an iterator of (frame_id, frame) pairs)."""
+        if name in self.consumers:
+            raise ValueError('Consumer {} is already registered'.format(name))
+        self.consumers[name] = consumer
+
+    def _frames(self, name):
+        """ Iterate over the frames in the ring (releasing each one when asking for the
+        next)."""
+        k = 0
+        while True:
+            with self._condition:
+                self._positions[name] = k
+                self._condition.notify_all()
+                self._condition.wait_for(lambda: self._num_written > k or self._finished)
+                if self._num_written <= k:
+                    return
+            yield self._start + k, self._ring[k % self.ring_size]
+            k += 1
+
+    def _consume(self, name, results, errors):
+        try:
+            results[name] = self.consumers[name](self._frames(name))
+        except Exception as e:
+            errors[name] = e
+        finally:
+            with self._condition:  # detach
+                self._positions[name] = float('inf')
+                self._condition.notify_all()
+
+    def run(self, start=0, stop=None):
+        """ Decode frames [start, stop) and feed them to all consumers.
+
+        :param int start: First frame to read (0-based).
+        :param int stop: Frame to stop at. None (or a value past the last frame that could be
+            decoded) reads until the end of the video.
+
+        :returns: (results, errors). Dictionaries with the result of each consumer that
+            finished and the exception raised by each consumer that failed.
+        """
+        import threading
+
+        cap = cv2.VideoCapture(self.filename)
+        if not cap.isOpened():
+            raise ValueError('Could not open video {}'.format(self.filename))
+        if not self.consumers:
+            cap.release()
+            return {}, {}
+        num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        stop = num_frames if stop is None else min(stop, num_frames)
+        if start > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        x0, x1, y0, y1 = self.crop or (0, int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 0,
+                                       int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+        self._ring = np.empty((self.ring_size, y1 - y0, x1 - x0, *([] if self.gray else [3])),
+                              dtype=np.uint8)
+        self._condition = threading.Condition()
+        self._start, self._num_written, self._finished = start, 0, False
+        self._positions = {name: 0 for name in self.consumers}
+        results, errors = {}, {}
+        threads = [threading.Thread(target=self._consume, args=(name, results, errors),
+                                    daemon=True) for name in self.consumers]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for k in range(stop - start):
+                with self._condition:  # wait until no consumer needs the frame in this slot
+                    self._condition.wait_for(
+                        lambda: min(self._positions.values()) > k - self.ring_size)
+                    if min(self._positions.values()) == float('inf'):
+                        break  # all consumers are done
+                ret, frame = cap.read()
+                if not ret:  # frame count in the header can be wrong: stop here
+                    break
+                if self.gray:
+                    cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY,
+                                 dst=self._ring[k % self.ring_size])
+                else:
+                    self._ring[k % self.ring_size] = frame[y0:y1, x0:x1]
+                with self._condition:
+                    self._num_written = k + 1
+                    self._condition.notify_all()
+        finally:
+            cap.release()
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+            for thread in threads:
+                thread.join()
+        self.num_decoded = self._num_written
+
+        return results, errors
+
+
+def preview_sampler(frame_ids):
+    """ DecodeService consumer that keeps (copies of) some frames.
+
+    :param list frame_ids: Frames to keep (0-based).
+
+    :returns: Consumer returning the list of frames (in the order of frame_ids).
+    """
+    wanted = set(frame_ids)
+
+    def consumer(frames):
+        samples = {}
+        for frame_id, frame in frames:
+            if frame_id in wanted:
+                samples[frame_id] = frame.copy()
+                if len(samples) == len(wanted):
+                    break
+        return [samples[frame_id] for frame_id in frame_ids if frame_id in samples]
+
+    return consumer
+
+
+def frame_statistics(frames):
+    """ DecodeService consumer computing the mean and standard deviation of each frame.
+
+    :returns: Array (num_frames x 2 * num_channels) with the mean and std of each channel.
+    """
+    return np.array([np.concatenate(cv2.meanStdDev(frame)).ravel() for _, frame in frames])
+
+
+def frame_hashes(frames):
+    """ DecodeService consumer computing a hash (crc32) of each frame: two reads of a video
+    decoded the same frames if their hashes match.
+
+    :returns: List with the hash of each frame.
+    """
+    import zlib
+
+    return [zlib.crc32(np.ascontiguousarray(frame)) for _, frame in frames]
+
+
+class ClipCache():
+    """ Decoded movie clips cached on local disk, addressed by the hash of the clip bytes.
+
+    Each clip is decoded once (sequentially, through an ffmpeg rawvideo pipe) and saved as
+    <cache_dir>/<sha1 of the clip>[-gray][-down<factor>].npy. The least recently used clips
+    are deleted when the cache grows larger than max_bytes.
+
+    :param string cache_dir: Directory for the decoded clips (created if needed).
+    :param int max_bytes: Size limit of the cache.
+
+    :ivar int num_decoded: Number of clips decoded (cache misses).
+    :ivar int num_cached: Number of clips read from the cache (cache hits).
+    """
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.num_decoded = 0
+        self.num_cached = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, clip, gray=False, downsample=1):
+        """ Decoded frames of a clip.
+
+        :param bytes clip: Encoded clip (e.g., the blob in stimulus.Movie.Clip).
+        :param bool gray: Whether to return grayscale frames (rather than RGB).
+        :param int downsample: Factor to downsample the frames by (area averaging).
+
+        :returns: Array (num_frames x height x width [x 3], np.uint8).
+        """
+        import hashlib
+
+        clip = bytes(clip)
+        filename = os.path.join(self.cache_dir, hashlib.sha1(clip).hexdigest() +
+                                ('-gray' if gray else '') +
+                                ('-down{}'.format(downsample) if downsample > 1 else '') + '.npy')
+        try:
+            frames = np.load(filename)
+            os.utime(filename)  # recently used
+            self.num_cached += 1
+        except (OSError, ValueError):
+            frames = self._decode(clip, gray, downsample)
+            self.num_decoded += 1
+            self._save(filename, frames)
+
+        return frames
+
+    def _decode(self, clip, gray, downsample):
+        """ Decode all frames of a clip with ffmpeg."""
+        import subprocess
+        import tempfile
+
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.clip') as temp_file:
+            temp_file.write(clip)
+            temp_file.flush()
+
+            cap = cv2.VideoCapture(temp_file.name)
+            if not cap.isOpened():
+                raise ValueError('Could not open clip')
+            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) // downsample
+            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) // downsample
+            cap.release()
+
+            cmd = ['ffmpeg', '-loglevel', 'error', '-i', temp_file.name, '-f', 'rawvideo',
+                   '-pix_fmt', 'gray' if gray else 'rgb24', '-an', 'pipe:1']
+            if downsample > 1:
+                cmd[-1:-1] = ['-vf', 'scale={}:{}:flags=area'.format(width, height)]
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                raise ValueError('Could not decode clip: {}'.format(result.stderr.decode()))
+
+        frame_shape = (height, width) if gray else (height, width, 3)
+        return np.frombuffer(result.stdout, dtype=np.uint8).reshape(-1, *frame_shape).copy()
+
+    def _save(self, filename, frames):
+        """ Save a decoded clip and evict the least recently used ones over max_bytes."""
+        temp_filename = filename + '.tmp{}'.format(os.getpid())
+        try:
+            with open(temp_filename, 'wb') as f:  # np.save would append .npy
+                np.save(f, frames)
+            os.replace(temp_filename, filename)
+        except OSError:
+            return
+
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if path != filename:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total_bytes -= size
@@ -0,0 +1,207 @@
+""" Chunked storage and lazy (crop-first) access to big 3-d volumes. """
+import numpy as np
+import json
+import zlib
+import os
+import uuid
+
+MAGIC = b'CHUNKVOL'  # first bytes in every chunked volume file
+
+
+def save_chunked(filename, volume, chunk_depth=16, compression_level=1):
+    """ Save volume as independent z-chunks so crops can be read lazily.
+
+    File layout: MAGIC, the (optionally zlib compressed) chunks (volume[i * chunk_depth:
+    (i + 1) * chunk_depth] in C order), a json footer (shape, dtype, chunk_depth,
+    compression and the size in bytes of each chunk) and 8 bytes with the footer size.
+    Chunks are written one at a time; the file is written to a temporary file first so
+    incomplete files are never read.
+
+    Before compression, bytes in each chunk are shuffled (all first bytes of each value,
+    then all second bytes, ...) as in blosc/HDF5: exponents of floats are very similar
+    so this compresses noisy stacks ~1.4x rather than ~1.2x.
+
+    :param string filename: Output filename.
+    :param np.array volume: 3-d array (depth x height x width).
+    :param int chunk_depth: Number of slices per chunk.
+    :param int compression_level: zlib compression level (0-9). 0 stores the chunks
+        uncompressed.
+    """
+    volume = np.asarray(volume)
+    temp_filename = '{}.{}.tmp'.format(filename, uuid.uuid4())
+    try:
+        with open(temp_filename, 'wb') as f:
+            f.write(MAGIC)
+            sizes = []
+            for z in range(0, len(volume), chunk_depth):
+                chunk = np.ascontiguousarray(volume[z: z + chunk_depth])
+                if compression_level > 0:
+                    chunk = zlib.compress(_shuffle(chunk), compression_level)
+                sizes.append(f.write(chunk))
+            footer = {'shape': volume.shape, 'dtype': volume.dtype.str,
+                      'chunk_depth': chunk_depth, 'compressed': compression_level > 0,
+                      'shuffled': compression_level > 0, 'sizes': sizes}
+            footer_size = f.write(json.dumps(footer).encode())
+            f.write(footer_size.to_bytes(8, 'little'))
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
+
+
+def _shuffle(array):
+    """ Bytes of the array grouped by position in each value (all first bytes, ...)."""
+    values = array.reshape(-1).view(np.uint8).reshape(-1, array.itemsize)
+    shuffled = np.empty((array.itemsize, len(values)), dtype=np.uint8)
+    for i in range(array.itemsize):  # faster than a transposed copy
+        shuffled[i] = values[:, i]
+    return shuffled.tobytes()
+
+
+def _unshuffle(buffer, dtype):
+    """ Inverse of _shuffle: 1-d array of type dtype from the shuffled bytes."""
+    shuffled = np.frombuffer(buffer, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    values = np.empty((shuffled.shape[1], dtype.itemsize), dtype=np.uint8)
+    for i in range(dtype.itemsize):
+        values[:, i] = shuffled[i]
+    return values.view(dtype).reshape(-1)
+
+
+class LazyVolume():
+    """ Read-only 3-d volume that loads z-chunks only when they are indexed.
+
+    Supports numpy basic indexing (ints and slices, e.g., vol[z0:z1, y0:y1, x0:x1]);
+    only the chunks that contain the requested slices are loaded. np.asarray(vol) loads
+    the whole volume.
+
+    :param tuple shape: Shape of the volume (depth x height x width).
+    :param np.dtype dtype: Type of the volume.
+    :param int chunk_depth: Number of slices per chunk.
+    :param function load_chunk: Function that receives a chunk index and returns the
+        chunk (a chunk_depth x height x width array; last chunk may be smaller).
+    """
+    def __init__(self, shape, dtype, chunk_depth, load_chunk):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_depth = chunk_depth
+        self.load_chunk = load_chunk
+        self.bytes_read = 0  # (uncompressed) bytes of the chunks loaded so far
+
+    @classmethod
+    def from_file(cls, filename):
+        """ Open a volume saved with save_chunked."""
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a chunked volume'.format(filename))
+            f.seek(-8, os.SEEK_END)
+            footer_size = int.from_bytes(f.read(8), 'little')
+            f.seek(-8 - footer_size, os.SEEK_END)
+            footer = json.loads(f.read(footer_size).decode())
+        offsets = len(MAGIC) + np.concatenate([[0], np.cumsum(footer['sizes'])])
+        dtype = np.dtype(footer['dtype'])
+        height, width = footer['shape'][1:]
+
+        def load_chunk(chunk_idx):
+            with open(filename, 'rb') as f:
+                f.seek(int(offsets[chunk_idx]))
+                if footer['compressed']:
+                    chunk = zlib.decompress(f.read(footer['sizes'][chunk_idx]))
+                    chunk = (_unshuffle(chunk, dtype) if footer.get('shuffled', False)
+                             else np.frombuffer(chunk, dtype=dtype))
+                else:
+                    chunk = np.fromfile(f, dtype=dtype,
+                                        count=footer['sizes'][chunk_idx] // dtype.itemsize)
+            return chunk.reshape(-1, height, width)
+
+        return cls(footer['shape'], dtype, footer['chunk_depth'], load_chunk)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        volume = self[:]
+        return volume if dtype is None else volume.astype(dtype)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key, )
+        if len(key) > self.ndim or any(k is Ellipsis or k is None for k in key):
+            raise IndexError('Only ints and slices are supported in a LazyVolume.')
+        z_key, yx_key = key[0], key[1:]
+
+        # Get requested slices
+        if isinstance(z_key, slice):
+            zs = np.arange(self.shape[0])[z_key]
+        else:
+            zs = np.arange(self.shape[0])[[z_key]]  # raises IndexError if out of bounds
+
+        # Load the needed chunks and crop them
+        yx_shape = np.broadcast_to(0, self.shape[1:])[yx_key].shape  # no copy
+        result = np.empty((len(zs), *yx_shape), dtype=self.dtype)
+        chunk_ids = zs // self.chunk_depth
+        for chunk_idx in np.unique(chunk_ids):
+            chunk = self.load_chunk(chunk_idx)
+            self.bytes_read += chunk.nbytes
+
+            # zs are evenly spaced so slices in the chunk are too (avoids fancy indexing)
+            positions = np.flatnonzero(chunk_ids == chunk_idx)  # contiguous in result
+            local_zs = zs[positions] - chunk_idx * self.chunk_depth
+            step = local_zs[1] - local_zs[0] if len(local_zs) > 1 else 1
+            stop = local_zs[-1] + step
+            z_slice = slice(local_zs[0], stop if stop >= 0 else None, step)
+            result[positions[0]: positions[-1] + 1] = chunk[(z_slice, *yx_key)]
+
+        return result if isinstance(z_key, slice) else result[0]
+
+
+def percentile(volume, q):
+    """ Exact q-th percentile (as np.percentile) of a float32 volume read chunk by chunk.
+
+    Radix selection on the bits of each value: a first pass counts the values per each
+    of the 2 ** 16 possible high 16 bits and a second pass, the low 16 bits of the
+    values in the bins that contain the two ranks needed for interpolation. Memory is
+    a couple of chunks regardless of the size of the volume (as a LazyVolume).
+
+    :param volume: 3-d volume. Only float32 LazyVolumes are read by chunks; arrays (or
+        other types) use np.percentile.
+    :param float q: Percentile to compute (0-100).
+
+    :returns: The percentile.
+    """
+    if isinstance(volume, np.ndarray) or np.dtype(volume.dtype) != np.float32:
+        return np.percentile(np.asarray(volume), q)
+
+    chunk_depth = getattr(volume, 'chunk_depth', len(volume))
+    def sortable_keys():  # uint32 keys with the same order as the float values
+        for z in range(0, len(volume), chunk_depth):
+            bits = np.ascontiguousarray(volume[z: z + chunk_depth]).ravel().view(np.uint32)
+            sign_mask = (bits.view(np.int32) >> 31).view(np.uint32)  # all ones if negative
+            yield bits ^ (sign_mask | np.uint32(2 ** 31))
+
+    # Ranks (in the sorted volume) of the two values to interpolate
+    position = q / 100 * (np.prod(volume.shape) - 1)
+    ranks = [int(np.floor(position)), int(np.ceil(position))]
+
+    # First pass: find the high 16 bits of each value
+    high_counts = sum(np.bincount(keys >> 16, minlength=2 ** 16) for keys in
+                      sortable_keys())
+    high_starts = np.cumsum(high_counts) - high_counts  # rank of the first value in bin
+    highs = [np.searchsorted(high_starts, rank, side='right') - 1 for rank in ranks]
+
+    # Second pass: find the low 16 bits
+    low_counts = {high: np.zeros(2 ** 16, dtype=np.int64) for high in set(highs)}
+    for keys in sortable_keys():
+        for high, counts in low_counts.items():
+            counts += np.bincount(keys[(keys >> 16) == high] & 0xFFFF, minlength=2 ** 16)
+    values = []
+    for rank, high in zip(ranks, highs):
+        low = np.searchsorted(np.cumsum(low_counts[high]), rank - high_starts[high],
+                              side='right')
+        key = np.uint32(high << 16 | low)
+        bits = ~key if key >> 31 == 0 else key & np.uint32(2 ** 31 - 1)
+        values.append(np.array(bits, dtype=np.uint32).view(np.float32).item())
+
+    return values[0] + (values[1] - values[0]) * (position - ranks[0])
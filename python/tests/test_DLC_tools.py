@@ -0,0 +1,273 @@
+""" Test suite for filtering and fitting deeplabcut labels."""
+import os
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_allclose
+
+DLC_tools = pytest.importorskip('pipeline.utils.DLC_tools')
+
+SCORER = 'DLC_resnet50_test'
+DLC_CONFIG_PATH = '/mnt/lab/DeepLabCut/pupil_track-Donnie-2019-02-12/config.yaml'
+DIRECTIONS = ['top', 'top_right', 'right', 'right_bottom', 'bottom', 'bottom_left', 'left',
+              'left_top']
+BODYPARTS = (['eyelid_' + d for d in DIRECTIONS] + ['pupil_' + d for d in DIRECTIONS])
+
+
+def _label_table(num_frames=200, pcutoff=0.9):
+    """ Synthetic deeplabcut labels: eyelids and pupil on ellipses around a moving center."""
+    rng = np.random.default_rng(0)
+    angles = np.arange(8) * np.pi / 4
+    center = np.stack([100 + 5 * np.sin(np.arange(num_frames) / 20),
+                       80 + 3 * np.cos(np.arange(num_frames) / 20)], axis=1)
+    eyelids = center[:, None] + np.stack([60 * np.cos(angles), 40 * np.sin(angles)], axis=-1)
+    pupil = center[:, None] + np.stack([15 * np.cos(angles), 12 * np.sin(angles)], axis=-1)
+    coords = np.concatenate([eyelids, pupil], axis=1) + rng.normal(0, 0.5, (num_frames, 16, 2))
+    likelihood = np.where(rng.random((num_frames, 16)) < 0.2, pcutoff / 2, 0.99)
+
+    columns = pd.MultiIndex.from_product([[SCORER], BODYPARTS, ['x', 'y', 'likelihood']],
+                                         names=['scorer', 'bodyparts', 'coords'])
+    values = np.concatenate([coords, likelihood[..., None]], axis=-1).reshape(num_frames, -1)
+    return pd.DataFrame(values, columns=columns)
+
+
+def _online_median_filter(x, kernel_size=3):
+    """ Original (per sample) online_median_filter."""
+    interval = kernel_size // 2
+    online_medfilt = x[0:interval].tolist()
+    for i in range(interval, len(x) - interval):
+        online_medfilt.append(np.median(x[i - interval:i + interval + 1]))
+    online_medfilt += x[-interval:].tolist()
+    return np.array(online_medfilt)
+
+
+def test_online_median_filter_matches_loop():
+    x = np.random.default_rng(1).normal(size=(100, 4))
+    for kernel_size in [3, 7]:
+        filtered = DLC_tools.online_median_filter(x, kernel_size)
+        for i in range(x.shape[1]):
+            assert_allclose(filtered[:, i], _online_median_filter(x[:, i], kernel_size),
+                            err_msg='Filtered signals do not match')
+
+
+@pytest.fixture
+def dlc_config(monkeypatch):
+    """ Config of DeeplabcutPupilFitting reading synthetic labels (and blank frames)."""
+    df_label = _label_table()
+
+    class Clip():
+        def __init__(self, fname):
+            pass
+        def width(self):
+            return 320
+        def height(self):
+            return 240
+        def _read_specific_frame(self, frame_num):
+            return np.zeros((240, 320, 3), dtype=np.uint8)
+
+    monkeypatch.setattr(DLC_tools.pd, 'read_hdf', lambda path: df_label)
+    monkeypatch.setattr(DLC_tools.video_processor, 'VideoProcessorCV', Clip)
+    monkeypatch.setattr(DLC_tools.auxiliaryfunctions, 'GetScorerName', lambda *args: SCORER)
+
+    return {'bodyparts': BODYPARTS, 'cropped_coords': (20, 220, 10, 170), 'shuffle': 1,
+            'trainingsetindex': 0, 'project_path': '', 'orig_video_path': 'case.avi',
+            'TrainingFraction': [0.95], 'pcutoff': 0.9, 'colormap': 'jet', 'alphavalue': 0.7,
+            'df_label': df_label}
+
+
+def test_coords_pcutoff_matches_dataframe(dlc_config):
+    df_label, cropped_coords = dlc_config['df_label'], dlc_config['cropped_coords']
+
+    df_bodyparts = df_label[SCORER][BODYPARTS]
+    is_coord = df_bodyparts.columns.get_level_values(1)
+    confident = df_bodyparts.iloc[:, is_coord == 'likelihood'].values > dlc_config['pcutoff']
+    for cropped in [True, False]:
+        fitting = DLC_tools.DeeplabcutPupilFitting(dlc_config, cropped=cropped)
+        df_x = df_bodyparts.iloc[:, is_coord == 'x'] + (0 if cropped else cropped_coords[0])
+        df_y = df_bodyparts.iloc[:, is_coord == 'y'] + (0 if cropped else cropped_coords[2])
+        for frame_num in range(0, len(df_label), 7):
+            bpindex, x_coords, y_coords = fitting.coords_pcutoff(frame_num)
+            expected_bpindex = np.flatnonzero(confident[frame_num])
+            assert bpindex.tolist() == expected_bpindex.tolist(), 'Wrong bodyparts'
+            assert_allclose(x_coords, df_x.iloc[frame_num, expected_bpindex].values, rtol=1e-6,
+                            err_msg='x coordinates do not match')
+            assert_allclose(y_coords, df_y.iloc[frame_num, expected_bpindex].values, rtol=1e-6,
+                            err_msg='y coordinates do not match')
+
+        masked = fitting.masked_coords()
+        assert np.array_equal(np.isnan(masked[..., 0]), ~confident), 'Wrong pcutoff mask'
+
+    # fits use the pupil labels above pcutoff
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)
+    frame_num = int(np.flatnonzero(confident[:, 8:].all(axis=1))[0])
+    ellipse_fit = fitting.fit_ellipse_to_pupil(frame_num, frame)
+    circle_fit = fitting.fit_circle_to_pupil(frame_num, frame)
+    assert ellipse_fit['pupil_labels_num'] == circle_fit['pupil_labels_num'] == 8
+    center = df_label[SCORER][BODYPARTS[8:]].values.reshape(-1, 8, 3)[frame_num, :, :2].mean(0)
+    assert_allclose(ellipse_fit['center'], center + cropped_coords[::2], atol=1,
+                    err_msg='Wrong ellipse center')
+    assert_allclose(ellipse_fit['major_radius'], 15, atol=1, err_msg='Wrong ellipse radius')
+    assert_allclose(circle_fit['radius'], 15, atol=1, err_msg='Wrong circle radius')
+    eyelid_fit = fitting.connect_eyelids(frame_num, frame)
+    assert eyelid_fit['eyelid_labels_num'] == confident[frame_num, :8].sum()
+
+
+def _filter_by_fitting_std(centers, sizes, std_magnitude):
+    """ Original (per column) outlier rejection in filter_by_fitting_std."""
+    xy = np.array([c if c is not None else (np.nan, np.nan) for c in centers], dtype=float)
+    rejected = np.zeros(len(centers), dtype=bool)
+    for values in [*sizes.T, *xy.T]:
+        valid = ~np.isnan(values)
+        rejected[valid] |= (abs(values[valid] - np.nanmean(values)) >
+                            std_magnitude * np.nanstd(values))
+    return rejected
+
+
+def test_filter_by_fitting_std_matches_per_column():
+    rng = np.random.default_rng(2)
+    num_frames = 500
+    centers = [tuple(c) for c in rng.normal(100, 2, size=(num_frames, 2))]
+    sizes = rng.normal(15, 0.5, size=(num_frames, 2))
+    sizes[[10, 200], 0] = 40  # outliers
+    centers[300] = (160, 100)
+    for i in [5, 6, 400]:  # not detected
+        centers[i] = None
+        sizes[i] = np.nan
+
+    data_circle = np.empty((num_frames, 3), dtype=object)
+    data_circle[:, 0] = centers
+    data_circle[:, 1] = [None if np.isnan(r) else r for r in sizes[:, 0]]
+    data_circle[:, 2] = -1.0
+    rejected = DLC_tools.filter_by_fitting_std(data_circle, 'circle', std_magnitude=5.5)
+    assert np.array_equal(rejected, _filter_by_fitting_std(centers, sizes[:, :1], 5.5))
+    assert np.flatnonzero(rejected).tolist() == [10, 200, 300], 'Wrong outliers'
+
+    data_ellipse = np.empty((num_frames, 5), dtype=object)
+    data_ellipse[:, 0] = centers
+    data_ellipse[:, 1:3] = sizes
+    data_ellipse[:, 3:] = 0.0
+    rejected = DLC_tools.filter_by_fitting_std(data_ellipse, 'ellipse', std_magnitude=3)
+    assert np.array_equal(rejected, _filter_by_fitting_std(centers, sizes, 3)), \
+        'Rejected frames do not match'
+
+
+def test_fit_all_frames_matches_raster(dlc_config):
+    fitting = DLC_tools.DeeplabcutPupilFitting(dlc_config, cropped=True)
+    fits = fitting.fit_all_frames(num_frames=60)
+    raster_fits = fitting.fit_all_frames(num_frames=60, raster=True)
+
+    for shape in ['circle', 'ellipse']:
+        fit, raster_fit = fits[shape], raster_fits[shape]
+        assert np.array_equal(np.isnan(fit['center']), np.isnan(raster_fit['center']))
+        for k in fit:
+            if k == 'visible_portion':  # raster masks include the (1 pixel) drawn borders
+                assert_allclose(fit[k], raster_fit[k], atol=0.05,
+                                err_msg='{} visible portions do not match'.format(shape))
+                assert np.array_equal(fit[k] < 0, raster_fit[k] < 0)
+            elif k == 'rotation_angle':
+                rotated = raster_fit[k] > 0
+                assert_allclose(fit[k][rotated], raster_fit[k][rotated], atol=1e-3,
+                                err_msg='Ellipse angles do not match')
+            else:
+                assert_allclose(fit[k], raster_fit[k], rtol=1e-6,
+                                err_msg='{} {} does not match'.format(shape, k))
+    assert {-1, -2, -3} & set(fits['ellipse']['visible_portion']), 'No missing labels'
+
+
+def _stub_predictor(batch_shapes):
+    """ Predictor that labels the eyelids at the edges of the red rectangle (in RGB) and
+    returns the frame number (encoded in the background) as the x of the pupil."""
+    def predict_batch(frames):
+        batch_shapes.append(frames.shape)
+        labels = []
+        for frame in frames:
+            ys, xs = np.nonzero((frame[..., 0] > 200) & (frame[..., 2] < 50))
+            if len(ys) == 0:  # padding
+                labels.append(np.zeros(15))
+                continue
+            x, y = (xs.min() + xs.max()) / 2, (ys.min() + ys.max()) / 2
+            frame_num = frame[0, 0, 1] - 20.0
+            labels.append([x, ys.min(), 0.99, xs.max(), y, 0.99, xs.min(), y, 0.99,
+                           x, ys.max(), 0.99, frame_num, y, 0.99])
+        return np.array(labels)
+
+    return predict_batch, ['eyelid_top', 'eyelid_right', 'eyelid_left', 'eyelid_bottom',
+                           'pupil_center']
+
+
+def test_predict_labels_streaming_with_stub_predictor(tmp_path):
+    # Lossless video (320 x 240): frame i has background i + 20 and a red rectangle in
+    # x = [100, 180), y = [60, 140)
+    video_path = str(tmp_path / 'eye.avi')
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'FFV1'), 30, (320, 240))
+    for i in range(100):
+        frame = np.full((240, 320, 3), i + 20, dtype=np.uint8)
+        frame[60:140, 100:180] = (0, 0, 255)  # BGR
+        writer.write(frame)
+    writer.release()
+    config = {'pcutoff': 0.9, 'original_width': 320, 'original_height': 240}
+
+    # All frames: 13 batches (the last one padded), one row per frame
+    batch_shapes = []
+    predict_batch, bodyparts = _stub_predictor(batch_shapes)
+    h5_path = DLC_tools.predict_labels_streaming(
+        video_path, str(tmp_path / 'labels.h5'), SCORER, predict_batch, bodyparts, 8)
+    assert sorted(os.listdir(str(tmp_path))) == ['eye.avi', 'labels.h5'], 'Wrote videos'
+    assert batch_shapes == [(8, 240, 320, 3)] * 13, 'Batches were not padded'
+    labels = pd.read_hdf(h5_path)
+    assert labels.columns.names == ['scorer', 'bodyparts', 'coords']
+    assert list(labels[SCORER].columns) == [(b, c) for b in bodyparts for c in
+                                            ['x', 'y', 'likelihood']], 'Wrong columns'
+    assert_allclose(labels[SCORER]['pupil_center']['x'], np.arange(100),
+                    err_msg='Labels are not in frame order')
+    assert DLC_tools.obtain_cropping_coords(h5_path, SCORER, config) == dict(
+        cropped_x0=100, cropped_x1=179, cropped_y0=60, cropped_y1=139)
+
+    # Segment of cropped frames: labels relative to the crop
+    batch_shapes.clear()
+    cropped_coords = dict(cropped_x0=80, cropped_x1=200, cropped_y0=50, cropped_y1=160)
+    h5_path = DLC_tools.predict_labels_streaming(
+        video_path, str(tmp_path / 'cropped.h5'), SCORER, predict_batch, bodyparts, 8,
+        cropped_coords=cropped_coords, start=30, stop=75)
+    assert batch_shapes == [(8, 110, 120, 3)] * 6, 'Wrong batches of cropped frames'
+    labels = pd.read_hdf(h5_path)
+    assert_allclose(labels[SCORER]['pupil_center']['x'], np.arange(30, 75),
+                    err_msg='Labels are not for frames [start, stop)')
+    assert DLC_tools.obtain_cropping_coords(h5_path, SCORER, config) == dict(
+        cropped_x0=20, cropped_x1=99, cropped_y0=10, cropped_y1=89)
+
+
+def test_streaming_labels_match_analyze_videos(tmp_path):
+    """ Labels predicted on decoded frames match dlc.analyze_videos on a short clip."""
+    pytest.importorskip('deeplabcut.pose_estimation_tensorflow')
+    if not os.path.exists(DLC_CONFIG_PATH):
+        pytest.skip('Trained deeplabcut model is not available')
+    config = DLC_tools.auxiliaryfunctions.read_config(DLC_CONFIG_PATH)
+    config.update(config_path=DLC_CONFIG_PATH, shuffle=1, trainingsetindex=0)
+    scorer = DLC_tools.auxiliaryfunctions.GetScorerName(config, config['shuffle'],
+                                                        config['TrainingFraction'][0])
+
+    # Synthetic eye (dark pupil moving inside a lighter eye) on a 2 s clip
+    video_path = str(tmp_path / 'clip.avi')
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (320, 240))
+    for i in range(60):
+        frame = np.full((240, 320, 3), 40, dtype=np.uint8)
+        cv2.ellipse(frame, (160, 120), (90, 55), 0, 0, 360, (150, 150, 150), -1)
+        cv2.circle(frame, (150 + i // 3, 118), 25, (10, 10, 10), -1)
+        writer.write(frame)
+    writer.release()
+
+    DLC_tools.predict_labels(video_path, config)
+    expected = pd.read_hdf(os.path.splitext(video_path)[0] + scorer + '.h5')
+
+    batch_size = config['batch_size']
+    predict_batch, bodyparts = DLC_tools.load_pose_predictor(config, batch_size)
+    h5_path = DLC_tools.predict_labels_streaming(
+        video_path, str(tmp_path / 'streamed.h5'), scorer, predict_batch, bodyparts,
+        batch_size)
+    labels = pd.read_hdf(h5_path)
+
+    assert labels.columns.equals(expected.columns), 'Label columns do not match'
+    assert_allclose(labels.values, expected.values, atol=1e-3,
+                    err_msg='Streamed labels do not match dlc.analyze_videos')
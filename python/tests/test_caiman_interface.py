@@ -0,0 +1,135 @@
+""" Test suite for the CaImAn interface."""
+import numpy as np
+import pytest
+
+cmn = pytest.importorskip('pipeline.utils.caiman_interface')
+
+
+def _make_movie(centers, image_shape=(64, 80), num_frames=40, radius=2.5):
+    """ Synthetic movie with gaussian neurons planted at the given centers."""
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:image_shape[0], :image_shape[1]]
+    scan = rng.normal(0, 0.1, (*image_shape, num_frames)).astype(np.float32)
+    for i, (cy, cx) in enumerate(centers):
+        shape = np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / (2 * radius ** 2))
+        trace = rng.gamma(1, 1, num_frames) * (3 - 0.2 * i)
+        scan += (shape[..., np.newaxis] * trace).astype(np.float32)
+    return scan
+
+
+def test_tiled_argmax_matches_argmax():
+    rng = np.random.default_rng(0)
+    image = rng.random((100, 70))
+    tiled_argmax = cmn._TiledArgmax(image, tile_size=16)
+    for _ in range(50):
+        y, x = rng.integers(0, 90), rng.integers(0, 60)
+        image[y: y + 10, x: x + 10] = rng.random((10, 10)) * rng.choice([0.5, 2])
+        tiled_argmax.update(slice(y, y + 10), slice(x, x + 10))
+        assert tiled_argmax.argmax() == np.unravel_index(np.argmax(image), image.shape)
+
+
+def test_greedy_roi_finds_planted_neurons():
+    centers = [(15, 20), (40, 60), (50, 15), (20, 55)]
+    scan = _make_movie(centers)
+    masks, traces, _, _ = cmn._greedyROI(scan, num_components=4, neuron_size=(11, 11))
+
+    found = [np.unravel_index(np.argmax(masks[..., i]), masks.shape[:2]) for i in range(4)]
+    for center in centers:
+        distances = [np.hypot(center[0] - y, center[1] - x) for y, x in found]
+        assert min(distances) <= 2, 'Planted neuron at {} was not found'.format(center)
+
+
+def _greedy_roi_full_refilter(scan, num_components, neuron_size):
+    """ Components as originally found by _greedyROI (refiltering the full mean frame)."""
+    from scipy import ndimage
+
+    image_height, image_width, num_frames = scan.shape
+    gaussian_stddev = np.array(neuron_size) / 4
+    gaussian_kernel = cmn._gaussian2d(gaussian_stddev)
+    residual_scan = scan - np.mean(scan, axis=(0, 1))
+    background = ndimage.gaussian_filter(np.mean(residual_scan, axis=-1), neuron_size)
+    residual_scan -= np.expand_dims(background, -1)
+
+    masks = np.zeros([image_height, image_width, num_components], dtype=np.float32)
+    traces = np.zeros([num_components, num_frames], dtype=np.float32)
+    mean_frame = np.mean(residual_scan, axis=-1)
+    half_kernel = np.fix(np.array(gaussian_kernel.shape) / 2).astype(np.int32)
+    half_neuron = np.fix(np.array(neuron_size) / 2).astype(np.int32)
+    for i in range(num_components):
+        neuron_locations = ndimage.gaussian_filter(mean_frame, gaussian_stddev)
+        y, x = np.unravel_index(np.argmax(neuron_locations), [image_height, image_width])
+
+        big_yslice = slice(max(y - half_kernel[0], 0), y + half_kernel[0] + 1)
+        big_xslice = slice(max(x - half_kernel[1], 0), x + half_kernel[1] + 1)
+        kernel_yslice = slice(max(0, half_kernel[0] - y), None if image_height > y +
+                              half_kernel[0] else image_height - y - half_kernel[0] - 1)
+        kernel_xslice = slice(max(0, half_kernel[1] - x), None if image_width > x +
+                              half_kernel[1] else image_width - x - half_kernel[1] - 1)
+        cropped_kernel = gaussian_kernel[kernel_yslice, kernel_xslice]
+        trace = np.average(residual_scan[big_yslice, big_xslice].reshape(-1, num_frames),
+                           weights=cropped_kernel.ravel(), axis=0)
+
+        yslice = slice(max(y - half_neuron[0], 0), y + half_neuron[0] + 1)
+        xslice = slice(max(x - half_neuron[1], 0), x + half_neuron[1] + 1)
+        mask, trace = cmn._rank1_NMF(residual_scan[yslice, xslice], trace)
+        residual_scan[yslice, xslice] -= np.expand_dims(mask, -1) * trace
+        mean_frame[yslice, xslice] = np.mean(residual_scan[yslice, xslice], axis=-1)
+
+        masks[yslice, xslice, i] = mask
+        traces[i] = trace
+
+    return masks, traces
+
+
+def test_greedy_roi_matches_full_refilter():
+    rng = np.random.default_rng(1)
+    centers = rng.uniform(0, [96, 100], (25, 2))  # some at the edges, some overlapping
+    scan = _make_movie(centers, image_shape=(96, 100), num_frames=30)
+
+    masks, traces, _, _ = cmn._greedyROI(scan.copy(), num_components=30,
+                                         neuron_size=(11, 11))
+    expected_masks, expected_traces = _greedy_roi_full_refilter(scan.copy(), 30, (11, 11))
+
+    np.testing.assert_allclose(masks, expected_masks, rtol=1e-5, atol=1e-6,
+                               err_msg='Initial masks differ from full refiltering')
+    np.testing.assert_allclose(traces, expected_traces, rtol=1e-5, atol=1e-6,
+                               err_msg='Initial traces differ from full refiltering')
+
+
+def _gaussian_masks(image_shape=(64, 80), radius=3):
+    """ Gaussian masks (image_height x image_width x num_components) cut at 0.01."""
+    yy, xx = np.mgrid[:image_shape[0], :image_shape[1]]
+    centers = [(15.3, 20.1), (40, 60.7), (50.5, 15), (0.5, 79)]
+    masks = np.stack([np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / (2 * radius ** 2)) for
+                      cy, cx in centers], axis=-1)
+    masks[masks < 0.01] = 0
+    return masks, centers
+
+
+def test_centroids_match_caiman():
+    visualization = pytest.importorskip('caiman.utils.visualization')
+    masks, _ = _gaussian_masks()
+
+    flat_masks = masks.reshape(-1, masks.shape[-1], order='F')
+    coordinates = visualization.plot_contours(flat_masks, np.empty(masks.shape[:2]))
+    import matplotlib.pyplot as plt; plt.close()
+    expected = [coordinate['CoM'] for coordinate in coordinates]
+
+    np.testing.assert_allclose(cmn.get_centroids(masks), expected, rtol=1e-6,
+                               err_msg='Centroids do not match caiman CoM')
+
+
+def test_centroids_do_not_import_matplotlib(monkeypatch):
+    import sys
+    for name in [m for m in sys.modules if m.split('.')[0] == 'matplotlib']:
+        monkeypatch.delitem(sys.modules, name)
+    monkeypatch.setitem(sys.modules, 'matplotlib', None)  # importing it raises an error
+    masks, centers = _gaussian_masks()
+
+    centroids = cmn.get_centroids(masks)
+    thresholded_centroids = cmn.get_centroids(masks, thr=0.9)
+
+    np.testing.assert_allclose(centroids[:3], centers[:3], atol=0.05,
+                               err_msg='Centroids are not at the mask centers')
+    np.testing.assert_allclose(thresholded_centroids[:3], centers[:3], atol=0.5,
+                               err_msg='Thresholded centroids moved')
@@ -0,0 +1,146 @@
+""" Test suite for the pupil tracker."""
+import cv2
+import numpy as np
+from numpy.testing import assert_allclose
+from pipeline.utils import eye_tracking, video
+from pipeline.utils.eye_tracking import PupilTracker
+
+PARAMETERS = {'relative_area_threshold': 0.002, 'ratio_threshold': 1.5, 'error_threshold': 0.1,
+              'min_contour_len': 5, 'margin': 0.02, 'contrast_threshold': 5,
+              'speed_threshold': 0.1, 'dr_threshold': 0.1, 'gaussian_blur': 5,
+              'extreme_meso': 0, 'running_avg': 0.4, 'exponent': 9}
+
+
+def _write_video(filename, num_frames=60, shape=(240, 320), dark_frames=(30,)):
+    """ Synthetic eye video: a dark ellipse (pupil) moving over a noisy background."""
+    rng = np.random.default_rng(0)
+    centers = np.stack([160 + 20 * np.sin(np.arange(num_frames) / 10),
+                        120 + 10 * np.cos(np.arange(num_frames) / 10)], axis=1)
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'MJPG'), 30, shape[::-1])
+    for i, center in enumerate(centers):
+        frame = rng.normal(150, 8, size=shape).clip(0, 255).astype(np.uint8)
+        cv2.ellipse(frame, tuple(np.round(center).astype(int)), (24, 18), 20, 0, 360, 30, -1)
+        if i in dark_frames:
+            frame[:] = 0
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    writer.release()
+
+    return centers
+
+
+def _goodness_of_fit(contour, ellipse):
+    """ Original (per point) PupilTracker.goodness_of_fit."""
+    center, size, angle = ellipse
+    angle *= np.pi / 180
+    err = 0
+    for coord in contour.squeeze().astype(float):
+        posx = (coord[0] - center[0]) * np.cos(-angle) - (coord[1] - center[1]) * np.sin(-angle)
+        posy = (coord[0] - center[0]) * np.sin(-angle) + (coord[1] - center[1]) * np.cos(-angle)
+        err += ((posx / size[0]) ** 2 + (posy / size[1]) ** 2 - 0.25) ** 2
+    return np.sqrt(err / len(contour))
+
+
+def test_goodness_of_fit_matches_per_point_loop():
+    rng = np.random.default_rng(1)
+    contour = rng.integers(0, 100, size=(50, 1, 2)).astype(np.int32)
+    ellipse = cv2.fitEllipse(contour)
+    assert_allclose(PupilTracker.goodness_of_fit(contour, ellipse),
+                    _goodness_of_fit(contour, ellipse), err_msg='RMSEs do not match')
+
+
+def test_track_finds_moving_pupil(tmp_path):
+    filename = str(tmp_path / 'eye.avi')
+    centers = _write_video(filename)
+    eye_roi = np.array([[40, 200], [60, 260]])  # (y, x)
+
+    traces = PupilTracker(PARAMETERS, verbose=False).track(filename, eye_roi)
+    assert [t['frame_id'] for t in traces] == list(range(1, 61)), 'Missing frames'
+    assert 'center' not in traces[30], 'Pupil found in a dark frame'
+    assert traces[30]['frame_intensity'] < PARAMETERS['contrast_threshold']
+
+    found = [i for i, t in enumerate(traces) if 'center' in t]
+    assert len(found) > 55, 'Pupil was not found'
+    assert_allclose([traces[i]['center'] for i in found], centers[found], atol=1,
+                    err_msg='Pupil centers do not match')
+    gray = cv2.cvtColor(cv2.VideoCapture(filename).read()[1], cv2.COLOR_BGR2GRAY)
+    assert_allclose(traces[0]['frame_intensity'], np.std(gray), rtol=1e-6,
+                    err_msg='Frame intensity does not match')
+
+
+def test_track_parallel_matches_sequential(tmp_path):
+    filename = str(tmp_path / 'eye.avi')
+    _write_video(filename, num_frames=120, dark_frames=range(55, 62))
+    eye_roi = np.array([[40, 200], [60, 260]])
+    traces = PupilTracker(PARAMETERS, verbose=False).track(filename, eye_roi)
+
+    # overlap=0 cannot verify the seeks (tracks sequentially); one process tracks
+    # sequentially
+    for num_processes, overlap in [(4, 10), (4, 0), (1, 10)]:
+        parallel_traces = eye_tracking.track_parallel(PARAMETERS, filename, eye_roi,
+                                                      num_processes=num_processes,
+                                                      overlap=overlap)
+        assert len(parallel_traces) == len(traces), 'Missing frames'
+        for trace, parallel_trace in zip(traces, parallel_traces):
+            assert trace.keys() == parallel_trace.keys(), 'Tracking results do not match'
+            for k in trace:
+                assert_allclose(parallel_trace[k], trace[k], err_msg='Tracking results do '
+                                'not match (frame {}, {})'.format(trace['frame_id'], k))
+
+
+def test_track_parallel_checks_seeks(tmp_path, monkeypatch, capsys):
+    filename = str(tmp_path / 'eye.avi')
+    _write_video(filename, num_frames=120, dark_frames=range(55, 62))
+    eye_roi = np.array([[40, 200], [60, 260]])
+    traces = PupilTracker(PARAMETERS, verbose=False).track(filename, eye_roi)
+
+    class InaccurateCapture():
+        """ Capture whose seeks to some frames land one frame later."""
+        def __init__(self, *args, _VideoCapture=cv2.VideoCapture):
+            self._cap = _VideoCapture(*args)
+
+        def __getattr__(self, name):
+            return getattr(self._cap, name)
+
+        def set(self, prop, value):
+            if prop == cv2.CAP_PROP_POS_FRAMES and value in inaccurate_frames:
+                value += 1
+            return self._cap.set(prop, value)
+    monkeypatch.setattr(cv2, 'VideoCapture', InaccurateCapture)
+    monkeypatch.setattr(PupilTracker, 'same_state', staticmethod(lambda s1, s2: False))
+
+    # segments start at 30, 60 and 90 (warm-up from 20, 50 and 80); all are retracked
+    for inaccurate_frames, fallback in [([], False), ([50], True), ([60], True)]:
+        parallel_traces = eye_tracking.track_parallel(PARAMETERS, filename, eye_roi,
+                                                      num_processes=4, overlap=10)
+        output = capsys.readouterr().out
+        assert 'Retracking frames 30-60' in output, 'Segments were not retracked'
+        assert ('tracking sequentially' in output) == fallback, 'Seeks were not checked'
+        assert len(parallel_traces) == len(traces), 'Missing frames'
+        for trace, parallel_trace in zip(traces, parallel_traces):
+            assert trace.keys() == parallel_trace.keys(), 'Tracking results do not match'
+            for k in trace:
+                assert_allclose(parallel_trace[k], trace[k], err_msg='Tracking results do '
+                                'not match (frame {}, {})'.format(trace['frame_id'], k))
+
+
+def test_track_frames_from_decode_service(tmp_path):
+    filename = str(tmp_path / 'eye.avi')
+    _write_video(filename)
+    eye_roi = np.array([[40, 200], [60, 260]])
+    traces = PupilTracker(PARAMETERS, verbose=False).track(filename, eye_roi)
+
+    tracker = PupilTracker(PARAMETERS, verbose=False)
+    service = video.DecodeService(filename, gray=True, ring_size=8)
+    service.register('tracker', lambda frames: list(tracker.track_frames(
+        (frame for _, frame in frames), eye_roi)))
+    service.register('statistics', video.frame_statistics)
+    results, errors = service.run()
+
+    assert not errors and len(results['tracker']) == len(traces), 'Missing frames'
+    for trace, service_trace in zip(traces, results['tracker']):
+        assert trace.keys() == service_trace.keys(), 'Tracking results do not match'
+        for k in trace:
+            assert_allclose(service_trace[k], trace[k], err_msg='Tracking results do not '
+                            'match (frame {}, {})'.format(trace['frame_id'], k))
+    assert_allclose(results['statistics'][:, 1], [t['frame_intensity'] for t in traces],
+                    err_msg='Frame intensities do not match')
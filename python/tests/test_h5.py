@@ -0,0 +1,114 @@
+""" Test suite for reading and decoding olfaction files."""
+import h5py
+import os
+import numpy as np
+from numpy.testing import assert_allclose
+from pipeline.utils import h5, signal
+
+
+def _write_analog_file(filename, num_packets=300, packet_size=100, fs=10000, fps=30,
+                       mistimed_packets=(40, 41, 42, 200)):
+    """ Synthetic olfaction analog file (v1.0) with mistimed packets and a clock wrap."""
+    packet_ticks = packet_size / fs * 1e7
+    packet_ts = 2 ** 32 - 50 * packet_ticks + np.arange(1, num_packets + 1) * packet_ticks
+    packet_ts[list(mistimed_packets)] += 0.4 * packet_ticks
+    ts = np.repeat(packet_ts % 2 ** 32, packet_size)
+
+    sample_times = np.arange(num_packets * packet_size) / fs
+    scanimage = np.where((sample_times * fps) % 1 < 0.5, 5.0, 0.0)
+    breath = np.sin(2 * np.pi * 3 * sample_times)
+
+    with h5py.File(filename, 'w', driver='family') as f:
+        f.attrs.create('Version', ['1.0'], dtype=h5py.string_dtype())
+        f.attrs['waveform Frame Size'] = [packet_size]
+        f.attrs['waveform Fs'] = [fs]
+        f['waveform'] = np.stack([scanimage, breath, ts])
+
+
+def _ts2sec(ts, sampling_rate=1e7):
+    """ Original (loop-based) h5.ts2sec for packeted signals."""
+    ts = np.array(ts, np.float64)
+    for wrap_idx in np.where(np.diff(ts) < 0)[0]:
+        ts[wrap_idx + 1:] += 2 ** 32
+    ts_secs = ts / sampling_rate
+    packet_limits = np.where(np.diff([-float('inf'), *ts, float('inf')]))[0]
+    packet_size = np.diff(packet_limits)[0]
+    expected_length = np.median(np.diff(ts_secs[packet_limits[:-1]]))
+    xs = np.array([*range(0, len(ts_secs), packet_size), len(ts_secs)])
+    ys = np.array([ts_secs[0] - expected_length, *ts_secs[xs[:-1]]])
+    sample_xs = np.arange(len(ts_secs))
+    ts_secs = np.interp(sample_xs, xs, ys)
+    abnormal_diffs = abs(np.diff(ys) - expected_length) > 0.1 * expected_length
+    abnormal_limits = np.where(np.diff([0, *abnormal_diffs, 0]))[0]
+    for start, stop in zip(abnormal_limits[::2], abnormal_limits[1::2]):
+        ts_secs[np.logical_and(sample_xs > xs[start], sample_xs < xs[stop])] = float('nan')
+    return ts_secs
+
+
+def _fill_time_gaps(times, period):
+    """ Original (loop-based) gap filling in odor.OdorSync."""
+    nan_limits = np.where(np.diff(np.isnan(times)))[0]
+    nan_limits[1::2] += 1
+    filled = []
+    for i, (start, stop) in enumerate(zip(nan_limits[::2], nan_limits[1::2])):
+        filled.extend(times[0 if i == 0 else nan_limits[2 * i - 1]: start + 1])
+        num_missing = int(round((times[stop] - times[start]) / period - 1))
+        filled.extend(np.linspace(times[start], times[stop], num_missing + 2)[1:-1])
+    filled.extend(times[nan_limits[-1]:])
+    return np.array(filled)
+
+
+def test_decode_analog_file_fills_gaps(tmp_path):
+    filename = str(tmp_path / 'recording_%d.h5')
+    _write_analog_file(filename)
+
+    data = h5.decode_analog_olfaction_file(filename)
+    assert h5.decode_analog_olfaction_file(filename) is data, 'Decoded file was not cached'
+    assert np.any(np.isnan(data['times'])), 'Mistimed packets were not detected'
+    assert_allclose(data['times'], _ts2sec(data['ts']), err_msg='Times do not match')
+
+    # Fill gaps in frame times
+    rising_edges = np.where(np.diff((data['scanImage'] > 2.7).astype(int)) > 0)[0]
+    frame_times = data['times'][rising_edges]
+    frame_period = np.nanmedian(np.diff(frame_times))
+    filled = signal.fill_time_gaps(frame_times, frame_period)
+    assert not np.any(np.isnan(filled)), 'Gaps were not filled'
+    assert_allclose(filled, _fill_time_gaps(frame_times, frame_period),
+                    err_msg='Filled frame times do not match')
+    assert_allclose(np.diff(filled), frame_period, rtol=0.05, err_msg='Irregular frames')
+
+    # Gaps can have more timepoints than NaNs
+    times = np.array([0, 1, np.nan, 4, 5, np.nan, np.nan, 8])
+    assert_allclose(signal.fill_time_gaps(times, 1), np.arange(9),
+                    err_msg='Gap filling is wrong')
+
+
+def test_decoded_analog_files_are_cached(tmp_path, monkeypatch):
+    filenames = [str(tmp_path / 'recording{}_%d.h5'.format(i)) for i in range(3)]
+    for filename in filenames:
+        _write_analog_file(filename)
+
+    # Decoding all files twice (e.g., OdorSync then Respiration) decodes each once
+    decoded = [h5.decode_analog_olfaction_file(filename) for filename in filenames]
+    for filename, data in zip(filenames, decoded):
+        assert h5.decode_analog_olfaction_file(filename) is data, 'File decoded twice'
+
+    # Least recently used files are dropped when the cache is full
+    file_gb = sum(v.nbytes for v in decoded[0].values() if isinstance(v, np.ndarray))
+    file_gb /= 1024 ** 3
+    monkeypatch.setattr(h5, 'ANALOG_CACHE_GB', 2.5 * file_gb)
+    os.utime(filenames[0] % 0, (0, 0))  # modified: decoded again
+    data = h5.decode_analog_olfaction_file(filenames[0])
+    assert data is not decoded[0], 'Modified file was not decoded again'
+    assert list(h5._decoded_analog_files) == filenames[2:] + filenames[:1]
+
+
+def test_decode_valves_matches_binary_strings():
+    valves = np.array([1, 10, 2028, 2 ** 40 + 3, 5], dtype=np.float64)
+    decoded = h5.decode_valves(valves)
+    assert decoded.shape == (5, 41)
+    assert h5.decode_valves([0]).tolist() == [[False]], 'All closed should be [False]'
+    for valve_state, num in zip(decoded, valves):
+        expected = [bool(int(d)) for d in format(int(num), 'b')][::-1]
+        assert valve_state[:len(expected)].tolist() == expected, 'Valves do not match'
+        assert not np.any(valve_state[len(expected):]), 'Valves do not match'
@@ -0,0 +1,98 @@
+""" Test suite for the sparse mask representation."""
+import numpy as np
+from numpy.testing import assert_allclose
+from pipeline.utils.masks import SparseMaskSet
+
+
+def _make_masks(num_masks=20, image_height=60, image_width=50, seed=0):
+    """ Random gaussian blobs as (1-based, F-order) pixels and weights."""
+    rng = np.random.default_rng(seed)
+    ys, xs = np.meshgrid(np.arange(image_height), np.arange(image_width), indexing='ij')
+    mask_pixels, mask_weights = [], []
+    for _ in range(num_masks):
+        cy, cx = rng.uniform(0, image_height), rng.uniform(0, image_width)
+        blob = np.exp(-((ys - cy) ** 2 + (xs - cx) ** 2) / (2 * rng.uniform(2, 5) ** 2))
+        blob[blob < 0.05] = 0
+        pixels = np.flatnonzero(blob.ravel(order='F'))
+        mask_pixels.append(pixels + 1)
+        mask_weights.append(blob.ravel(order='F')[pixels])
+    return mask_pixels, mask_weights, image_height, image_width
+
+
+def _dense_masks(mask_pixels, mask_weights, image_height, image_width):
+    """ Dense masks as created by the original Segmentation.reshape_masks."""
+    masks = np.zeros([image_height, image_width, len(mask_pixels)], dtype=np.float32)
+    for i, (mp, mw) in enumerate(zip(mask_pixels, mask_weights)):
+        mask_as_vector = np.zeros(image_height * image_width)
+        mask_as_vector[np.squeeze(mp - 1).astype(int)] = np.squeeze(mw)
+        masks[:, :, i] = mask_as_vector.reshape(image_height, image_width, order='F')
+    return masks
+
+
+def test_sparse_masks_match_dense_masks():
+    args = _make_masks()
+    masks = SparseMaskSet.from_pixels(*args)
+    dense = _dense_masks(*args)
+
+    assert_allclose(masks.to_dense(), dense, err_msg='Dense masks do not match')
+    assert_allclose(masks.to_dense([3, 5]), dense[:, :, [3, 5]],
+                    err_msg='Subset of dense masks does not match')
+    assert_allclose(SparseMaskSet.from_dense(dense).to_dense(), dense,
+                    err_msg='Masks created from dense masks do not match')
+
+    ys, xs = np.meshgrid(np.arange(dense.shape[0]), np.arange(dense.shape[1]),
+                         indexing='ij')
+    expected_centroids = np.stack([np.sum(dense * ys[..., None], axis=(0, 1)),
+                                   np.sum(dense * xs[..., None], axis=(0, 1))], axis=-1)
+    expected_centroids /= np.sum(dense, axis=(0, 1))[:, None]
+    assert_allclose(masks.centroids(), expected_centroids, rtol=1e-5,
+                    err_msg='Centroids do not match')
+
+    delay_image = np.random.default_rng(1).uniform(size=dense.shape[:2])
+    expected_delays = (np.sum(dense * np.expand_dims(delay_image, -1), axis=(0, 1)) /
+                       np.sum(dense, axis=(0, 1)))
+    assert_allclose(masks.weighted_mean(delay_image), expected_delays, rtol=1e-5,
+                    err_msg='Weighted means do not match')
+
+    for (y0, y1, x0, x1), mask in zip(masks.bounding_boxes(), dense.transpose([2, 0, 1])):
+        assert np.count_nonzero(mask) == np.count_nonzero(mask[y0:y1, x0:x1]), \
+            'Mask is not inside its box'
+        assert np.any(mask[y0]) and np.any(mask[y1 - 1]), 'Box is not tight'
+        assert np.any(mask[:, x0]) and np.any(mask[:, x1 - 1]), 'Box is not tight'
+
+
+def test_binarize_matches_cumulative_mass():
+    args = _make_masks()
+    masks = SparseMaskSet.from_pixels(*args)
+    binary_masks = masks.binarize(0.9).to_dense()
+    dense = _dense_masks(*args).transpose([2, 0, 1])
+    assert_allclose(masks.to_dense().transpose([2, 0, 1]), dense,
+                    err_msg='Binarizing modified the original masks')
+
+    for binary_mask, mask in zip(binary_masks.transpose([2, 0, 1]), dense):
+        indices = np.unravel_index(np.flip(np.argsort(mask, axis=None), axis=0),
+                                   mask.shape)  # max to min value in mask
+        expected = np.zeros(mask.shape, dtype=bool)
+        expected[indices] = np.cumsum(mask[indices] ** 2) / np.sum(mask ** 2) < 0.9
+        assert_allclose(binary_mask, expected, err_msg='Binary masks do not match')
+
+
+def test_overlap_counts_shared_pixels():
+    masks = SparseMaskSet.from_pixels(*_make_masks())
+    support = masks.to_dense() > 0
+    expected = np.einsum('yxi,yxj->ij', support.astype(int), support.astype(int))
+    assert_allclose(masks.overlap().toarray(), expected, err_msg='Overlaps do not match')
+
+
+def test_label_ious_match_dense_ious():
+    args = _make_masks()
+    masks = SparseMaskSet.from_pixels(*args).binarize(0.9)
+    binary_masks = masks.to_dense().transpose([2, 0, 1]) > 0
+    label_image = np.random.default_rng(2).integers(0, 8, size=binary_masks.shape[1:]) * 3
+    labels = [21, 3, 6, 12, 30]  # unsorted, 30 not in image, 9, 15 and 18 ignored
+
+    expected = [np.logical_and(binary_masks, label_image == label).sum(axis=(1, 2)) /
+                np.logical_or(binary_masks, label_image == label).sum(axis=(1, 2)) for
+                label in labels]
+    assert_allclose(masks.label_ious(label_image, labels).toarray(), expected,
+                    err_msg='IOUs do not match')
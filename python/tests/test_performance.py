@@ -0,0 +1,63 @@
+""" Test suite for memory mapped scans (used by CNMF) and chunked inserts."""
+import os
+import numpy as np
+from pipeline.utils import performance
+
+
+def test_evict_memmaps_deletes_least_recently_used(tmp_path):
+    suffix = '_d1_16_d2_16_d3_1_order_C_frames_1024_.mmap'
+    kept = [str(tmp_path / 'caiman-{:032x}{}'.format(i, suffix)) for i in range(4)]
+    temporary = str(tmp_path / ('caiman-1b4e28ba-2fa1-11d2-883f-0016d3cca427' + suffix))
+    for i, filename in enumerate(kept + [temporary]):
+        with open(filename, 'wb') as f:
+            f.truncate(1024 ** 2)  # 1 MB each
+        os.utime(filename, (i, i))
+
+    deleted = performance.evict_memmaps(str(tmp_path), max_gb=2.5 / 1024, keep=kept[0])
+
+    assert deleted == kept[1:3], 'Did not evict the least recently used memmaps'
+    assert sorted(os.listdir(str(tmp_path))) == sorted(os.path.basename(f) for f in
+                                                       [kept[0], kept[3], temporary])
+
+
+class CountingTable():
+    """ Table that records each insert statement (rows sent in one round trip)."""
+    def __init__(self):
+        self.statements = []
+
+    def insert(self, rows, **kwargs):
+        self.statements.append(list(rows))
+
+    @property
+    def rows(self):
+        return [row for statement in self.statements for row in statement]
+
+
+def test_insert_in_chunks_sends_one_statement_per_chunk():
+    key = {'animal_id': 1, 'session': 2, 'scan_idx': 3, 'tracking_method': 1}
+
+    # Tracking.ManualTracking: a contour (or None if not detected) per frame
+    contours = [[None] if i % 7 == 0 else [np.full((5, 1, 2), i)] for i in range(12345)]
+    table = CountingTable()
+    num_statements = performance.insert_in_chunks(
+        table, performance.frame_rows(key, contours, ['contour']), chunk_size=5000)
+    assert num_statements == len(table.statements) == 3, 'Wrong number of statements'
+    assert [len(s) for s in table.statements] == [5000, 5000, 2345]
+    assert [row['frame_id'] for row in table.rows] == list(range(12345)), 'Wrong frame ids'
+    for row, (contour, ) in zip(table.rows, contours):
+        assert row['contour'] is contour and row['animal_id'] == 1
+
+    # FittedPupil.Ellipse: object rows with rejected fits set to None
+    names = ['center', 'major_radius', 'minor_radius', 'rotation_angle', 'visible_portion']
+    ellipses = np.empty((1000, 5), dtype=object)
+    for i in range(len(ellipses)):
+        ellipses[i] = (float(i), 2.0 * i), 10.0, 5.0, 0.5, 1.0
+    ellipses[::3] = None, None, None, None, -3.0
+    table = CountingTable()
+    performance.insert_in_chunks(table, performance.frame_rows(key, ellipses, names),
+                                 chunk_size=300)
+    assert [len(s) for s in table.statements] == [300, 300, 300, 100]
+    assert [row['frame_id'] for row in table.rows] == list(range(1000)), 'Wrong frame ids'
+    assert all(row['center'] is None and row['visible_portion'] == -3.0 for row in
+               table.rows[::3]), 'Rejected fits were not inserted as NULL'
+    assert table.rows[1]['center'] == (1.0, 2.0) and table.rows[1]['major_radius'] == 10.0
@@ -0,0 +1,126 @@
+""" Test suite for batched circle and ellipse fitting."""
+import itertools
+import cv2
+import numpy as np
+from numpy.testing import assert_allclose
+from pipeline.utils import pupil_fitting
+
+
+def _pupil_points(num_frames=1000, num_points=8, noise=1):
+    """ Noisy points on ellipses with random centers, axes and orientations."""
+    rng = np.random.default_rng(0)
+    t = rng.uniform(0, 2 * np.pi, (num_frames, num_points))
+    centers = rng.uniform(50, 200, (num_frames, 1, 2))
+    axes = rng.uniform(5, 30, (num_frames, 1, 2))
+    angles = rng.uniform(0, np.pi, (num_frames, 1))
+    x, y = axes[..., 0] * np.cos(t), axes[..., 1] * np.sin(t)
+    points = centers + np.stack([x * np.cos(angles) - y * np.sin(angles),
+                                 x * np.sin(angles) + y * np.cos(angles)], axis=-1)
+    points += rng.normal(0, noise, points.shape)
+    valid = rng.random((num_frames, num_points)) > 0.15
+
+    return points, valid
+
+
+def _enclosing_circle(points):
+    """ Smallest circumcircle of three points enclosing all points (brute force)."""
+    best = None
+    for a, b, c in itertools.combinations(points, 3):
+        (ax, ay), (bx, by), (cx, cy) = a, b, c
+        d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+        if d == 0:
+            continue
+        x = ((ax**2 + ay**2) * (by - cy) + (bx**2 + by**2) * (cy - ay) +
+             (cx**2 + cy**2) * (ay - by)) / d
+        y = ((ax**2 + ay**2) * (cx - bx) + (bx**2 + by**2) * (ax - cx) +
+             (cx**2 + cy**2) * (bx - ax)) / d
+        r = np.hypot(ax - x, ay - y)
+        if np.all(np.hypot(*(points - [x, y]).T) <= r * (1 + 1e-9)) and (best is None or
+                                                                        r < best[2]):
+            best = (x, y, r)
+    return best
+
+
+def test_fit_ellipses_matches_cv2():
+    points, valid = _pupil_points()
+    points = points.round()
+    centers, axes, angles = pupil_fitting.fit_ellipses(points, valid, min_points=6)
+
+    for frame in range(len(points)):
+        if valid[frame].sum() < 6:
+            assert np.all(np.isnan(centers[frame])), 'Ellipse fitted with too few points'
+            continue
+        (cx, cy), (width, height), angle = cv2.fitEllipse(
+            points[frame, valid[frame]].astype(np.int32).reshape(-1, 1, 2))
+        assert_allclose([*centers[frame], *axes[frame]], [cx, cy, width, height], atol=1e-3,
+                        err_msg='Ellipse {} does not match'.format(frame))
+        if angle != 0:
+            assert_allclose(np.cos(np.radians(2 * (angles[frame] - angle))), 1, atol=1e-6,
+                            err_msg='Ellipse angle {} does not match'.format(frame))
+
+
+def test_enclosing_circles_match_brute_force():
+    points, valid = _pupil_points(num_frames=300)
+    centers, radii = pupil_fitting.enclosing_circles(points, valid, min_points=3)
+
+    for frame in range(len(points)):
+        circle = _enclosing_circle(points[frame, valid[frame]])
+        if circle is None or valid[frame].sum() < 3:
+            assert np.isnan(radii[frame]), 'Circle fitted with too few points'
+            continue
+        assert_allclose([*centers[frame], radii[frame]], circle, rtol=1e-9,
+                        err_msg='Circle {} does not match'.format(frame))
+        _, min_radius = cv2.minEnclosingCircle(points[frame, valid[frame]].astype(np.float32))
+        assert radii[frame] >= min_radius - 1e-3, 'Circle is smaller than the enclosing one'
+
+
+def test_visible_portions_match_raster():
+    # fully inside, cut in half and outside of a square
+    square = np.array([[0, 0], [100, 0], [100, 100], [0, 100]], dtype=float)
+    eyelids = np.stack([square, square - [50, 0], square + [200, 0]])
+    centers = np.array([[50, 50]] * 3, dtype=float)
+    axes, angles = np.array([[40, 20]] * 3, dtype=float), np.array([0, 90, 30], dtype=float)
+    assert_allclose(pupil_fitting.visible_portions(eyelids, centers, axes, angles),
+                    [1, 0.5, 0], atol=1e-9, err_msg='Visible portions are wrong')
+
+    # non-convex eyelids against (high resolution) raster masks
+    rng = np.random.default_rng(1)
+    t = np.arange(8) * np.pi / 4
+    eyelids = np.stack([60 * np.cos(t), 40 * np.sin(t)], -1) * rng.uniform(0.5, 1.2, (20, 8, 1))
+    eyelids += 100
+    centers = 100 + rng.normal(0, 20, (20, 2))
+    axes, angles = rng.uniform(20, 60, (20, 2)), rng.uniform(0, 180, 20)
+    visible = pupil_fitting.visible_portions(eyelids, centers, axes, angles)
+
+    scale = 8  # pixels per unit
+    for frame in range(20):
+        eyelid_mask = cv2.fillPoly(np.zeros((200 * scale, 200 * scale), np.uint8),
+                                   [np.round(eyelids[frame] * scale).astype(np.int32)], 1)
+        ellipse_mask = cv2.ellipse(np.zeros_like(eyelid_mask), (
+            tuple(centers[frame] * scale), tuple(axes[frame] * scale), angles[frame]), 1, -1)
+        expected = np.sum(eyelid_mask & ellipse_mask) / np.sum(ellipse_mask)
+        assert_allclose(visible[frame], expected, atol=0.01,
+                        err_msg='Visible portion {} does not match'.format(frame))
+    assert 0 < visible.min() and visible.max() == 1
+
+
+def test_fit_contours_match_cv2():
+    rng = np.random.default_rng(3)
+    contours = []
+    for frame in range(300):
+        mask = cv2.ellipse(np.zeros((160, 200), np.uint8), (
+            tuple(rng.uniform(60, 140, 2)), tuple(rng.uniform(8, 60, 2)), rng.uniform(0, 180)),
+            1, -1)
+        contour, = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[0]
+        contours.append(contour)
+    contours[10], contours[20] = None, contours[20][:4]  # missing, too short
+    centers, axes, angles = pupil_fitting.fit_contours(contours, chunk_size=64)
+
+    for frame, contour in enumerate(contours):
+        if contour is None or len(contour) < 5:
+            assert np.all(np.isnan(axes[frame])), 'Ellipse fitted to a short contour'
+            continue
+        (cx, cy), (width, height), angle = cv2.fitEllipse(contour)
+        assert np.array_equal([*centers[frame], *axes[frame], angles[frame]],
+                              [cx, cy, width, height, angle]), \
+            'Ellipse {} does not match'.format(frame)
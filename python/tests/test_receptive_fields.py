@@ -0,0 +1,41 @@
+""" Test suite for the receptive field computations."""
+import numpy as np
+from numpy.testing import assert_allclose
+from pipeline.utils import receptive_fields
+from pipeline.utils.receptive_fields import RFEngine
+
+
+def _sta(snippets, movie, nbins):
+    """ Original (per bin) RF.spike_triggered_avg."""
+    return np.stack([np.tensordot(snippets, movie[:, :, rf_bin:rf_bin + snippets.shape[1]],
+                                  axes=(1, 2)) for rf_bin in reversed(range(nbins))], 3)
+
+
+def _predict_traces(movie, maps):
+    """ Original (per bin) RF.predict_traces."""
+    nbins = maps.shape[-1]
+    return sum(np.tensordot(maps[:, :, :, nbins - tau - 1], movie, axes=((1, 2), (0, 1)))[
+               :, tau:movie.shape[2] + tau - nbins + 1] for tau in range(nbins))
+
+
+def test_rf_engine_matches_per_bin_computation(tmp_path):
+    rng = np.random.default_rng(0)
+    movie = rng.uniform(-1, 1, size=(9, 16, 150)).astype(np.float32)
+    snippets = rng.normal(size=(30, 140))  # shorter than the movie
+    maps = rng.normal(size=(30, 9, 16, 5))
+
+    with RFEngine(5, cache_dir=str(tmp_path)) as engine:
+        engine.add_movie(1, movie)
+        assert_allclose(engine.spike_triggered_avg(snippets, 1), _sta(snippets, movie, 5),
+                        rtol=1e-4, atol=1e-3, err_msg='STAs do not match')
+        assert_allclose(engine.predict_traces(1, maps), _predict_traces(movie, maps),
+                        rtol=1e-4, atol=1e-3, err_msg='Predicted traces do not match')
+    assert not list(tmp_path.iterdir()), 'Cached movies were not deleted'
+
+
+def test_lag_matrix_is_a_view():
+    movie_matrix = np.arange(12, dtype=np.float32).reshape(4, 3)
+    lagged = receptive_fields.lag_matrix(movie_matrix, 2)
+    assert np.shares_memory(lagged, movie_matrix), 'Lag matrix is a copy'
+    assert_allclose(lagged, [movie_matrix[t:t + 2].ravel() for t in range(3)],
+                    err_msg='Lag matrix is wrong')
@@ -0,0 +1,27 @@
+""" Test suite for registration utilities."""
+import numpy as np
+from numpy.testing import assert_allclose
+from scipy.interpolate import griddata
+from pipeline.utils import registration
+
+
+def test_sample_affine_grid_matches_griddata():
+    rng = np.random.default_rng(0)
+    image = rng.random((40, 50))
+    rows, cols = np.meshgrid(np.arange(40), np.arange(50), indexing='ij')
+    A = np.array([[1.2, -0.3], [0.25, 0.9]])
+    grid = np.stack([cols, rows], axis=-1) @ A.T + [10, -5]
+    query_xs, query_ys = np.meshgrid(np.arange(0, 80, 0.7), np.arange(-10, 60, 0.9))
+
+    sampled = registration.sample_affine_grid(image, grid, query_xs, query_ys)
+    expected = griddata(grid.reshape(-1, 2), image.ravel(), (query_xs, query_ys),
+                        method='linear')
+
+    # griddata interpolates inside triangles (rather than bilinearly) so values only
+    # match at the grid points; check that both agree on what is outside the image
+    outside = np.isnan(expected)
+    assert_allclose(sampled[outside], 0, err_msg='Points outside the image are not zero')
+    assert np.mean(sampled[~outside] == 0) < 0.01, 'Points inside the image are zero'
+    assert_allclose(registration.sample_affine_grid(image, grid, grid[..., 0],
+                                                    grid[..., 1]), image, atol=1e-6,
+                    err_msg='Sampling at the grid does not recover the image')
@@ -0,0 +1,171 @@
+""" Test suite for tiled 3-d segmentation."""
+import numpy as np
+import torch
+from numpy.testing import assert_allclose
+from pipeline.utils import segmentation3d
+
+
+class ConvNet(torch.nn.Module):
+    """ Small fully convolutional model with the same outputs as QCANet."""
+    def __init__(self, num_layers=3):
+        super().__init__()
+        layers = [torch.nn.Conv3d(1 if i == 0 else 4, 4, 3, padding=1) for i in
+                  range(num_layers)]
+        self.features = torch.nn.Sequential(*[m for l in layers for m in
+                                              (l, torch.nn.ReLU())])
+        self.detection = torch.nn.Conv3d(4, 1, 1)
+        self.segmentation = torch.nn.Conv3d(4, 1, 1)
+
+    def forward(self, x):
+        features = self.features(x)
+        return self.detection(features), self.segmentation(features)
+
+
+class UNet(torch.nn.Module):
+    """ Small model with pooling and skip connections (as QCANet)."""
+    def __init__(self):
+        super().__init__()
+        conv = lambda in_channels, out_channels: torch.nn.Sequential(
+            torch.nn.Conv3d(in_channels, out_channels, 3, padding=1), torch.nn.ReLU())
+        self.down1, self.down2, self.bottom = conv(1, 4), conv(4, 8), conv(8, 8)
+        self.up2, self.up1 = conv(16, 4), conv(8, 4)
+        self.pool = torch.nn.MaxPool3d(2)
+        self.upsample = torch.nn.Upsample(scale_factor=2)
+        self.detection = torch.nn.Conv3d(4, 1, 1)
+        self.segmentation = torch.nn.Conv3d(4, 1, 1)
+
+    def forward(self, x):
+        x1 = self.down1(x)
+        x2 = self.down2(self.pool(x1))
+        x3 = self.bottom(self.pool(x2))
+        x2 = self.up2(torch.cat([self.upsample(x3), x2], 1))
+        features = self.up1(torch.cat([self.upsample(x2), x1], 1))
+        return self.detection(features), self.segmentation(features)
+
+    def forward_on_big_input(self, x):
+        self.big_input_calls = getattr(self, 'big_input_calls', 0) + 1
+        return self(x)
+
+
+def _whole_volume_prediction(nets, volume):
+    input_ = torch.as_tensor(volume[np.newaxis, np.newaxis])
+    with torch.no_grad():
+        detections = [torch.sigmoid(net(input_)[0])[0, 0].numpy() for net in nets]
+        segmentations = [torch.sigmoid(net(input_)[1])[0, 0].numpy() for net in nets]
+    return np.mean(detections, axis=0), np.mean(segmentations, axis=0)
+
+
+def test_tiled_inference_matches_whole_volume():
+    torch.manual_seed(0)
+    nets = [ConvNet() for _ in range(4)]
+    volume = np.random.default_rng(0).normal(size=(30, 50, 45)).astype(np.float32)
+    expected_detection, expected_segmentation = _whole_volume_prediction(nets, volume)
+
+    engine = segmentation3d.SegmentationEngine(nets=nets, device='cpu', tiled=True,
+                                               tile_shape=(16, 20, 24), overlap=(4, 6, 8),
+                                               halo=(3, 3, 3), pooling_stride=(1, 1, 1))
+    detection, segmentation = engine.predict(volume)
+
+    assert_allclose(detection, expected_detection, atol=1e-5,
+                    err_msg='Tiled detection differs from whole-volume inference')
+    assert_allclose(segmentation, expected_segmentation, atol=1e-5,
+                    err_msg='Tiled segmentation differs from whole-volume inference')
+
+
+def test_tiled_inference_with_pooling_matches_whole_volume():
+    torch.manual_seed(0)
+    nets = [UNet() for _ in range(2)]
+    volume = np.random.default_rng(0).normal(size=(36, 52, 44)).astype(np.float32)
+    expected_detection, expected_segmentation = _whole_volume_prediction(nets, volume)
+
+    # whole volume (default) uses forward_on_big_input
+    detection, _ = segmentation3d.SegmentationEngine(nets=nets, device='cpu').predict(volume)
+    assert all(net.big_input_calls == 1 for net in nets), 'forward_on_big_input not used'
+    assert_allclose(detection, expected_detection, atol=1e-6)
+
+    # tiles (extended to align with the pooling grid) with a halo covering the receptive
+    # field; e.g., the last tile in depth starts at 20 - 18 = 2 and is extended to 0
+    engine = segmentation3d.SegmentationEngine(nets=nets, device='cpu', tiled=True,
+                                               tile_shape=(16, 20, 24), overlap=(4, 6, 8),
+                                               halo=(18, 18, 18), pooling_stride=(4, 4, 4))
+    detection, segmentation = engine.predict(volume)
+    assert_allclose(detection, expected_detection, atol=1e-5,
+                    err_msg='Tiled detection differs from whole-volume inference')
+    assert_allclose(segmentation, expected_segmentation, atol=1e-5,
+                    err_msg='Tiled segmentation differs from whole-volume inference')
+
+
+def test_tiles_cover_volume():
+    volume_shape = (30, 50, 45)
+    covered = np.zeros(volume_shape, dtype=int)
+    for tile, input_tile, crop in segmentation3d._tiles(volume_shape, (16, 20, 24),
+                                                        (4, 6, 8), (3, 3, 3), (4, 4, 4)):
+        covered[tile] += 1
+        for t, i, c, size in zip(tile, input_tile, crop, volume_shape):
+            assert t.start == i.start + c.start and t.stop == i.start + c.stop
+            assert i.start % 4 == 0 and (i.stop % 4 == 0 or i.stop == size), 'Misaligned'
+    assert np.all(covered > 0), 'Some voxels are not covered by any tile'
+
+
+def test_tile_shape_respects_memory_cap():
+    engine = segmentation3d.SegmentationEngine(nets=[ConvNet()], device='cpu', tiled=True,
+                                               halo=(20, 20, 20), max_memory_in_GB=1,
+                                               bytes_per_voxel=1024)
+    tile_shape = engine._compute_tile_shape((100, 200, 200))
+    tile_bytes = np.prod(tile_shape + 2 * engine.halo) * 1024
+    assert tile_bytes + 16 * 100 * 200 * 200 <= 1024 ** 3
+
+
+def _field_unit_properties_loop(instance, segmented_field, grid, stack_center):
+    """ Unit properties as originally computed in stack.FieldSegmentation (one by one)."""
+    from skimage import measure
+    from scipy import ndimage
+
+    instance_props = measure.regionprops(instance)
+    instance_labels = np.array([p.label for p in instance_props])
+    units = []
+    for prop in measure.regionprops(segmented_field):
+        sunit_id = prop.label
+        instance_prop = instance_props[np.argmax(instance_labels == sunit_id)]
+        sunit_z, sunit_y, sunit_x = (stack_center + np.array(instance_prop.centroid) -
+                                     np.array(instance.shape) / 2 + 0.5)
+        binary_sunit = segmented_field == sunit_id
+        px_y, px_x = ndimage.center_of_mass(binary_sunit)
+        mask_x, mask_y, mask_z = [ndimage.map_coordinates(grid[..., i], [[px_y], [px_x]],
+                                                          order=1)[0] for i in range(3)]
+        units.append([sunit_id, instance_prop.bbox[3] - instance_prop.bbox[0],
+                      instance_prop.bbox[4] - instance_prop.bbox[1],
+                      instance_prop.bbox[5] - instance_prop.bbox[2], instance_prop.area,
+                      np.count_nonzero(binary_sunit), sunit_z, sunit_y, sunit_x, mask_z,
+                      mask_y, mask_x, np.sqrt((sunit_z - mask_z) ** 2 +
+                                              (sunit_y - mask_y) ** 2 +
+                                              (sunit_x - mask_x) ** 2)])
+    return np.array(units)
+
+
+def test_field_unit_properties_match_loop():
+    from scipy import ndimage
+
+    # Instance volume with 10k labels (small random boxes)
+    rng = np.random.default_rng(0)
+    instance = np.zeros((60, 300, 300), dtype=np.int32)
+    for label, (z, y, x) in enumerate(rng.integers(0, [56, 294, 294], (10000, 3)), 1):
+        dz, dy, dx = rng.integers(2, 7, 3)
+        instance[z: z + dz, y: y + dy, x: x + dx] = label
+
+    # Sample a tilted field (grid has the x, y, z coordinates of each pixel)
+    stack_center = np.array([-310.0, 20.0, 5.0])
+    ys, xs = np.meshgrid(np.arange(250) - 125.0, np.arange(280) - 140.0, indexing='ij')
+    grid = np.stack([xs + 5.0, ys + 20.0, -310.0 + 0.1 * xs - 0.05 * ys], axis=-1)
+    px_grid = grid[..., ::-1] - stack_center - 0.5 + np.array(instance.shape) / 2
+    segmented_field = ndimage.map_coordinates(instance, np.moveaxis(px_grid, -1, 0),
+                                              order=0)
+
+    units = segmentation3d.field_unit_properties(instance, segmented_field, grid,
+                                                 stack_center)
+    keys = ['sunit_id', 'depth', 'height', 'width', 'volume', 'area', 'sunit_z',
+            'sunit_y', 'sunit_x', 'mask_z', 'mask_y', 'mask_x', 'distance']
+    expected = _field_unit_properties_loop(instance, segmented_field, grid, stack_center)
+    assert len(units) > 500, 'Synthetic field has too few units'
+    assert_allclose([[unit[k] for k in keys] for unit in units], expected, rtol=1e-6,
+                    err_msg='Unit properties do not match the original loop')
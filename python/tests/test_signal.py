@@ -0,0 +1,29 @@
+""" Test suite for signal processing utilities."""
+import numpy as np
+from numpy.testing import assert_allclose
+from pipeline.utils import signal
+
+
+def test_fft_mirrconv_matches_direct_mirrconv():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=20000)
+    x[[100, 5000, 5001, 19990]] = float('nan')  # NaNs spread over the filter window
+    for filter_size in [3, 301, 1001]:
+        filter_ = np.hanning(filter_size + 2)[1:-1]
+        filter_ /= filter_.sum()
+        direct = signal.mirrconv(x, filter_, method='direct')
+        fft = signal.mirrconv(x, filter_, method='fft')
+        assert_allclose(fft, direct, atol=1e-10, err_msg='FFT convolution does not match')
+        assert_allclose(signal.mirrconv(x, filter_), direct, atol=1e-10,
+                        err_msg='Auto convolution does not match')
+
+
+def test_downsampled_low_pass_filter_matches_filtered_signal():
+    rng = np.random.default_rng(1)
+    x = np.cumsum(rng.normal(size=10007))
+    x[[50, 3000]] = float('nan')
+    for filter_size, step in [(200, 100), (10, 3), (1000, 7), (20, 1)]:
+        expected = signal.low_pass_filter(x, 100, 1, filter_size=filter_size)[::step]
+        assert_allclose(signal.low_pass_filter(x, 100, 1, filter_size=filter_size,
+                                               step=step), expected, atol=1e-10,
+                        err_msg='Downsampled signal does not match')
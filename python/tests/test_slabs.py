@@ -0,0 +1,42 @@
+""" Test suite for the streaming (z-slab) stack preprocessing."""
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+from pipeline.utils import slabs, registration, enhancement
+
+
+def test_preprocess_stack_matches_full_stack(tmp_path):
+    original = np.random.default_rng(0).random((30, 40, 50), dtype=np.float32)
+    um_sizes = (70, 45, 55)
+    resized = registration.resize(original, um_sizes, desired_res=1)
+    lcned = enhancement.lcn(resized, (3, 25, 25))
+    sharpened = enhancement.sharpen_2pimage(lcned, 1)
+
+    filenames = [str(tmp_path / '{}.npy'.format(i)) for i in range(3)]
+    max_gb = 0.0035  # slabs of 11 slices
+    assert slabs.get_slab_depth(resized.shape, original.shape, 16, max_gb) < 20
+    results = slabs.preprocess_stack(original, um_sizes, filenames, max_gb=max_gb)
+
+    assert_allclose(results[0], resized, atol=1e-5, err_msg='Resized stacks do not match')
+    assert_allclose(results[1], lcned, atol=1e-4, err_msg='Lcned stacks do not match')
+    assert_allclose(results[2], sharpened, atol=1e-5,
+                    err_msg='Sharpened stacks do not match')
+
+
+def test_percentiles_are_exact(tmp_path):
+    rng = np.random.default_rng(1)
+    volume = rng.integers(0, 50, size=(40, 30, 20)).astype(np.float32)  # many ties
+    volume[3] = rng.random((30, 20))
+    filename = str(tmp_path / 'volume.npy')
+    np.save(filename, volume)
+
+    q = [0, 3, 50, 99.9, 100]
+    assert_allclose(slabs.percentiles(filename, [(0, 13), (13, 26), (26, 40)], q),
+                    np.percentile(volume, q), rtol=1e-6, err_msg='Percentiles do not match')
+
+
+def test_slab_depth_raises_if_slices_do_not_fit():
+    from pipeline.exceptions import PipelineException
+    assert slabs.get_slab_depth((100, 500, 500), (50, 500, 500), halo=10, max_gb=1) > 0
+    with pytest.raises(PipelineException):
+        slabs.get_slab_depth((100, 5000, 5000), (50, 5000, 5000), halo=10, max_gb=1)
@@ -0,0 +1,73 @@
+""" Test suite for stitching routines."""
+import numpy as np
+from numpy.testing import assert_allclose
+from scipy.ndimage import interpolation
+from pipeline.utils import stitching
+
+
+def _make_mosaic(num_rows=3, num_cols=3, size=80, step=50):
+    """ Cut a random volume into overlapping (shuffled) ROIs at known positions."""
+    rng = np.random.default_rng(0)
+    volume = rng.random((2, (num_rows - 1) * step + size, (num_cols - 1) * step + size),
+                        dtype=np.float32)
+    rois = []
+    for i in range(num_rows):
+        for j in range(num_cols):
+            y, x = i * step, j * step
+            roi = volume[:, y: y + size, x: x + size].copy()
+            rois.append(stitching.StitchedROI(roi, x=x + size / 2, y=y + size / 2, z=0,
+                                              id_=i * num_cols + j))
+    rng.shuffle(rois)
+    return volume, rois
+
+
+def _join(left, right):
+    right.join_with(left, [s.x for s in left.slices], [s.y for s in left.slices])
+
+
+def test_join_rows_recovers_volume():
+    volume, rois = _make_mosaic()
+
+    rois = stitching.join_rows(rois, _join)
+    assert len(rois) == 3, 'Rows were not joined'
+    [roi.rot90() for roi in rois]
+    rois = stitching.join_rows(rois, _join)
+    [roi.rot270() for roi in rois]
+    assert len(rois) == 1, 'Columns were not joined'
+
+    stitched = rois[0]
+    assert sorted(c.id for c in stitched.roi_coordinates) == list(range(9))
+    assert stitched.volume.shape == (2, volume.shape[1] + 1, volume.shape[2] + 1)
+    assert_allclose(stitched.volume[:, :-1, :-1], volume, rtol=1e-5,
+                    err_msg='Stitched volume does not match the original volume')
+
+
+def test_shift_into_canvas_matches_full_shift():
+    rng = np.random.default_rng(1)
+    mask = rng.random((20, 30), dtype=np.float32)
+    slice_ = rng.random((20, 30), dtype=np.float32)
+    for delta in [(0, 0), (3, 0), (2.3, 7.75), (0.5, 10.1), (10.9, 0.2)]:
+        canvas_mask = np.zeros((35, 45), dtype=np.float32)
+        canvas_slice = np.zeros((35, 45), dtype=np.float32)
+        canvas_mask[:20, :30] = mask
+        canvas_slice[:20, :30] = slice_
+        expected_mask = interpolation.shift(canvas_mask, delta, order=1)
+        expected_slice = interpolation.shift(canvas_slice, delta, order=1)
+
+        (ys, xs), shifted_mask, shifted_slice = stitching._shift_into_canvas(
+            mask, slice_, delta, (35, 45))
+        result_mask = np.zeros((35, 45), dtype=np.float32)
+        result_slice = np.zeros((35, 45), dtype=np.float32)
+        result_mask[ys, xs] = shifted_mask
+        result_slice[ys, xs] = shifted_slice
+
+        assert_allclose(result_mask, expected_mask, err_msg='Shifted mask is different')
+        assert_allclose(result_slice, expected_slice, err_msg='Shifted slice is different')
+
+
+def test_extent_is_updated_after_moving_slices():
+    _, rois = _make_mosaic(num_rows=1, num_cols=1)
+    roi = rois[0]
+    x, y = roi.x, roi.y
+    roi.shift_slices([2, 2], [-3, -3])
+    assert roi.x == x + 3 and roi.y == y - 2, 'Cached ROI coordinates were not updated'
@@ -0,0 +1,78 @@
+""" Test suite for surface estimation."""
+import numpy as np
+from numpy.testing import assert_allclose
+from pipeline.utils import surface
+
+
+def _make_synthetic_stack(params, shape=(80, 300, 300), background=0, tissue=100):
+    """ Stack that is dark above a paraboloid surface and bright below it."""
+    depth, height, width = shape
+    mesh_x, mesh_y = np.meshgrid(np.arange(width), np.arange(height))
+    surface_im = surface.surface_eqn((mesh_x, mesh_y), *params)
+    zs = np.arange(depth).reshape(-1, 1, 1)
+    stack = np.where(zs >= surface_im, tissue, background).astype(np.float32)
+    stack += np.random.default_rng(0).normal(scale=1, size=shape).astype(np.float32)
+    return stack, surface_im
+
+
+def test_guessed_points_match_ground_truth():
+    params = (2e-4, 2e-4, -0.06, -0.06, 25)
+    stack, surface_im = _make_synthetic_stack(params)
+    points = surface.guess_surface_points(stack, r=20)
+
+    assert len(points) == 25, 'Surface points were dropped in a clean synthetic stack'
+    assert_allclose(points[:, 0], surface_im[points[:, 1], points[:, 2]], atol=2,
+                    err_msg='Guessed surface depths do not match the ground truth')
+
+
+def test_guessed_points_from_lazy_stack(tmp_path):
+    from pipeline.utils import volume
+
+    stack, _ = _make_synthetic_stack((2e-4, 2e-4, -0.06, -0.06, 25))
+    filename = str(tmp_path / 'stack.chunked')
+    volume.save_chunked(filename, stack)
+    lazy_stack = volume.LazyVolume.from_file(filename)
+
+    points = surface.guess_surface_points(lazy_stack, r=20)
+    assert np.array_equal(points, surface.guess_surface_points(stack, r=20))
+
+
+def test_guessed_points_order():
+    stack, _ = _make_synthetic_stack((0, 0, 0, 0, 30))
+    points = surface.guess_surface_points(stack, r=20)
+    assert np.all(np.diff(points[:, 2]) >= 0), 'Guessed points are not in x-major order'
+
+
+def test_bootstrap_bounds_contain_surface():
+    params = (2e-4, 2e-4, -0.06, -0.06, 25)
+    stack, surface_im = _make_synthetic_stack(params)
+    points = surface.guess_surface_points(stack, r=20)
+    initial = [1, 1, 150, 150, 1]
+    bounds = ([0, 0, -np.inf, -np.inf, -np.inf], [np.inf] * 5)
+
+    fitted = surface.surface_eqn(np.meshgrid(np.arange(300), np.arange(300)),
+                                 *surface.fit_surface(points, initial, bounds))
+    lower, upper = surface.bootstrap_surface_bounds(points, (300, 300), initial, bounds,
+                                                    num_iterations=50, seed=0,
+                                                    num_processes=1,
+                                                    chunk_size_in_GB=1e-4)
+    assert_allclose(fitted[60:240, 60:240], surface_im[60:240, 60:240], atol=2,
+                    err_msg='Fitted surface does not match the ground truth')
+    assert np.all(lower <= upper), 'Lower bound is above the upper bound'
+    assert np.all(lower[60:240, 60:240] <= fitted[60:240, 60:240] + 1)
+    assert np.all(upper[60:240, 60:240] >= fitted[60:240, 60:240] - 1)
+
+
+def test_bootstrap_bounds_are_reproducible():
+    points = np.array([[30 + x * 0.01 + y * 0.02, y, x] for x in range(50, 500, 100)
+                       for y in range(50, 400, 100)])
+    initial = [1, 1, 250, 200, 1]
+    bounds = ([0, 0, -np.inf, -np.inf, -np.inf], [np.inf] * 5)
+    kwargs = {'num_iterations': 20, 'seed': 123}
+    results1 = surface.bootstrap_surface_bounds(points, (40, 50), initial, bounds,
+                                                num_processes=1, **kwargs)
+    results2 = surface.bootstrap_surface_bounds(points, (40, 50), initial, bounds,
+                                                num_processes=3, chunk_size_in_GB=1e-5,
+                                                **kwargs)
+    for res1, res2 in zip(results1, results2):
+        assert_allclose(res1, res2, err_msg='Bootstrap depends on the number of processes')
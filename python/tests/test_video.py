@@ -0,0 +1,110 @@
+""" Test suite for reading frames from videos."""
+import os
+import shutil
+import time
+import cv2
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+from pipeline.utils.video import (read_batches, DecodeService, preview_sampler, frame_statistics,
+                                  ClipCache)
+
+
+def _write_video(filename, fourcc, num_frames=100, shape=(64, 96)):
+    rng = np.random.default_rng(0)
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*fourcc), 30, shape[::-1])
+    for i in range(num_frames):
+        frame = rng.integers(0, 50, size=(*shape, 3), dtype=np.uint8)
+        cv2.putText(frame, str(i), (5, 50), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
+        writer.write(frame)
+    writer.release()
+
+    cap = cv2.VideoCapture(filename)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    return frames
+
+
+def test_read_batches_crops_and_converts(tmp_path):
+    filename = str(tmp_path / 'video.avi')
+    frames = np.stack(_write_video(filename, 'MJPG'))
+
+    batches = list(read_batches(filename, 16, start=10, stop=60, crop=(5, 90, 10, 40), rgb=True))
+    assert [len(batch) for batch in batches] == [16, 16, 16, 2], 'Wrong batches'
+    assert np.array_equal(np.concatenate(batches), frames[10:60, 10:40, 5:90, ::-1]), \
+        'Cropped frames do not match'
+
+    batches = list(read_batches(filename, 64, stop=1000))  # stop past the end
+    assert np.array_equal(np.concatenate(batches), frames), 'Frames do not match'
+
+
+def test_decode_service_feeds_all_consumers(tmp_path):
+    filename = str(tmp_path / 'video.avi')
+    frames = np.stack(_write_video(filename, 'MJPG'))
+    gray = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames])
+
+    def slow_copies(frames):  # slower than the decoder: fills the ring
+        copies = []
+        for frame_id, frame in frames:
+            time.sleep(0.001)
+            copies.append((frame_id, frame.copy()))
+        return copies
+
+    def failing(frames):
+        for frame_id, frame in frames:
+            if frame_id == 20:
+                raise RuntimeError('Consumer failed')
+
+    service = DecodeService(filename, crop=(5, 90, 10, 40), ring_size=4)
+    service.register('copies', slow_copies)
+    service.register('preview', preview_sampler([50, 3, 97]))
+    service.register('statistics', frame_statistics)
+    service.register('failing', failing)
+    results, errors = service.run(start=2)
+
+    assert service.num_decoded == 98, 'Video was not decoded once'
+    assert [frame_id for frame_id, _ in results['copies']] == list(range(2, 100))
+    assert np.array_equal(np.stack([frame for _, frame in results['copies']]),
+                          gray[2:, 10:40, 5:90]), 'Frames do not match'
+    assert np.array_equal(np.stack(results['preview']), gray[[50, 3, 97], 10:40, 5:90])
+    assert_allclose(results['statistics'][:, 0], gray[2:, 10:40, 5:90].mean(axis=(1, 2)),
+                    err_msg='Frame means do not match')
+    assert 'failing' not in results and isinstance(errors['failing'], RuntimeError)
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+def test_clip_cache_decodes_each_clip_once(tmp_path):
+    clips, expected = [], []
+    for i in range(3):
+        filename = str(tmp_path / 'clip{}.mp4'.format(i))
+        frames = np.stack(_write_video(filename, 'mp4v', num_frames=20 + i))
+        with open(filename, 'rb') as f:
+            clips.append(f.read())
+        expected.append(frames[..., ::-1])  # RGB
+
+    cache_dir = str(tmp_path / 'cache')
+    cache = ClipCache(cache_dir)
+    for trial in range(4):  # trials repeat the clips
+        for clip, frames in zip(clips, expected):
+            movie = cache.load(np.frombuffer(clip, dtype=np.uint8))
+            assert np.array_equal(movie, frames), 'Decoded clip does not match'
+    assert (cache.num_decoded, cache.num_cached) == (3, 9), 'Clips were decoded again'
+
+    gray = cache.load(clips[0], gray=True, downsample=2)
+    assert gray.shape == (20, 32, 48), 'Wrong grayscale and downsampled clip'
+    assert cache.num_decoded == 4, 'Transformed clips share a cache entry'
+
+    # least recently used clips are evicted
+    cache_dir = str(tmp_path / 'small_cache')
+    cache = ClipCache(cache_dir, max_bytes=2.5 * expected[0].nbytes)
+    for clip in clips:
+        cache.load(clip)
+    assert len(os.listdir(cache_dir)) == 2, 'Clips were not evicted'
+    cache.load(clips[1])
+    cache.load(clips[0])  # evicts clips[2]
+    cache.load(clips[1])
+    assert (cache.num_decoded, cache.num_cached) == (4, 2), 'Wrong clips were evicted'
@@ -0,0 +1,45 @@
+""" Test suite for chunked volumes."""
+import numpy as np
+from numpy.testing import assert_allclose
+from pipeline.utils import volume
+
+
+def test_lazy_volume_matches_array(tmp_path):
+    array = np.random.default_rng(0).random((37, 20, 30)).astype(np.float32)
+    for compression_level in [0, 1]:
+        filename = str(tmp_path / 'volume{}.chunked'.format(compression_level))
+        volume.save_chunked(filename, array, chunk_depth=8,
+                            compression_level=compression_level)
+        lazy = volume.LazyVolume.from_file(filename)
+
+        assert lazy.shape == array.shape and lazy.dtype == array.dtype
+        for key in [np.s_[:], np.s_[3], np.s_[-1], np.s_[5:20, 2:10, ::3],
+                    np.s_[30:100:2, 4], np.s_[::-5, :, 7], np.s_[::-9], np.s_[10:10]]:
+            assert_allclose(lazy[key], array[key],
+                            err_msg='Crop {} does not match'.format(key))
+        assert_allclose(np.asarray(lazy), array, err_msg='Full volume does not match')
+
+
+def test_lazy_volume_reads_only_needed_chunks(tmp_path):
+    array = np.zeros((64, 10, 10), dtype=np.float32)
+    filename = str(tmp_path / 'volume.chunked')
+    volume.save_chunked(filename, array, chunk_depth=16)
+    lazy = volume.LazyVolume.from_file(filename)
+
+    lazy[20:30, :5]
+    assert lazy.bytes_read == 16 * 10 * 10 * 4, 'Read chunks not needed for the crop'
+
+
+def test_percentile_matches_numpy(tmp_path):
+    rng = np.random.default_rng(0)
+    array = rng.normal(0, 1, (37, 20, 30)).astype(np.float32)
+    array[:5] = np.round(array[:5])  # some repeated values
+    filename = str(tmp_path / 'volume.chunked')
+    volume.save_chunked(filename, array, chunk_depth=8)
+    lazy = volume.LazyVolume.from_file(filename)
+
+    for q in [0, 0.1, 30, 50, 99.99, 100]:
+        lazy.bytes_read = 0
+        assert_allclose(volume.percentile(lazy, q), np.percentile(array, q), rtol=1e-6,
+                        err_msg='Percentile {} does not match'.format(q))
+        assert lazy.bytes_read == 2 * array.nbytes, 'Volume should be read twice'